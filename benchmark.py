@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+from src.world import World
+from src.simulator import Simulator
+from src.helper_functions import create_agents
+from src.metrics import default_observers
+from src.batch_runner import run_batch
+from src import plotting
+
+# Benchmark matrix of the step throughput
+AGENT_COUNTS = (12, 100, 1000, 5000)
+SENSING_RADII = (0, 200, 1000)
+SCENARIOS = ("a", "b")
+TEAM_MIXES = {"1:1": 0.5, "1:3": 0.25}   # fraction of team A
+ENGINES = ("python", "vectorized", "compiled")
+AGENT_RADIUS = 10
+# The world grows with the number of agents, so that the density never exceeds that of
+# 300 agents in the default 1000x1000 world (more agents would not fit at all)
+AGENTS_PER_WORLD = 300
+# Cases whose estimated number of (A, B) pair evaluations per step is larger than this are
+# skipped, e.g. 5000 agents that all sense each other can not be stepped by any engine
+MAX_PAIRS_PER_STEP = {"python": 2e6, "vectorized": 5e7, "compiled": 5e8}
+
+def world_size(num_agents):
+    return 1000 * max(1.0, np.sqrt(num_agents / AGENTS_PER_WORLD))
+
+def estimated_pairs(num_agents, sensing_radius, size, fraction_A):
+    """Rough number of (A, B) pairs that all agents evaluate in one step."""
+    sensed = num_agents
+    if sensing_radius > 0:
+        sensed = min(num_agents, num_agents * np.pi * sensing_radius**2 / size**2)
+    return num_agents * (fraction_A * sensed) * ((1 - fraction_A) * sensed)
+
+def make_agents(num_agents, sensing_radius, fraction_A, seed=0):
+    np.random.seed(seed)
+    world = World([0, world_size(num_agents)])
+    agents = []
+    num_A = int(round(num_agents * fraction_A))
+    create_agents(world, agents, 'A', num_A, 1, AGENT_RADIUS, sensing_radius)
+    create_agents(world, agents, 'B', num_agents - num_A, 1, AGENT_RADIUS, sensing_radius)
+    return world, agents
+
+def timing(times, **fields):
+    # one benchmark record, seconds is the median over the repeats
+    times = np.asarray(times, dtype=float)
+    return {**fields, "seconds": float(np.median(times)), "min": float(times.min()),
+            "mean": float(times.mean()), "max": float(times.max()), "repeats": len(times)}
+
+def bench_steps(agent_counts=AGENT_COUNTS, sensing_radii=SENSING_RADII, scenarios=SCENARIOS,
+                team_mixes=TEAM_MIXES, engines=ENGINES, steps=20, max_seconds=2.0, log=print):
+    """Time create_agents, Simulator.update per step and Simulator.simulate per step."""
+    results = []
+    for num_agents in agent_counts:
+        for sensing_radius in sensing_radii:
+            for mix, fraction_A in team_mixes.items():
+                params = {"num_agents": num_agents, "sensing_radius": sensing_radius, "team_mix": mix}
+                t = time.perf_counter()
+                world, agents = make_agents(num_agents, sensing_radius, fraction_A)
+                results.append(timing([time.perf_counter() - t], name=f"create_agents/N={num_agents}/mix={mix}",
+                                      group="create_agents", params=dict(params, sensing_radius=None)))
+                pairs = estimated_pairs(num_agents, sensing_radius, world.world_size, fraction_A)
+                for scenario in scenarios:
+                    for engine in engines:
+                        name = f"step/{engine}/{scenario}/N={num_agents}/r={sensing_radius}/mix={mix}"
+                        case = dict(params, scenario=scenario, engine=engine)
+                        if pairs > MAX_PAIRS_PER_STEP[engine]:
+                            results.append({"name": name, "group": "step", "params": case, "skipped": True})
+                            continue
+                        results.extend(bench_case(name, case, world, agents, scenario, engine, steps, max_seconds))
+                        log(f"{name}: {results[-2]['seconds']*1e3:.2f} ms/step")
+    return results
+
+def bench_case(name, case, world, agents, scenario, engine, steps, max_seconds):
+    # fresh copies of the agents, the engines turn them into views on their state arrays
+    agents = [type(agent)(agent.agent_type, agent.position.copy(), agent.step_length, agent.radius,
+                          agent.sensing_radius, agent.world_size) for agent in agents]
+    sim = Simulator(world, agents, scenario, engine=engine)
+    sim.update()   # warm up (e.g. numba compilation)
+
+    update_times = []
+    start = time.perf_counter()
+    while len(update_times) < steps and time.perf_counter() - start < max_seconds:
+        t = time.perf_counter()
+        sim.update()
+        update_times.append(time.perf_counter() - t)
+
+    # simulate() with the same number of steps that update() managed in the time budget
+    num_steps = len(update_times)
+    t = time.perf_counter()
+    sim.simulate(num_steps)
+    simulate_time = (time.perf_counter() - t) / num_steps
+    return [timing(update_times, name=name, group="step", params=case),
+            timing([simulate_time], name=name.replace("step/", "simulate/", 1), group="simulate",
+                   params=dict(case, steps=num_steps))]
+
+def bench_plotting(num_sims=5, steps=200, repeats=1, log=print):
+    """Time every plotting function on a few small simulations."""
+    sims = []
+    for seed in range(num_sims):
+        world, agents = make_agents(12, 200, 0.5, seed=seed)
+        sim = Simulator(world, agents, "a", engine="vectorized", observers=default_observers())
+        sim.simulate(steps)
+        sims.append(sim)
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # the plotting functions save to figures/ in the working directory
+        os.makedirs(os.path.join(tmp, "figures"))
+        os.chdir(tmp)
+        try:
+            for function in (plotting.plot_density, plotting.plot_rotated_histogram,
+                             plotting.plot_separation_index, plotting.plot_target_distance):
+                times = []
+                for _ in range(repeats):
+                    t = time.perf_counter()
+                    function(sims)
+                    times.append(time.perf_counter() - t)
+                    plt.close("all")
+                results.append(timing(times, name=f"plot/{function.__name__}", group="plot",
+                                      params={"num_sims": num_sims, "steps": steps}))
+                log(f"plot/{function.__name__}: {results[-1]['seconds']:.2f} s")
+        finally:
+            os.chdir(cwd)
+    return results
+
+def bench_sweep(worker_counts=None, num_runs=8, steps=500, log=print):
+    """Wall time of a small parameter sweep against the number of worker processes."""
+    if worker_counts is None:
+        worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    param_grid = [{"scenario": scenario, "num_A_agents": 6, "num_B_agents": 6, "step_length_A": 1,
+                   "step_length_B": 1, "sensing_radius_A": 200, "sensing_radius_B": 200}
+                  for scenario in SCENARIOS]
+    results = []
+    for workers in worker_counts:
+        t = time.perf_counter()
+        for _ in run_batch(param_grid, num_runs, steps=steps, max_workers=workers):
+            pass
+        results.append(timing([time.perf_counter() - t], name=f"sweep/workers={workers}", group="sweep",
+                              params={"workers": workers, "jobs": len(param_grid) * num_runs, "steps": steps}))
+        log(f"sweep/workers={workers}: {results[-1]['seconds']:.2f} s")
+    return results
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"date": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+def compare(results, baseline, tolerance=0.2, min_seconds=1e-4):
+    """Compare against the results of a baseline run. A benchmark regressed if it got
+    more than `tolerance` slower (and by more than min_seconds, to ignore noise of tiny
+    timings). Returns a list of (name, baseline seconds, seconds, ratio, regressed)."""
+    baseline = {result["name"]: result for result in baseline["results"] if "seconds" in result}
+    rows = []
+    for result in results["results"]:
+        if "seconds" not in result or result["name"] not in baseline:
+            continue
+        old, new = baseline[result["name"]]["seconds"], result["seconds"]
+        ratio = new / old if old > 0 else float("inf")
+        regressed = ratio > 1 + tolerance and new - old > min_seconds
+        rows.append((result["name"], old, new, ratio, regressed))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulator and compare against a baseline.")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", help="also write the results to this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--quick", action="store_true", help="only small agent counts, one team mix")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=ENGINES)
+    parser.add_argument("--steps", type=int, default=20, help="timed steps per case")
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="time budget per case")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["steps", "plot", "sweep"])
+    args = parser.parse_args(argv)
+
+    results = []
+    if "steps" not in args.skip:
+        if args.quick:
+            results += bench_steps(agent_counts=(12, 100), team_mixes={"1:1": 0.5}, engines=args.engines,
+                                   steps=args.steps, max_seconds=args.max_seconds)
+        else:
+            results += bench_steps(engines=args.engines, steps=args.steps, max_seconds=args.max_seconds)
+    if "plot" not in args.skip:
+        results += bench_plotting()
+    if "sweep" not in args.skip:
+        results += bench_sweep(num_runs=2 if args.quick else 8, steps=200 if args.quick else 500)
+
+    output = {"machine": machine_info(), "results": results}
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(output, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(output, baseline, args.tolerance)
+        regressions = [row for row in rows if row[4]]
+        for name, old, new, ratio, regressed in rows:
+            print(f"{'REGRESSION ' if regressed else ''}{name}: {old*1e3:.3f} ms -> {new*1e3:.3f} ms ({ratio:.2f}x)")
+        print(f"{len(regressions)} of {len(rows)} benchmarks regressed by more than {args.tolerance:.0%}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,8 @@
-import matplotlib.pyplot as plt
-import numpy as np
 from tqdm import tqdm
-import multiprocessing
-import concurrent.futures
 
-from src.simulator import Simulator
-from src.world import World
-from src.plot_agents import plot_movements
-from src.helper_functions import create_agents
-from src.plotting import plot_density, plot_rotated_histogram, plot_separation_index, plot_target_distance
+from src.batch_runner import PARAM_NAMES, make_jobs, run_batch, run_settings
+from src.results_store import ResultsStore
+from src.plotting import plot_separation_index
 
 def plot_sims(sim_results,
               scenario,
@@ -21,82 +15,55 @@ def plot_sims(sim_results,
     # print("save_string:", save_str)
     # print("title: ", title)
 
+    # sim_results are the StoredRuns of the results store
     # plot_density(sim_results, title=f"Density with {title}", name=f"density{save_str}")
     # plot_rotated_histogram(sim_results, title=f"Histogram with {title}", name=f"histogram{save_str}")
     plot_separation_index(sim_results, title=f"Orderliness with {title}", name=f"orderliness{save_str}")
     # plot_target_distance(sim_results, title=f"Target distance with {title}", name=f"target_distance{save_str}")
 
 
-def run_sims(world,
-             num_sims,
-             scenario,
-             num_A_agents, num_B_agents,
-             step_length_A, step_length_B,
-             sensing_radius_A, sensing_radius_B):
-    
-    sim_results = []
-    for _ in range(num_sims):
-        #################
-        # Create agents #
-        #################
-        agents = []
-        agent_radius = 10
-
-        create_agents(world, agents,
-                    'A', num_A_agents, step_length_A, agent_radius, sensing_radius_A)
-
-        create_agents(world, agents,
-                    'B', num_B_agents, step_length_B, agent_radius, sensing_radius_B)
-        
-        ##################
-        # Run simulation #
-        ##################
-        steps = 5000
-
-        sim = Simulator(world,agents,scenario)
-        sim.simulate(steps=steps)
-        sim_results.append(sim)
-
-    plot_sims(sim_results,
-              scenario=scenario,
-              num_A_agents=num_A_agents, num_B_agents=num_B_agents,
-              step_length_A=step_length_A, step_length_B=step_length_B,
-              sensing_radius_A=sensing_radius_A, sensing_radius_B=sensing_radius_B)
-
-    return 1
-
-
 if __name__ == "__main__":
     ####################
     # Create Scenarios #
     ####################
     world_limits = [0,1000]
-    world = World(world_limits)
 
     num_sims = 50
+    steps = 5000
+    # finished runs are stored here, rerunning the script resumes the sweep
+    # and the figures can be regenerated from the store without simulating again
+    store = ResultsStore("results")
 
     scenarios = []
-    scenarios.append((world, num_sims, "a", 6, 6, 1, 1, 200, 200))
-    scenarios.append((world, num_sims, "a", 6, 6, 2, 1, 200, 200))
-    scenarios.append((world, num_sims, "a", 6, 6, 1, 1, 1000, 1000))
-    scenarios.append((world, num_sims, "a", 3, 9, 1, 1, 200, 200))
+    scenarios.append(("a", 6, 6, 1, 1, 200, 200))
+    scenarios.append(("a", 6, 6, 2, 1, 200, 200))
+    scenarios.append(("a", 6, 6, 1, 1, 1000, 1000))
+    scenarios.append(("a", 3, 9, 1, 1, 200, 200))
 
-    scenarios.append((world, num_sims, "b", 6, 6, 1, 1, 200, 200))
-    scenarios.append((world, num_sims, "b", 6, 6, 2, 1, 200, 200))
-    scenarios.append((world, num_sims, "b", 6, 6, 1, 1, 1000, 1000))
-    scenarios.append((world, num_sims, "b", 3, 9, 1, 1, 200, 200))
+    scenarios.append(("b", 6, 6, 1, 1, 200, 200))
+    scenarios.append(("b", 6, 6, 2, 1, 200, 200))
+    scenarios.append(("b", 6, 6, 1, 1, 1000, 1000))
+    scenarios.append(("b", 3, 9, 1, 1, 200, 200))
 
+    param_grid = [dict(zip(PARAM_NAMES, scenario), world_limits=world_limits) for scenario in scenarios]
     print("Created scenarios!")
 
     ############
     # Run sims #
-    ############ 
-    pbar = tqdm(total=len(scenarios))
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = [executor.submit(run_sims, *scenarios[i]) for i in range(len(scenarios))]
-
-        for future in concurrent.futures.as_completed(results):
-            pbar.update(1)
+    ############
+    jobs = make_jobs(param_grid, num_sims)
+    # runs with other settings (e.g. an earlier number of steps) are neither resumed nor plotted
+    settings = run_settings(steps)
+    pbar = tqdm(total=len(jobs), initial=len(store.find(**settings)))
+    for result in run_batch(param_grid, num_sims, steps=steps, store=store):
+        pbar.update(1)
     pbar.close()
 
-    print("All simulations completed!")
\ No newline at end of file
+    print("All simulations completed!")
+
+    ############
+    # Plotting #
+    ############
+    for params in param_grid:
+        params = {name: params[name] for name in PARAM_NAMES}
+        plot_sims(store.runs(**settings, **params), **params)
@@ -1,5 +1,11 @@
 from .agent import Agent
 from .simulator import Simulator
 from .world import World
-from .plot_agents import plot_movements
-from .helper_functions import create_agents
\ No newline at end of file
+from .helper_functions import create_agents
+
+def __getattr__(name):
+    # the plotting code (matplotlib) is only imported when it is used
+    if name == "plot_movements":
+        from .plot_agents import plot_movements
+        return plot_movements
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
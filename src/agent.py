@@ -1,13 +1,28 @@
+import time
 import numpy as np
+from .teams import MODES
+
+# Relative tolerance within which the broadcasted pair search defers to the exact computation
+PAIR_TOLERANCE = 1e-9
 
 class Agent:
     collision = False
+    # Profiler of the Simulator (see profiling.py), None unless profiling is enabled
+    profiler = None
+    # Rule (first team, second team, mode) of the agent's team (see teams.py), None to
+    # position relative to the teams A and B as given by the scenario
+    rule = None
+    # np.random.Generator of the random targets of the agent, None for the global np.random
+    # (a Simulator with a seed gives every agent its own stream)
+    rng = None
     def __init__(self, agent_type, position, step_length=1, 
                  radius=100, sensing_radius=200,
-                 world_size=1000):
+                 world_size=1000, rng=None):
         self.agent_type = agent_type
         self.position = np.array(position)
-        self.target_position = np.random.rand(2) * world_size
+        if rng is not None:
+            self.rng = rng
+        self.target_position = self.random_state().random(2) * world_size
         self.target_distance = np.linalg.norm(self.target_position - self.position)
 
         self.step_length = step_length
@@ -17,7 +32,14 @@ class Agent:
         self.avoidance_direction = 1 if agent_type == 'A' else -1 #np.sign(np.random.rand() - 0.5)
 
     def move(self, other_agents, scenario):
+        profiler = self.profiler
+        if profiler is not None:
+            start = time.perf_counter()
         self.update_target_position(other_agents, scenario)
+        if profiler is not None:
+            now = time.perf_counter()
+            profiler.add_time("target_update", now - start)
+            start = now
         
         """ Move towards a target position if it's not the current position.
         If new position will cause a collision, rotate direction vector (move around)."""
@@ -29,104 +51,73 @@ class Agent:
             for theta in range(0, 330, 30):
                 direction = rotate_vector(direction0, self.avoidance_direction*theta)
                 new_position = self.position + step_length * direction
+                if profiler is not None:
+                    profiler.count("rotation_attempts")
             
                 if not self.will_collide(new_position, other_agents):
                     self.position = new_position
                     break
                 step_length = self.step_length
+        if profiler is not None:
+            profiler.add_time("move", time.perf_counter() - start)
+            profiler.count("moves")
+
+    def random_state(self):
+        return np.random if self.rng is None else self.rng
 
     def update_target_position(self, other_agents, scenario):
         # Find a target position for the agent by locating the nearest opposite type agent.
+        profiler = self.profiler
+        if profiler is not None:
+            start = time.perf_counter()
+        first_team, second_team = 'A', 'B'
+        if self.rule is not None:
+            first_team, second_team, mode = self.rule
+            scenario = MODES[mode]
         A_list = []
         B_list = []
         target_position = self.target_position
-        closest_point = float('inf') * np.ones(2)
-        offset = 4*self.radius # some extra offset to ensure we are not too close to A or B
-        """Find all agents of type A and B.
+        """Find all agents of type A and B (the first and second team of our rule).
         We have included a perception radius too."""
         for other in other_agents:
             if self.sensing_radius == 0 or np.linalg.norm(self.position - other.position) < self.sensing_radius:
-                if other.agent_type == 'A':
+                if other.agent_type == first_team:
                     A_list.append(other)
-                elif other.agent_type == 'B':
+                elif other.agent_type == second_team:
                     B_list.append(other)
         
         other_agents = A_list + B_list
+        if profiler is not None:
+            profiler.add_time("target_update/neighbors", time.perf_counter() - start)
 
         
         if (A_list == [] or B_list == []) and np.linalg.norm(self.target_position - self.position) < self.step_length:
-            target_position = np.random.rand(2) * (self.world_size-4*self.radius) + 2*self.radius
+            target_position = self.random_state().random(2) * (self.world_size-4*self.radius) + 2*self.radius
+            if profiler is not None:
+                profiler.count("random_targets")
         elif A_list != [] and B_list != []:
             """Find the closest point between A and B.
             First check projection of A and B, if this point
             is outside AB, then find the closest point is either
-            A or B (minus 2*radius)."""
-            dist_to_target = float('inf')
-            valid_target = False
-            for agent_A in A_list:
-                for agent_B in B_list:
-                    if dist_to_target > 0:
-                        A = agent_A.position
-                        B = agent_B.position
-                        C = self.position
-                        AB = B - A
-                        AC = C - A
-                        BC = C - B
-                        proj_scalar = np.dot(AC, AB) / np.dot(AB, AB)
-                        D = A + proj_scalar * AB
-
-                        if scenario == 'a':
-                            if np.linalg.norm(AB) > 4*self.radius:
-                                # Check if the projection scalar is between 0 and 1
-                                if 0 <= proj_scalar <= 1:
-                                    closest_point = D
-                                else:
-                                    # Determine if A or B is closer to C
-                                    if np.linalg.norm(AC) < np.linalg.norm(BC):
-                                        closest_point = A + offset * AB/np.linalg.norm(AB)
-                                    else:
-                                        closest_point = B + offset * -AB/np.linalg.norm(AB)
-
-                        elif scenario == 'b':
-                            # The agent can either place itself so that B is between A and yourself (this is colsest_point_0),
-                            # or so that B is between A and a target agent (this is closest_point).
-                            # Choose the closest of these two points.
-                            # if self.agent_type == 'A':
-                            #     # ensure that B is inbetween self and A
-                            #     # so take the vector AB, be sure that target_position is on this line, but extend it slightly to 
-                            #     # ensure we are further than B is on this line
-                            #     closest_point_0 = B + (2*self.radius+offset) * AB/np.linalg.norm(AB)             
-                            # elif self.agent_type == 'B':
-                            #     # ensure that A is inbetween self and B
-                            #     closest_point_0 = A + (2*self.radius+offset) * -AB/np.linalg.norm(AB)
-                            # else:
-                            #     closest_point_0 = closest_point
-
-                            # Check if the projection scalar is outside A and B
-                            if proj_scalar > 1:
-                                closest_point = D
-                            else:
-                                # ensure that B is inbetween self and A
-                                # so take the vector AB, be sure that target_position is on this line, but extend it slightly to 
-                                # ensure we are further than B is on this line
-                                closest_point = B + offset * AB/np.linalg.norm(AB)
-                            
-                            # if np.linalg.norm(closest_point_0 - self.position) < np.linalg.norm(closest_point - self.position):
-                            #     closest_point = closest_point_0
-
-                        if np.linalg.norm(closest_point - self.position) < 1e-1 * self.step_length:
-                            dist_to_target = 0
-                            target_position = self.position
-                            valid_target = True                         
-                            
-                        elif np.linalg.norm(closest_point - self.position) < dist_to_target and not self.will_collide(closest_point, other_agents):
-                            dist_to_target = np.linalg.norm(closest_point - self.position)
-                            target_position = closest_point
-                            valid_target = True
-                            
+            A or B (minus 2*radius).
+            All (A, B) pairs are evaluated at once, see closest_pair_target."""
+            if profiler is not None:
+                start = time.perf_counter()
+            target_position, valid_target = self.closest_pair_target(A_list, B_list, other_agents, scenario)
+            if profiler is not None:
+                profiler.add_time("target_update/pair_search", time.perf_counter() - start)
+                profiler.count("pairs_evaluated", len(A_list) * len(B_list))
+                if not valid_target:
+                    profiler.count("random_targets")
+                random_start = None if valid_target else time.perf_counter()
+
             while not valid_target:
-                target_position = np.random.rand(2) * (self.world_size-4*self.radius) + 2*self.radius
+                target_position = self.random_state().random(2) * (self.world_size-4*self.radius) + 2*self.radius
                 valid_target = not self.will_collide(target_position, other_agents)
+                if profiler is not None and not valid_target:
+                    profiler.count("random_target_rejections")
+            if profiler is not None and random_start is not None:
+                profiler.add_time("target_update/random_target", time.perf_counter() - random_start)
 
         # Ensure that the target position is within the world boundaries
         target_position[0] = max(target_position[0], self.radius*1.1)
@@ -139,7 +130,52 @@ class Agent:
         # Update the target distance
         self.target_distance = np.linalg.norm(self.target_position - self.position)
 
+    def closest_pair_target(self, A_list, B_list, other_agents, scenario):
+        """Return the closest target w.r.t. all pairs (A, B) that does not cause a collision.
+
+        The candidates of all pairs are computed with one broadcasted array operation,
+        then only the shortlist of best candidates is recomputed with pair_closest_point
+        (so the result is exactly the one of looping over all pairs in order) and
+        collision checked. Returns (target_position, valid_target)."""
+        C = self.position
+        A = np.array([agent.position for agent in A_list])
+        B = np.array([agent.position for agent in B_list])
+        points, dist, uncertain = pair_closest_points(A, B, C, self.radius, scenario)
+
+        # pairs close to a branch of the case distinction are always computed exactly
+        exact = {}
+        def evaluate(k):
+            if k not in exact:
+                point = pair_closest_point(A[k // len(B)], B[k % len(B)], C, self.radius, scenario)
+                exact[k] = (point, np.inf if point is None else np.linalg.norm(point - C))
+            return exact[k]
+        for k in np.flatnonzero(uncertain):
+            dist[k] = evaluate(k)[1]
+
+        # if any candidate is (almost) our own position we stay where we are
+        for k in np.flatnonzero((dist < 1e-1 * self.step_length * (1 + PAIR_TOLERANCE)) | uncertain):
+            if evaluate(k)[1] < 1e-1 * self.step_length:
+                return self.position, True
+
+        # go through the candidates from close to far, in groups of (numerically) equal distance
+        order = np.argsort(dist, kind='stable')
+        sorted_dist = dist[order]
+        start = 0
+        while start < len(order) and np.isfinite(sorted_dist[start]):
+            end = np.searchsorted(sorted_dist, sorted_dist[start] * (1 + PAIR_TOLERANCE), side='right')
+            target_position, dist_to_target = None, float('inf')
+            for k in np.sort(order[start:end]):
+                point, point_dist = evaluate(k)
+                if point_dist < dist_to_target and not self.will_collide(point, other_agents):
+                    target_position, dist_to_target = point, point_dist
+            if target_position is not None:
+                return target_position, True
+            start = end
+        return self.target_position, False
+
     def will_collide(self, new_position, other_agents):
+        if self.profiler is not None:
+            self.profiler.count("collision_checks")
         if new_position[0] < self.radius or new_position[0] > self.world_size-self.radius or new_position[1] < self.radius or new_position[1] > self.world_size-self.radius:
             return True
         for other in other_agents:
@@ -149,6 +185,73 @@ class Agent:
                     return True
         return False
 
+def pair_closest_point(A, B, C, radius, scenario):
+    """Closest target point for an agent at C w.r.t. the pair (A, B), or None if the pair is not valid."""
+    offset = 4*radius # some extra offset to ensure we are not too close to A or B
+    AB = B - A
+    AC = C - A
+    BC = C - B
+    proj_scalar = np.dot(AC, AB) / np.dot(AB, AB)
+    D = A + proj_scalar * AB
+
+    if scenario == 'a':
+        if np.linalg.norm(AB) > 4*radius:
+            # Check if the projection scalar is between 0 and 1
+            if 0 <= proj_scalar <= 1:
+                return D
+            # Determine if A or B is closer to C
+            if np.linalg.norm(AC) < np.linalg.norm(BC):
+                return A + offset * AB/np.linalg.norm(AB)
+            return B + offset * -AB/np.linalg.norm(AB)
+
+    elif scenario == 'b':
+        # Check if the projection scalar is outside A and B
+        if proj_scalar > 1:
+            return D
+        # ensure that B is inbetween self and A
+        # so take the vector AB, be sure that target_position is on this line, but extend it slightly to 
+        # ensure we are further than B is on this line
+        return B + offset * AB/np.linalg.norm(AB)
+    return None
+
+def pair_closest_points(A, B, C, radius, scenario):
+    """Broadcasted version of pair_closest_point for positions A (nA, 2) and B (nB, 2).
+
+    Returns the candidates (nA*nB, 2) and their distance to C (nA*nB,) in A-major order,
+    invalid pairs get an infinite distance. Pairs that are within PAIR_TOLERANCE of a
+    branch of the case distinction are flagged as uncertain."""
+    A = A[:, None, :]
+    B = B[None, :, :]
+    offset = 4*radius
+    AB = B - A
+    AC = C - A
+    BC = C - B
+    norm_AB = np.sqrt(np.sum(AB * AB, axis=-1))
+    proj_scalar = np.sum(AC * AB, axis=-1) / np.sum(AB * AB, axis=-1)
+    D = A + proj_scalar[..., None] * AB
+    unit_AB = AB / norm_AB[..., None]
+
+    if scenario == 'a':
+        norm_AC = np.sqrt(np.sum(AC * AC, axis=-1))
+        norm_BC = np.sqrt(np.sum(BC * BC, axis=-1))
+        inside = (0 <= proj_scalar) & (proj_scalar <= 1)
+        outside = np.where((norm_AC < norm_BC)[..., None], A + offset * unit_AB, B - offset * unit_AB)
+        points = np.where(inside[..., None], D, outside)
+        valid = norm_AB > 4*radius
+        uncertain = (np.abs(norm_AB - 4*radius) <= PAIR_TOLERANCE * 4*radius) \
+            | (np.abs(proj_scalar) <= PAIR_TOLERANCE) | (np.abs(proj_scalar - 1) <= PAIR_TOLERANCE) \
+            | (np.abs(norm_AC - norm_BC) <= PAIR_TOLERANCE * np.maximum(norm_AC, norm_BC))
+    elif scenario == 'b':
+        points = np.where((proj_scalar > 1)[..., None], D, B + offset * unit_AB)
+        valid = np.ones(proj_scalar.shape, dtype=bool)
+        uncertain = np.abs(proj_scalar - 1) <= PAIR_TOLERANCE
+    else:
+        raise ValueError(f"Unknown scenario {scenario}")
+
+    dist = np.sqrt(np.sum((points - C) ** 2, axis=-1))
+    dist = np.where(valid, dist, np.inf)
+    return points.reshape(-1, 2), dist.ravel(), uncertain.ravel()
+
 def rotate_vector(vector, angle):
     """Rotate a 2D vector by a given angle."""
     angle = np.radians(angle)
@@ -0,0 +1,306 @@
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import zlib
+import numpy as np
+
+from .simulator import Simulator
+from .convergence import ConvergenceDetector, BatchedConvergenceDetector
+from .batched import BatchedSimulator
+from .world import World
+from .metrics import SeparationIndexObserver, IntraTeamDistanceObserver, MeanTargetDistanceObserver
+from .helper_functions import create_agents, get_density
+from .results_store import run_arrays
+from .placement import place_team
+
+# Parameters of one configuration, in the order used for the save strings in main.py
+PARAM_NAMES = ("scenario", "num_A_agents", "num_B_agents",
+               "step_length_A", "step_length_B", "sensing_radius_A", "sensing_radius_B")
+DEFAULT_PARAMS = {"agent_radius": 10, "world_limits": (0, 1000)}
+
+def expand_grid(param_grid):
+    """A parameter grid is either a list of parameter dicts, or a dict of lists
+    of which the cartesian product is taken."""
+    if isinstance(param_grid, dict):
+        names = list(param_grid)
+        return [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+    return [dict(params) for params in param_grid]
+
+def param_key(params):
+    """String that identifies a configuration, e.g. 'a_6_6_1_1_200_200_5d1c2e4b'. The short
+    hash covers all other parameters (world_limits, agent_radius, placement, ...), missing
+    ones are taken from DEFAULT_PARAMS, so every parameter that changes a run changes the key."""
+    params = {**DEFAULT_PARAMS, **params}
+    key = "_".join(str(params[name]) for name in PARAM_NAMES)
+    rest = {name: value for name, value in params.items() if name not in PARAM_NAMES}
+    text = json.dumps(rest, sort_keys=True)
+    return key + "_" + hashlib.sha256(text.encode()).hexdigest()[:8]
+
+def run_settings(steps=5000, engine="python", convergence=None, batched=False):
+    """The settings of a run besides its configuration, as recorded in its summary and the
+    manifest of a ResultsStore. Batched runs have the engine "batched"."""
+    return {"steps": steps, "engine": "batched" if batched else engine, "convergence": convergence}
+
+def settings_key(settings):
+    """Short hash of run_settings, runs of a configuration with other settings are other runs."""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:8]
+
+def job_seed(params, run, base_seed=0):
+    """Reproducible seed of one run, it only depends on the configuration (all parameters,
+    see param_key) and the run index (so adding configurations to a sweep does not change
+    the seeds of the others)."""
+    key = zlib.crc32(param_key(params).encode())
+    return int(np.random.SeedSequence([base_seed, key, run]).generate_state(1)[0])
+
+def make_jobs(param_grid, num_runs, base_seed=0, first_run=0):
+    """One job per (configuration, run), for the runs first_run, ..., first_run + num_runs - 1."""
+    jobs = []
+    for params in expand_grid(param_grid):
+        params = {**DEFAULT_PARAMS, **params}
+        for run in range(first_run, first_run + num_runs):
+            jobs.append({"key": param_key(params), "run": run,
+                         "seed": job_seed(params, run, base_seed), "params": params})
+    return jobs
+
+def run_job(job, steps=5000, engine="python", convergence=None, store=None, save_trajectory=False,
+            cache=None, profile=False):
+    """Run one simulation and return its summary metrics (not the Simulator).
+    convergence is None or a dict of ConvergenceDetector arguments to stop runs early.
+    With a ResultsStore the arrays of the run are written to it (the trajectory only
+    with save_trajectory) and the summary gets the path of the run. With a
+    SimulationCache, runs that were computed before are not simulated again. With profile
+    the summary gets the profile of the run (see Profiler.to_dict)."""
+    params = job["params"]
+    settings = run_settings(steps, engine, convergence)
+    if cache is not None:
+        key = cache.key(params=params, seed=job["seed"], steps=steps, engine=engine, convergence=convergence)
+        arrays = cache.get(key)
+        if arrays is not None and (not save_trajectory or "position" in arrays):
+            summary = {**json.loads(str(arrays.pop("summary"))), **settings_summary(settings)}
+            if store is not None:
+                summary["path"] = store.save_arrays(run_name(job, settings), job["seed"], arrays)
+            return summary
+
+    world, agents = job_agents(job)
+
+    # the metrics are computed during the run, no history is stored unless we save it
+    observers = [SeparationIndexObserver(), IntraTeamDistanceObserver(), MeanTargetDistanceObserver()]
+    sim = Simulator(world, agents, params["scenario"], engine=engine,
+                    observers=observers, record_history=save_trajectory, profile=profile)
+    sim.simulate(steps=steps, convergence=ConvergenceDetector(**convergence) if convergence is not None else None)
+    summary = summarize(sim, job, settings)
+    if profile:
+        summary["profile"] = sim.profiler.to_dict()
+    if store is not None or cache is not None:
+        arrays = run_arrays(sim, save_trajectory)
+    if cache is not None:
+        cache.put(key, {**arrays, "summary": np.array(json.dumps(summary))})
+    if store is not None:
+        summary["path"] = store.save_arrays(run_name(job, settings), job["seed"], arrays)
+    return summary
+
+def run_name(job, settings):
+    # the runs of a configuration with other settings are stored next to each other
+    return f"{job['key']}_{settings_key(settings)}"
+
+def job_agents(job):
+    """World and agents of a job. Seeds np.random with the seed of the job, the random
+    targets of the run are drawn from the np.random state after this."""
+    params = job["params"]
+    np.random.seed(job["seed"])
+    world = World(list(params["world_limits"]))
+    positions_A, positions_B = initial_positions(world, params, job["seed"])
+    agents = []
+    create_agents(world, agents, 'A', params["num_A_agents"], params["step_length_A"],
+                  params["agent_radius"], params["sensing_radius_A"], positions=positions_A)
+    create_agents(world, agents, 'B', params["num_B_agents"], params["step_length_B"],
+                  params["agent_radius"], params["sensing_radius_B"], positions=positions_B)
+    return world, agents
+
+def batch_layout(params):
+    # jobs with the same layout can be simulated in one BatchedSimulator
+    return (params["scenario"], params["num_A_agents"], params["num_B_agents"],
+            params["agent_radius"], tuple(params["world_limits"]))
+
+def run_batched_jobs(jobs, steps=5000, convergence=None, store=None, save_trajectory=False, cache=None):
+    """Run jobs with the same batch_layout in one BatchedSimulator, all runs are advanced
+    in one array pass per step. Returns the summaries of run_job, the trajectories are the
+    same as those of run_job with the vectorized engine (the metrics equal up to rounding)."""
+    summaries = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    settings = run_settings(steps, convergence=convergence, batched=True)
+    todo = []
+    for n, job in enumerate(jobs):
+        if cache is not None:
+            keys[n] = cache.key(params=job["params"], seed=job["seed"], steps=steps, engine="batched",
+                                convergence=convergence)
+            arrays = cache.get(keys[n])
+            if arrays is not None and (not save_trajectory or "position" in arrays):
+                summaries[n] = {**json.loads(str(arrays.pop("summary"))), **settings_summary(settings)}
+                if store is not None:
+                    summaries[n]["path"] = store.save_arrays(run_name(job, settings), job["seed"], arrays)
+                continue
+        todo.append(n)
+    if not todo:
+        return summaries
+
+    runs, random_states = [], []
+    for n in todo:
+        world, agents = job_agents(jobs[n])
+        runs.append(agents)
+        # every run continues with its own copy of the np.random state, as in run_job
+        random_state = np.random.RandomState()
+        random_state.set_state(np.random.get_state())
+        random_states.append(random_state)
+    sim = BatchedSimulator(world, runs, jobs[todo[0]]["params"]["scenario"], random_states,
+                           record_history=save_trajectory)
+    sim.simulate(steps, convergence=BatchedConvergenceDetector(len(runs), **convergence)
+                 if convergence is not None else None)
+
+    for r, n in enumerate(todo):
+        run = sim.run(r)
+        summaries[n] = summarize(run, jobs[n], settings)
+        if store is not None or cache is not None:
+            arrays = run_arrays(run, save_trajectory)
+        if cache is not None:
+            cache.put(keys[n], {**arrays, "summary": np.array(json.dumps(summaries[n]))})
+        if store is not None:
+            summaries[n]["path"] = store.save_arrays(run_name(jobs[n], settings), jobs[n]["seed"], arrays)
+    return summaries
+
+def initial_positions(world, params, seed):
+    """Positions of team A and B from the optional "placement" parameter (None if not
+    given, then create_agents places them). The placement is a spec of place_team for
+    both teams, or a dict with a spec per team, e.g. {"A": "poisson_disk", "B": {...}}."""
+    placement = params.get("placement")
+    if placement is None:
+        return None, None
+    if not (isinstance(placement, dict) and "A" in placement):
+        placement = {"A": placement, "B": placement}
+    rng = np.random.default_rng(seed)
+    positions_A = place_team(world, placement["A"], params["num_A_agents"], params["agent_radius"], seed=rng)
+    positions_B = place_team(world, placement["B"], params["num_B_agents"], params["agent_radius"], seed=rng,
+                             existing=positions_A)
+    return positions_A, positions_B
+
+def settings_summary(settings):
+    # the requested settings of a run (its "steps" is the number of steps it actually took)
+    return {"settings": settings, "settings_key": settings_key(settings)}
+
+def summarize(sim, job, settings):
+    """Final metrics plus the per-step series used by the plots, as plain python types.
+    settings are the run_settings of the run."""
+    orderliness = sim.metrics["orderliness"].series()[1]
+    intra_team_distance = sim.metrics["intra_team_distance"].series()[1]
+    target_distance_A, target_distance_B = sim.metrics["target_distance"].series()[1].T
+    mean_pos_A, mean_pos_B = get_density(sim)
+    return {
+        "key": job["key"], "run": job["run"], "seed": job["seed"],
+        "params": {name: (list(value) if isinstance(value, tuple) else value) for name, value in job["params"].items()},
+        "steps": sim.step_count,
+        "converged_step": sim.converged_step,
+        **settings_summary(settings),
+        "final_orderliness": float(orderliness[-1]),
+        "final_intra_team_distance": float(intra_team_distance[-1]),
+        "final_target_distance_A": float(target_distance_A[-1]),
+        "final_target_distance_B": float(target_distance_B[-1]),
+        "mean_pos_A": mean_pos_A.tolist(),
+        "mean_pos_B": mean_pos_B.tolist(),
+        "orderliness": orderliness.tolist(),
+        "intra_team_distance": intra_team_distance.tolist(),
+        "target_distance_A": target_distance_A.tolist(),
+        "target_distance_B": target_distance_B.tolist(),
+    }
+
+# The per-step series of a summary (not written to the manifest of a ResultsStore)
+SERIES_NAMES = ("orderliness", "intra_team_distance", "target_distance_A", "target_distance_B")
+
+def run_jobs(jobs, steps=5000, engine="python", convergence=None, store=None, save_trajectory=False,
+             cache=None, profile=False):
+    # One chunk of jobs, executed in a worker process
+    return [run_job(job, steps=steps, engine=engine, convergence=convergence, store=store,
+                    save_trajectory=save_trajectory, cache=cache, profile=profile) for job in jobs]
+
+def load_results(results_file):
+    """Read the summaries of all finished jobs from a results file (one json per line).
+    A truncated last line (from a crash while writing) is ignored."""
+    results = []
+    if results_file is None or not os.path.exists(results_file):
+        return results
+    with open(results_file) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return results
+
+def run_batch(param_grid, num_runs, steps=5000, base_seed=0, engine="python",
+              max_workers=None, chunksize=None, results_file=None, convergence=None,
+              store=None, save_trajectory=False, cache=None, profile=False, batched=False, first_run=0):
+    """Run num_runs simulations of every configuration in param_grid on a process pool.
+
+    Every (configuration, run) is a separate job with its own seed, jobs are sent to the
+    workers in chunks. The summaries are yielded as soon as their chunk finishes. If a
+    results_file is given, every summary is appended to it and jobs that are already in
+    the file with the same run_settings (steps, engine, convergence, batched) are
+    skipped, so an interrupted sweep can be resumed. With convergence
+    (ConvergenceDetector arguments) runs stop early once they converged.
+    With a ResultsStore, the arrays of every run are saved in the store and runs that
+    are already in its manifest are skipped as well. With a SimulationCache, runs that
+    were computed before (e.g. in another sweep) are taken from the cache. With profile
+    every summary has the profile of its run, combine them with aggregate_profiles.
+    With batched, the runs of a chunk are simulated together in a BatchedSimulator (see
+    run_batched_jobs), the chunks are formed per batch_layout and engine is not used (the
+    runs follow the vectorized engine, whose trajectories differ from the default python one).
+    first_run is the index of the first run, to add more runs to an earlier batch."""
+    jobs = make_jobs(param_grid, num_runs, base_seed, first_run)
+    settings = settings_key(run_settings(steps, engine, convergence, batched))
+    finished = load_results(results_file) + (store.entries() if store is not None else [])
+    # runs of earlier versions without settings are done again
+    done = {(result["key"], result["run"], result["seed"], result.get("settings_key")) for result in finished}
+    jobs = [job for job in jobs if (job["key"], job["run"], job["seed"], settings) not in done]
+    if not jobs:
+        return
+
+    max_workers = max_workers or os.cpu_count()
+    if batched:
+        if profile:
+            raise ValueError("Batched runs can not be profiled individually")
+        groups = {}
+        for job in jobs:
+            groups.setdefault(batch_layout(job["params"]), []).append(job)
+        chunks = []
+        for group in groups.values():
+            # as few batches as possible, but at least one per worker
+            size = chunksize or -(-len(group) // max_workers)
+            chunks += [group[i:i+size] for i in range(0, len(group), size)]
+    else:
+        if chunksize is None:
+            # a few chunks per worker to balance slow and fast configurations
+            chunksize = max(1, len(jobs) // (4 * max_workers))
+        chunks = [jobs[i:i+chunksize] for i in range(0, len(jobs), chunksize)]
+
+    out = open(results_file, "a") if results_file is not None else None
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            if batched:
+                futures = [executor.submit(run_batched_jobs, chunk, steps, convergence, store, save_trajectory, cache)
+                           for chunk in chunks]
+            else:
+                futures = [executor.submit(run_jobs, chunk, steps, engine, convergence, store, save_trajectory,
+                                           cache, profile)
+                           for chunk in chunks]
+            for future in concurrent.futures.as_completed(futures):
+                for result in future.result():
+                    if store is not None:
+                        store.add({name: value for name, value in result.items() if name not in SERIES_NAMES})
+                    if out is not None:
+                        out.write(json.dumps(result) + "\n")
+                        out.flush()
+                    yield result
+    finally:
+        if out is not None:
+            out.close()
@@ -0,0 +1,187 @@
+import numpy as np
+
+from .engine import VectorizedEngine
+from .history import TrajectoryHistory
+from .metrics import MetricObserver
+from .helper_functions import separation_index_series, mean_target_distance_series
+
+class BatchedEngine(VectorizedEngine):
+    """VectorizedEngine for R independent runs of N agents each.
+
+    The runs are stored one after another in the flat state arrays (R*N rows), agents
+    only sense and collide with the agents of their own run. The target search of all
+    runs is a single pass of the VectorizedEngine pair search, and the sequential moves
+    are done for agent k of all runs at once (N array passes per step instead of R*N
+    single agent moves). Random targets of run r are drawn from random_states[r] in agent
+    order, so every run gives exactly the trajectory of a VectorizedEngine whose
+    np.random state was random_states[r]. Runs with running[r] False are not stepped."""
+    def __init__(self, runs, scenario="a", random_states=None, team_rules=None):
+        self.num_runs = len(runs)
+        self.run_size = len(runs[0]) if runs else 0
+        if any(len(agents) != self.run_size for agents in runs):
+            raise ValueError("All runs of a batch need the same number of agents")
+        super().__init__([agent for agents in runs for agent in agents], scenario, team_rules=team_rules)
+        # all neighbor queries are within one small run, no spatial index
+        self.dense = True
+        if random_states is None:
+            random_states = [np.random.RandomState(seed) for seed in range(self.num_runs)]
+        self.random_states = random_states
+        self.running = np.ones(self.num_runs, dtype=bool)
+
+    @property
+    def runs_position(self):
+        # positions of all runs, (R, N, 2) view on the flat array
+        return self.position.reshape(self.num_runs, self.run_size, 2)
+
+    @property
+    def runs_target_distance(self):
+        return self.target_distance.reshape(self.num_runs, self.run_size)
+
+    def step(self):
+        """Advance all running runs by one simulation step."""
+        active = None if self.running.all() else np.repeat(self.running, self.run_size)
+        self.timed("target_update", self.update_target_positions, active)
+        self.timed("move", self.move_agents)
+
+    def move_agents(self, order=None):
+        # agent k of all running runs at once, these never interact
+        first = np.flatnonzero(self.running) * self.run_size
+        for k in (range(self.run_size) if order is None else order):
+            self.move_synchronous(first + k)
+
+    def move_neighbors(self, idx):
+        # the other agents of the run of every agent in idx
+        neighbors = (idx - idx % self.run_size)[:, None] + np.arange(self.run_size)
+        neighbors[neighbors == idx[:, None]] = -1
+        return neighbors
+
+    def move_conflicts(self, idx, proposal):
+        # the agents moved at once are all in different runs
+        return np.zeros(len(idx), dtype=bool)
+
+    def sensed_pairs(self):
+        """All pairs (i, j) of agents of the same run where agent i senses agent j."""
+        R, N = self.num_runs, self.run_size
+        position = self.runs_position
+        dx = position[:, :, None, 0] - position[:, None, :, 0]
+        dy = position[:, :, None, 1] - position[:, None, :, 1]
+        dist = np.sqrt(dx * dx + dy * dy)
+        sensing_radius = self.sensing_radius.reshape(R, N, 1)
+        sensed = (sensing_radius == 0) | (dist < sensing_radius)
+        sensed[:, np.arange(N), np.arange(N)] = False
+        r, i, j = np.nonzero(sensed)
+        return r * N + i, r * N + j
+
+    def sensed_others(self, i):
+        others = i - i % self.run_size + np.arange(self.run_size)
+        if self.sensing_radius[i] != 0:
+            dx = self.position[i, 0] - self.position[others, 0]
+            dy = self.position[i, 1] - self.position[others, 1]
+            others = others[np.sqrt(dx * dx + dy * dy) < self.sensing_radius[i]]
+        relevant = (self.team[others] == self.first_team[i]) | (self.team[others] == self.second_team[i])
+        return others[(others != i) & relevant]
+
+    def apply_random_targets(self, target_position, needs_random, has_both):
+        # random targets are drawn from the state of the run, in agent order
+        for i in np.flatnonzero(needs_random):
+            random_state = self.random_states[i // self.run_size]
+            if has_both[i]:
+                target_position[i] = self.random_free_target(i, self.sensed_others(i), random_state)
+            else:
+                target_position[i] = random_state.random(2) * (self.world_size[i] - 4*self.radius[i]) + 2*self.radius[i]
+
+class RecordedMetric(MetricObserver):
+    # The series of one metric of one run of a BatchedSimulator
+    def __init__(self, name, values):
+        super().__init__()
+        self.name = name
+        self.steps = list(range(1, len(values) + 1))
+        self.values = list(values)
+
+class BatchedSimulator:
+    """Many independent simulations of the same world and scenario, stepped together.
+
+    runs is a list of R agent lists with the same team layout (same number of agents of
+    every team), the parameters of the agents (step lengths, sensing radii, positions)
+    can differ between runs. random_states are the np.random.RandomState of the runs
+    (used for the random targets). After every step the separation index, intra team
+    distance and mean target distances of all runs are computed at once. With a
+    BatchedConvergenceDetector, runs that converged are masked and no longer stepped.
+    run(r) gives run r with the attributes of a Simulator (metrics, history, ...)."""
+    def __init__(self, world, runs, scenario="a", random_states=None, record_history=False, team_rules=None):
+        self.world = world
+        self.scenario = scenario
+        self.runs = runs
+        self.engine = BatchedEngine(runs, scenario, random_states, team_rules)
+        self.num_runs, self.num_agents = self.engine.num_runs, self.engine.run_size
+        agent_types = self.engine.agent_type.reshape(self.num_runs, self.num_agents)
+        if not (agent_types == agent_types[:1]).all():
+            raise ValueError("All runs of a batch need the same team layout")
+        self.agent_types = agent_types[0] if self.num_runs > 0 else np.empty(0, dtype=str)
+        self.step_count = np.zeros(self.num_runs, dtype=int)
+        self.converged_step = [None] * self.num_runs
+        # per step (position, target_position, target_distance) of all runs
+        self.history = [] if record_history else None
+        self.series = {"orderliness": [], "intra_team_distance": [], "target_distance": []}
+
+    def update(self):
+        # One step of all running runs, then the metrics of all runs
+        self.engine.step()
+        self.step_count[self.engine.running] += 1
+        position = self.engine.runs_position
+        orderliness, intra_team_distance = separation_index_series(position, self.agent_types)
+        self.series["orderliness"].append(orderliness)
+        self.series["intra_team_distance"].append(intra_team_distance)
+        self.series["target_distance"].append(
+            mean_target_distance_series(self.engine.runs_target_distance, self.agent_types))
+        if self.history is not None:
+            self.history.append((position.copy(), self.engine.target_position.reshape(position.shape).copy(),
+                                 self.engine.runs_target_distance.copy()))
+
+    def simulate(self, steps, convergence=None):
+        # Run all runs for steps steps, or until they converged (with a BatchedConvergenceDetector)
+        for _ in range(steps):
+            if not self.engine.running.any():
+                break
+            self.update()
+            if convergence is not None:
+                converged = convergence.update(self.engine.runs_position, self.engine.runs_target_distance,
+                                               self.series["orderliness"][-1]) & self.engine.running
+                for r in np.flatnonzero(converged):
+                    self.converged_step[r] = int(self.step_count[r])
+                self.engine.running &= ~converged
+        self.engine.sync_agents()
+
+    def run(self, r):
+        return BatchedRun(self, r)
+
+class BatchedRun:
+    """Run r of a BatchedSimulator, with the attributes of a Simulator that are used by
+    summarize, run_arrays and the plotting functions."""
+    def __init__(self, sim, r):
+        self.sim = sim
+        self.r = r
+        self.world = sim.world
+        self.scenario = sim.scenario
+        self.agents = sim.runs[r]
+        self.agent_types = sim.agent_types
+        self.step_count = int(sim.step_count[r])
+        self.converged_step = sim.converged_step[r]
+        self.metrics = {name: RecordedMetric(name, [value[r] for value in values[:self.step_count]])
+                        for name, values in sim.series.items()}
+        self.history = None
+        if sim.history is not None:
+            position, target_position, target_distance = (
+                np.array([state[k][r] for state in sim.history[:self.step_count]]) for k in range(3))
+            self.history = TrajectoryHistory.from_arrays(
+                self.agent_types, np.array([agent.step_length for agent in self.agents], dtype=float),
+                np.array([agent.radius for agent in self.agents], dtype=float),
+                np.array([agent.sensing_radius for agent in self.agents], dtype=float),
+                position.reshape(-1, sim.num_agents, 2), target_position.reshape(-1, sim.num_agents, 2),
+                target_distance.reshape(-1, sim.num_agents))
+
+    def get_positions(self):
+        return self.sim.engine.runs_position[self.r]
+
+    def get_target_distances(self):
+        return self.sim.engine.runs_target_distance[self.r]
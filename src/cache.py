@@ -0,0 +1,124 @@
+import glob
+import hashlib
+import json
+import os
+import zipfile
+import numpy as np
+
+from .simulator import Simulator
+from .helper_functions import create_agents
+from .results_store import RunArrays, run_arrays
+
+_code_version = None
+
+def code_version():
+    """Hash of the source code of the simulator package, part of every cache key so
+    that results computed with older code are never returned."""
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        _code_version = digest.hexdigest()[:16]
+    return _code_version
+
+def _jsonable(value):
+    # numpy values (e.g. per-agent step lengths) in a cache key
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Can not use {type(value)} in a cache key")
+
+class SimulationCache:
+    """Content-addressed on-disk cache of simulation results.
+
+    The key is a hash of everything that determines a run (world bounds, agent specs,
+    scenario, steps, seed, ... and the code version), the value is a dict of arrays
+    stored as one .npz file. The total size is bounded, the least recently used
+    entries are evicted first (a hit updates the modification time of its file).
+    Writes are atomic, so the cache can be shared by the workers of a process pool."""
+    def __init__(self, root, max_bytes=2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, **spec):
+        spec = {**spec, "code_version": code_version()}
+        text = json.dumps(spec, sort_keys=True, default=_jsonable)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        """The cached arrays of key, or None."""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp{os.getpid()}.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        files = []
+        for path in glob.glob(os.path.join(self.root, "*", "*.npz")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class CachedRun(RunArrays):
+    """A run loaded from the cache, used like a Simulator by the plotting functions."""
+    def __init__(self, params, arrays):
+        super().__init__(params)
+        self.arrays = arrays
+
+    def has(self, name):
+        return name in self.arrays
+
+    def array(self, name):
+        return self.arrays[name]
+
+def simulate_cached(cache, world, agent_specs, scenario, steps, seed, engine="python"):
+    """Create the agents and simulate, or return the cached result of the same run.
+
+    agent_specs is a list of create_agents arguments (agent_type, num_agents,
+    step_length, agent_radius, sensing_radius). Returns the Simulator on a miss and a
+    CachedRun (with the full trajectory) on a hit."""
+    key = cache.key(bounds=list(world.x_lim), agents=[list(spec) for spec in agent_specs],
+                    scenario=scenario, steps=steps, seed=seed, engine=engine)
+    arrays = cache.get(key)
+    if arrays is not None:
+        return CachedRun({"scenario": scenario, "world_limits": list(world.x_lim)}, arrays)
+
+    np.random.seed(seed)
+    agents = []
+    for spec in agent_specs:
+        create_agents(world, agents, *spec)
+    sim = Simulator(world, agents, scenario, engine=engine)
+    sim.simulate(steps=steps)
+    cache.put(key, run_arrays(sim, save_trajectory=True))
+    return sim
@@ -0,0 +1,84 @@
+import argparse
+import sys
+from collections import defaultdict
+import numpy as np
+
+from .batch_runner import PARAM_NAMES, run_batch
+
+# Headless entry point for sweeps: python -m src --scenario a b --sensing-radius-A 100 250 ...
+# Only the simulation is imported (no matplotlib), the plots can be made later from the store.
+
+def number(text):
+    # 1 stays an int so that the configuration keys match those of main.py ("a_6_6_1_1_200_200_...")
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src", description="Run a parameter sweep without plotting.")
+    parser.add_argument("--scenario", nargs="+", default=["a"], choices=["a", "b"])
+    parser.add_argument("--num-A-agents", nargs="+", type=int, default=[6])
+    parser.add_argument("--num-B-agents", nargs="+", type=int, default=[6])
+    parser.add_argument("--step-length-A", nargs="+", type=number, default=[1])
+    parser.add_argument("--step-length-B", nargs="+", type=number, default=[1])
+    parser.add_argument("--sensing-radius-A", nargs="+", type=number, default=[200],
+                        help="0 means the agents sense everyone")
+    parser.add_argument("--sensing-radius-B", nargs="+", type=number, default=[200])
+    parser.add_argument("--world-size", type=number, default=1000)
+    parser.add_argument("--runs", type=int, default=50, help="runs per configuration (the maximum with --adaptive)")
+    parser.add_argument("--steps", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0, help="base seed of the sweep")
+    parser.add_argument("--engine", default="python", choices=["python", "vectorized", "compiled"])
+    parser.add_argument("--batched", action="store_true", help="step the runs of a configuration together (the vectorized engine's update order, not --engine)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--store", help="directory of a ResultsStore, finished runs are skipped")
+    parser.add_argument("--results-file", help="append the summaries to this file (one json per line)")
+    parser.add_argument("--save-trajectory", action="store_true", help="also store the trajectories")
+    parser.add_argument("--convergence-window", type=int,
+                        help="stop runs early once converged over this many steps")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="stop sampling a configuration once its confidence interval is tight (see sweep.py)")
+    parser.add_argument("--min-runs", type=int, default=5, help="first runs per configuration with --adaptive")
+    parser.add_argument("--ci", type=float, default=0.02,
+                        help="confidence interval half width of the final orderliness with --adaptive")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    ranges = {"scenario": args.scenario, "num_A_agents": args.num_A_agents, "num_B_agents": args.num_B_agents,
+              "step_length_A": args.step_length_A, "step_length_B": args.step_length_B,
+              "sensing_radius_A": args.sensing_radius_A, "sensing_radius_B": args.sensing_radius_B}
+    assert list(ranges) == list(PARAM_NAMES)
+    store = None
+    if args.store is not None:
+        from .results_store import ResultsStore
+        store = ResultsStore(args.store)
+    convergence = {"window": args.convergence_window} if args.convergence_window else None
+    run_kwargs = dict(steps=args.steps, base_seed=args.seed, max_workers=args.workers, results_file=args.results_file,
+                      convergence=convergence, store=store, save_trajectory=args.save_trajectory,
+                      batched=args.batched)
+    if not args.batched:
+        run_kwargs["engine"] = args.engine
+
+    if args.adaptive:
+        from .sweep import adaptive_sweep, CI_TOLERANCE
+        ci_tolerance = {**CI_TOLERANCE, "final_orderliness": args.ci}
+        configs = adaptive_sweep(ranges, fixed={"world_limits": (0, args.world_size)}, ci_tolerance=ci_tolerance,
+                                 min_runs=args.min_runs, max_runs=args.runs,
+                                 log=lambda text: print(text, file=sys.stderr), **run_kwargs)
+        summaries = {config.key: list(config.summaries.values()) for config in configs}
+    else:
+        param_grid = dict(ranges, world_limits=[(0, args.world_size)])
+        summaries = defaultdict(list)
+        for count, summary in enumerate(run_batch(param_grid, args.runs, **run_kwargs), 1):
+            summaries[summary["key"]].append(summary)
+            print(f"\r{count} runs finished", end="", file=sys.stderr)
+        print(file=sys.stderr)
+
+    # one line per configuration (runs that were already in the store or results file are not counted)
+    print(f"{'configuration':<32}{'runs':>6}{'orderliness':>14}{'ci':>8}{'steps':>8}")
+    for key in sorted(summaries):
+        orderliness = np.array([summary["final_orderliness"] for summary in summaries[key]])
+        steps = np.mean([summary["steps"] for summary in summaries[key]])
+        ci = 1.96 * orderliness.std(ddof=1) / np.sqrt(len(orderliness)) if len(orderliness) > 1 else np.nan
+        print(f"{key:<32}{len(orderliness):>6}{orderliness.mean():>14.4f}{ci:>8.4f}{steps:>8.0f}")
+    return 0
@@ -0,0 +1,116 @@
+from collections import deque
+import numpy as np
+
+class ConvergenceDetector:
+    """Decides when a simulation has converged, for early termination in Simulator.simulate.
+
+    It watches
+    - the mean displacement of the agents per step,
+    - the mean target distance of the agents,
+    - the separation index (only computed every `check_every` steps),
+    smoothed by averaging them over windows of `window` steps. It reports convergence
+    once the swarm metrics are stationary: the averages of the target distance and the
+    separation index over the last num_windows windows differ by less than their
+    tolerance, and the average displacement of the last window is below displacement_tol.
+    A tolerance of None disables that criterion. The displacement is disabled by default
+    since the agents of scenario a keep wandering around in a stationary swarm.
+
+    The defaults are calibrated on the standard runs (6 + 6 agents, step length 1, world
+    1000, scenario a and b, sensing radius 200 and 1000, 3 seeds): the runs that settle
+    stop after 1600-4700 steps with the final separation index of a 5000 step run,
+    the runs whose swarm keeps drifting (scenario a, sensing radius 200) run to the end."""
+    def __init__(self, window=300, displacement_tol=None, target_distance_tol=5.0,
+                 separation_tol=5e-3, check_every=10, num_windows=3):
+        self.window = window
+        self.displacement_tol = displacement_tol
+        self.target_distance_tol = target_distance_tol
+        self.separation_tol = separation_tol
+        self.check_every = check_every
+        self.num_windows = num_windows
+
+        self.displacements = deque(maxlen=window)
+        self.target_distances = deque(maxlen=num_windows * window)
+        self.separation_indices = deque(maxlen=num_windows * max(1, window // check_every))
+        self.previous_position = None
+        self.steps = 0
+        self.converged_step = None
+
+    def update(self, sim):
+        """Feed the state after one simulation step, returns True once converged."""
+        position = sim.get_positions()
+        if self.previous_position is not None:
+            diff = position - self.previous_position
+            self.displacements.append(np.mean(np.sqrt(np.sum(diff**2, axis=1))))
+        self.previous_position = position.copy()
+        self.target_distances.append(np.mean(sim.get_target_distances()))
+        self.steps += 1
+
+        if self.steps % self.check_every != 0:
+            return False
+        self.separation_indices.append(sim.separation_index()[0])
+        if len(self.target_distances) < self.target_distances.maxlen \
+                or len(self.separation_indices) < self.separation_indices.maxlen:
+            return False
+
+        stationary = (self.displacement_tol is None or np.mean(self.displacements) < self.displacement_tol) \
+            and (self.target_distance_tol is None or
+                 np.ptp(window_means(self.target_distances, self.num_windows)) < self.target_distance_tol) \
+            and (self.separation_tol is None or
+                 np.ptp(window_means(self.separation_indices, self.num_windows)) < self.separation_tol)
+        if stationary:
+            self.converged_step = self.steps
+        return stationary
+
+def window_means(values, num_windows):
+    # means of num_windows equal consecutive windows of values (..., num_windows * window), oldest first
+    values = np.asarray(values)
+    return values.reshape(values.shape[:-1] + (num_windows, -1)).mean(axis=-1)
+
+class BatchedConvergenceDetector:
+    """ConvergenceDetector for the R runs of a BatchedSimulator, the same criteria per
+    run on (R, num_windows * window) ring buffers. All runs are fed in lockstep, update()
+    returns the mask of the runs that are converged after this step."""
+    def __init__(self, num_runs, window=300, displacement_tol=None, target_distance_tol=5.0,
+                 separation_tol=5e-3, check_every=10, num_windows=3):
+        self.window = window
+        self.displacement_tol = displacement_tol
+        self.target_distance_tol = target_distance_tol
+        self.separation_tol = separation_tol
+        self.check_every = check_every
+        self.num_windows = num_windows
+
+        self.displacements = np.zeros((num_runs, window))
+        self.target_distances = np.zeros((num_runs, num_windows * window))
+        self.separation_indices = np.zeros((num_runs, num_windows * max(1, window // check_every)))
+        self.previous_position = None
+        self.steps = 0
+
+    def update(self, position, target_distance, separation_index):
+        """Feed the positions (R, N, 2), target distances (R, N) and separation indices (R,) after one step."""
+        num_runs = len(position)
+        if self.previous_position is not None:
+            diff = position - self.previous_position
+            self.displacements[:, (self.steps - 1) % self.window] = np.mean(np.sqrt(np.sum(diff**2, axis=2)), axis=1)
+        self.previous_position = position.copy()
+        self.target_distances[:, self.steps % self.target_distances.shape[1]] = np.mean(target_distance, axis=1)
+        self.steps += 1
+
+        converged = np.zeros(num_runs, dtype=bool)
+        if self.steps % self.check_every != 0:
+            return converged
+        checks = self.steps // self.check_every
+        self.separation_indices[:, (checks - 1) % self.separation_indices.shape[1]] = separation_index
+        if self.steps < self.target_distances.shape[1] or checks < self.separation_indices.shape[1]:
+            return converged
+
+        converged[:] = True
+        if self.displacement_tol is not None:
+            converged &= self.displacements.mean(axis=1) < self.displacement_tol
+        if self.target_distance_tol is not None:
+            # the ring buffers in order, oldest first
+            target_distances = np.roll(self.target_distances, -(self.steps % self.target_distances.shape[1]), axis=1)
+            converged &= np.ptp(window_means(target_distances, self.num_windows), axis=1) < self.target_distance_tol
+        if self.separation_tol is not None:
+            separation_indices = np.roll(self.separation_indices, -(checks % self.separation_indices.shape[1]), axis=1)
+            converged &= np.ptp(window_means(separation_indices, self.num_windows), axis=1) < self.separation_tol
+        return converged
@@ -0,0 +1,854 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .spatial_index import SpatialHash
+from .pair_geometry import PairGeometry
+from .teams import TeamRules
+
+# Candidate avoidance angles tried by a moving agent, same as in Agent.move
+ROTATION_ANGLES = np.arange(0, 330, 30)
+# Upper bound on the number of (agent, A, B) triplets evaluated at once in the pair search
+PAIR_CHUNK_ELEMENTS = 2**20
+# Below this number of agents all neighbor queries are done with dense (N, N) arrays
+DENSE_NEIGHBOR_LIMIT = 256
+# Slices of agents per worker thread in the parallel target search (for load balancing,
+# agents that sense many pairs take much longer than the others)
+SLICES_PER_WORKER = 4
+# Smallest number of independent agents of a sequential step that is split over the worker
+# threads, smaller levels are updated by the calling thread
+MIN_PARALLEL_LEVEL = 256
+# Skin of the neighbor list of large swarms in step lengths, the list is rebuilt once an
+# agent moved half of it (see PairGeometry)
+NEIGHBOR_SKIN_STEPS = 10
+# Update schedules of a step, see VectorizedEngine
+SCHEDULES = ("sequential", "synchronous", "random", "partial")
+# Motion models of a move, see VectorizedEngine
+MOTIONS = ("rotation", "analytic")
+# Gap that the analytic motion model keeps to the discs it stops at, so that rounding
+# never lets two agents overlap
+CONTACT_MARGIN = 1e-6
+# Clearance (in step lengths) that the analytic motion model keeps to the neighbors when it
+# picks a direction, agents pressed against each other block each other in every direction
+CONE_CLEARANCE = 0.5
+# Angle by which the candidate directions lie outside the cone edges they come from
+CONE_EDGE = 1e-9
+# Directions of the outward normals of the walls (+x, +y, -x, -y), see blocked_directions
+WALL_NORMALS = np.array([0, np.pi / 2, np.pi, -np.pi / 2])
+
+def wrap_angle(angle):
+    # angle in [-pi, pi)
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+class VectorizedEngine:
+    """Structure-of-arrays version of the simulation step.
+
+    All agent state lives in contiguous numpy arrays, the Agent objects are only
+    kept as views on these arrays (for the plotting code). Targets of all agents
+    are computed at once from the positions at the start of the step, the moves
+    are then applied in agent order so that agents never end up overlapping.
+    For large swarms the neighbor queries go through a SpatialHash over the world.
+    team_rules (a TeamRules or its dict of rules) says which pair of teams every team
+    positions itself relative to, by default all teams follow the scenario w.r.t. A and B.
+
+    schedule says in which order the agents are updated in a step:
+    - "sequential": targets from the start of the step, moves in agent order (the reference)
+    - "synchronous": double buffered, all agents move at once based on the positions at
+      the start of the step, overlapping moves are resolved in a conflict pass
+    - "random": like sequential, but the moves are done in a random order every step
+    - "partial": the agents are updated in random batches of batch_size (default N/4),
+      every batch synchronously on the state left by the previous batches
+
+    motion says how a move avoids collisions:
+    - "rotation": the step is rotated by the avoidance angles until one is free (as Agent.move),
+      an agent for which all 11 angles are blocked stays put
+    - "analytic": every neighbor disc blocks a cone of step directions (computed in closed
+      form, a velocity obstacle for one step) and the agent steps in the free direction
+      closest to its target, so it is only blocked if all directions are, not just the 11
+      angles (with some clearance, see CONE_CLEARANCE). Enclosed agents take a shorter
+      step, cut at the time of impact. All
+      agents are moved at once with a fixed number of array passes and the conflict pass
+      of the synchronous schedule, so the move phase is synchronous whatever the schedule
+      (the schedules still decide which agents update their targets together)."""
+    # Profiler of the Simulator (see profiling.py), None unless profiling is enabled
+    profiler = None
+    # Random streams: rng for the update order of the schedules, rngs (one per agent) for
+    # the random targets. The Simulator sets them when it has a seed.
+    rng = np.random
+    rngs = None
+
+    def __init__(self, agents, scenario="a", bounds=None, cell_size=None, team_rules=None,
+                 schedule="sequential", batch_size=None, motion="rotation"):
+        if schedule not in SCHEDULES:
+            raise ValueError(f"Unknown schedule {schedule}, use one of {SCHEDULES}")
+        if motion not in MOTIONS:
+            raise ValueError(f"Unknown motion model {motion}, use one of {MOTIONS}")
+        self.agents = agents
+        self.schedule = schedule
+        self.batch_size = batch_size
+        self.motion = motion
+        self.scenario = scenario
+        self.num_agents = len(agents)
+
+        self.position = np.array([agent.position for agent in agents], dtype=float).reshape(-1, 2)
+        self.target_position = np.array([agent.target_position for agent in agents], dtype=float).reshape(-1, 2)
+        self.target_distance = np.array([agent.target_distance for agent in agents], dtype=float)
+        self.step_length = np.array([agent.step_length for agent in agents], dtype=float)
+        self.radius = np.array([agent.radius for agent in agents], dtype=float)
+        self.sensing_radius = np.array([agent.sensing_radius for agent in agents], dtype=float)
+        self.world_size = np.array([agent.world_size for agent in agents], dtype=float)
+        self.avoidance_direction = np.array([agent.avoidance_direction for agent in agents], dtype=float)
+        self.agent_type = np.array([agent.agent_type for agent in agents])
+
+        # integer team labels, and per agent the labels of the teams it positions itself relative to
+        if not isinstance(team_rules, TeamRules):
+            team_rules = TeamRules(team_rules, scenario)
+        self.team_rules = team_rules
+        self.teams, self.team, self.first_team, self.second_team, self.beyond = \
+            team_rules.labels(agent.agent_type for agent in agents)
+
+        # rotation tables for the avoidance angles of every agent, shape (N, len(ROTATION_ANGLES))
+        angles = np.radians(self.avoidance_direction[:, None] * ROTATION_ANGLES[None, :])
+        self.rotation_cos = np.cos(angles)
+        self.rotation_sin = np.sin(angles)
+
+        # Spatial index, the cells are at least as large as the collision reach of a move
+        self.dense = self.num_agents <= DENSE_NEIGHBOR_LIMIT
+        if self.num_agents > 0:
+            self.collision_reach = 2 * self.radius.max() + self.step_length.max()
+            if motion == "analytic":
+                # the cones of blocked_directions reach CONE_CLEARANCE step lengths further
+                self.collision_reach += CONTACT_MARGIN + CONE_CLEARANCE * self.step_length.max()
+            if bounds is None:
+                bounds = (0, self.world_size.max())
+            bounded = self.sensing_radius[self.sensing_radius > 0]
+            if cell_size is None:
+                cell_size = max(self.collision_reach, bounded.max() / 2 if len(bounded) else 0)
+            self.bounds = bounds
+            self.index = SpatialHash(bounds, cell_size)
+            # distances between the agents, shared by the sensing, the move neighbors and the
+            # metrics; large swarms keep the pairs within sensing or collision reach
+            cutoff = max(self.collision_reach, bounded.max() if len(bounded) else 0)
+            self.geometry = PairGeometry(self.position, self.dense, cutoff, NEIGHBOR_SKIN_STEPS * self.step_length.max(), bounds)
+
+        # The agents become views on the state arrays
+        for i, agent in enumerate(agents):
+            agent.position = self.position[i]
+            agent.target_position = self.target_position[i]
+
+    def step(self):
+        """Advance all agents by one simulation step."""
+        batches = [None]
+        if self.schedule == "partial":
+            batch_size = self.batch_size or max(1, self.num_agents // 4)
+            order = self.rng.permutation(self.num_agents)
+            batches = [np.sort(order[start:start+batch_size]) for start in range(0, self.num_agents, batch_size)]
+
+        for batch in batches:
+            active = None
+            if batch is not None:
+                active = np.zeros(self.num_agents, dtype=bool)
+                active[batch] = True
+            self.timed("target_update", self.update_target_positions, active)
+            if self.motion == "analytic":
+                self.timed("move", self.move_analytic, batch)
+            elif self.schedule == "sequential":
+                self.timed("move", self.move_agents)
+            elif self.schedule == "random":
+                self.timed("move", self.move_agents, self.rng.permutation(self.num_agents))
+            else:
+                self.timed("move", self.move_synchronous, batch)
+        if self.profiler is not None:
+            self.profiler.count("moves", self.num_agents)
+        self.sync_agents()
+
+    def timed(self, name, function, *args):
+        # call function(*args), timed as phase name when profiling
+        if self.profiler is None:
+            return function(*args)
+        start = time.perf_counter()
+        result = function(*args)
+        self.profiler.add_time(name, time.perf_counter() - start)
+        return result
+
+    def move_agents(self, order=None):
+        for i in (range(self.num_agents) if order is None else order):
+            self.move_agent(i)
+
+    def sync_agents(self):
+        # positions and targets are views already, only the scalars need to be copied
+        for agent, target_distance in zip(self.agents, self.target_distance.tolist()):
+            agent.target_distance = target_distance
+
+    def sensed_pairs(self):
+        """All pairs (i, j) where agent i senses agent j, sorted by i and then j."""
+        if self.dense:
+            dist = self.geometry.refresh().distance
+            sensed = (self.sensing_radius[:, None] == 0) | (dist < self.sensing_radius[:, None])
+            np.fill_diagonal(sensed, False)
+            return np.nonzero(sensed)
+
+        # bounded sensing radii go through the neighbor list, a radius of 0 means the agent senses everyone
+        is_global = self.sensing_radius == 0
+        i, j = np.empty(0, dtype=int), np.empty(0, dtype=int)
+        if not is_global.all():
+            i, j = self.geometry.refresh().pairs(np.where(is_global, 0, self.sensing_radius))
+        if is_global.any():
+            gi = np.repeat(np.flatnonzero(is_global), self.num_agents)
+            gj = np.tile(np.arange(self.num_agents), is_global.sum())
+            keep = gi != gj
+            i, j = np.concatenate([i, gi[keep]]), np.concatenate([j, gj[keep]])
+            order = np.lexsort((j, i))
+            i, j = i[order], j[order]
+        return i, j
+
+    def nearby(self, i, radius):
+        """Indices of the agents (other than i) that may be within radius of agent i."""
+        if self.dense:
+            others = np.arange(self.num_agents)
+            return others[others != i]
+        others = self.index.query(self.position[i], radius)
+        return others[others != i]
+
+    def sensed_others(self, i):
+        """Indices of the agents of the first and second team of agent i that it senses."""
+        if self.sensing_radius[i] == 0:
+            others = np.arange(self.num_agents)
+        elif self.dense:
+            others = np.flatnonzero(self.geometry.refresh().distance[i] < self.sensing_radius[i])
+        else:
+            others = self.index.query(self.position[i], self.sensing_radius[i])
+        relevant = (self.team[others] == self.first_team[i]) | (self.team[others] == self.second_team[i])
+        return others[(others != i) & relevant]
+
+    def update_target_positions(self, active=None):
+        """Batched version of Agent.update_target_position for all agents (or only for
+        the agents in the mask active, the others keep their targets)."""
+        if self.num_agents > 0 and not self.dense:
+            self.index.build(self.position)
+        target_position, stay, needs_random, has_both = self.search_targets(active)
+        if self.profiler is not None and needs_random.any():
+            start = time.perf_counter()
+            self.apply_random_targets(target_position, needs_random, has_both)
+            self.profiler.add_time("target_update/random_target", time.perf_counter() - start)
+            self.profiler.count("random_targets", int(needs_random.sum()))
+        else:
+            self.apply_random_targets(target_position, needs_random, has_both)
+        self.finish_targets(target_position, stay, active)
+
+    def search_targets(self, active=None):
+        """Closest pair targets of all agents (or of the agents in the mask active).
+        Returns the new targets and the masks of the agents that stay put, that need a
+        random target and that sense both teams."""
+        profiler = self.profiler
+        if profiler is not None:
+            phase_start = time.perf_counter()
+        i, j = self.sensed_pairs()
+        if active is not None:
+            keep = active[i]
+            i, j = i[keep], j[keep]
+        # group the sensed agents by their role for agent i, the agents of its first team
+        # take the place of A and the agents of its second team that of B
+        is_first = self.team[j] == self.first_team[i]
+        is_second = self.team[j] == self.second_team[i]
+        sensed_A = padded_lists(i[is_first], j[is_first], self.num_agents)
+        sensed_B = padded_lists(i[is_second], j[is_second], self.num_agents)
+        has_both = (sensed_A[:, 0] >= 0) & (sensed_B[:, 0] >= 0)
+        if profiler is not None:
+            now = time.perf_counter()
+            profiler.add_time("target_update/neighbors", now - phase_start)
+            phase_start = now
+
+        target_position = self.target_position.copy()
+        stay = np.zeros(self.num_agents, dtype=bool)
+        needs_random = np.zeros(self.num_agents, dtype=bool)
+
+        # Agents that only see one team pick a new random target once they reached the old one
+        diff = self.target_position - self.position
+        reached = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]) < self.step_length
+        if active is not None:
+            reached &= active
+        needs_random[~has_both & reached] = True
+
+        # Agents that sense both teams look for the closest point w.r.t. all (A, B) pairs,
+        # in chunks of agents to bound the size of the (chunk, A, B) pair arrays
+        idx_both = np.flatnonzero(has_both)
+        pairs_per_agent = max(1, sensed_A.shape[1] * sensed_B.shape[1])
+        chunk_size = max(1, PAIR_CHUNK_ELEMENTS // pairs_per_agent)
+        for start in range(0, len(idx_both), chunk_size):
+            idx = idx_both[start:start+chunk_size]
+            A_idx, B_idx = trim_padding(sensed_A[idx]), trim_padding(sensed_B[idx])
+            candidates, cand_dist = pair_candidates(self.position, idx, A_idx, B_idx,
+                                                    self.radius[idx], self.beyond[idx])
+            if profiler is not None:
+                profiler.count("pairs_evaluated", int(((A_idx >= 0).sum(axis=1) * (B_idx >= 0).sum(axis=1)).sum()))
+            stay[idx] = (cand_dist < 1e-1 * self.step_length[idx, None]).any(axis=1)
+            search = ~stay[idx]
+            chosen = self.first_free_candidate(idx[search], candidates[search], cand_dist[search],
+                                               np.concatenate([A_idx, B_idx], axis=1)[search])
+            for i, point in zip(idx[search], chosen):
+                if point is None:
+                    needs_random[i] = True
+                else:
+                    target_position[i] = point
+        if profiler is not None:
+            profiler.add_time("target_update/pair_search", time.perf_counter() - phase_start)
+        return target_position, stay, needs_random, has_both
+
+    def apply_random_targets(self, target_position, needs_random, has_both):
+        # random targets are drawn in agent order (from the stream of the agent, if it has one)
+        for i in np.flatnonzero(needs_random):
+            random_state = np.random if self.rngs is None else self.rngs[i]
+            if has_both[i]:
+                target_position[i] = self.random_free_target(i, self.sensed_others(i), random_state)
+            else:
+                target_position[i] = random_state.random(2) * (self.world_size[i] - 4*self.radius[i]) + 2*self.radius[i]
+
+    def finish_targets(self, target_position, stay, active=None):
+        # Agents that stay put target their own position (as Agent does, this also clamps the position)
+        target_position[stay] = self.position[stay]
+
+        # Ensure that the target position is within the world boundaries
+        low = 1.1 * self.radius[:, None]
+        high = self.world_size[:, None] - low
+        target_position = np.minimum(np.maximum(target_position, low), high)
+        if active is not None:
+            target_position = np.where(active[:, None], target_position, self.target_position)
+        self.position[stay] = target_position[stay]
+        if not self.dense:
+            self.index.update(np.flatnonzero(stay))
+
+        self.target_position[:] = target_position
+        diff = self.target_position - self.position
+        self.target_distance[:] = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1])
+
+    def first_free_candidate(self, idx, candidates, cand_dist, neighbors):
+        """For each agent in idx return the closest candidate that does not collide
+        with one of its neighbors (or None). Candidates are checked in rounds, one per
+        agent per round, so usually only the best one is collision checked."""
+        chosen = [None] * len(idx)
+        order = np.argsort(cand_dist, axis=1, kind='stable')
+        rank = np.zeros(len(idx), dtype=int)
+        active = np.arange(len(idx)) if order.shape[1] > 0 else np.empty(0, dtype=int)
+        while len(active) > 0:
+            best = order[active, rank[active]]
+            best_dist = cand_dist[active, best]
+            # agents without any finite candidate left have no valid target
+            active = active[np.isfinite(best_dist)]
+            best = best[np.isfinite(best_dist)]
+            if len(active) == 0:
+                break
+            points = candidates[active, best]
+            collide = self.collides(idx[active], points, neighbors[active])
+            for a, point in zip(active[~collide], points[~collide]):
+                chosen[a] = point
+            active = active[collide]
+            rank[active] += 1
+            active = active[rank[active] < order.shape[1]]
+        return chosen
+
+    def collides(self, idx, points, neighbors):
+        """Check for each agent in idx if it collides at points (M, 2) with the world
+        boundary or with one of its neighbors (M, K), padded with -1."""
+        if self.profiler is not None:
+            self.profiler.count("collision_checks", len(idx))
+        radius = self.radius[idx]
+        high = self.world_size[idx] - radius
+        out = (points[:, 0] < radius) | (points[:, 0] > high) | (points[:, 1] < radius) | (points[:, 1] > high)
+        other = self.position[neighbors]
+        dx = points[:, 0, None] - other[..., 0]
+        dy = points[:, 1, None] - other[..., 1]
+        dist = np.sqrt(dx * dx + dy * dy)
+        hit = (neighbors >= 0) & (dist < radius[:, None] + self.radius[neighbors])
+        return out | hit.any(axis=1)
+
+    def random_free_target(self, i, others, random_state=np.random):
+        """Sample random targets until one does not collide with the agents in others."""
+        while True:
+            target = random_state.random(2) * (self.world_size[i] - 4*self.radius[i]) + 2*self.radius[i]
+            if not self.collides(np.array([i]), target[None, :], others[None, :])[0]:
+                return target
+            if self.profiler is not None:
+                self.profiler.count("random_target_rejections")
+
+    def move_agent(self, i):
+        """Move agent i towards its target, trying all avoidance angles at once."""
+        position = self.position[i]
+        diff = self.target_position[i] - position
+        if diff[0] == 0 and diff[1] == 0:
+            return
+        distance = np.sqrt(diff[0] * diff[0] + diff[1] * diff[1])
+        direction0 = diff / distance
+
+        # the first (unrotated) step may be shorter to not overshoot the target
+        step_length = np.full(len(ROTATION_ANGLES), self.step_length[i])
+        step_length[0] = min(distance, self.step_length[i])
+        cos, sin = self.rotation_cos[i], self.rotation_sin[i]
+        new_position = np.empty((len(ROTATION_ANGLES), 2))
+        new_position[:, 0] = position[0] + step_length * (cos * direction0[0] - sin * direction0[1])
+        new_position[:, 1] = position[1] + step_length * (sin * direction0[0] + cos * direction0[1])
+
+        others = self.nearby(i, self.collision_reach)
+        neighbors = np.broadcast_to(others, (len(ROTATION_ANGLES), len(others)))
+        collide = self.collides(np.full(len(ROTATION_ANGLES), i), new_position, neighbors)
+        free = np.flatnonzero(~collide)
+        if self.profiler is not None:
+            # the number of angles that a sequential search would have tried
+            self.profiler.count("rotation_attempts", int(free[0]) + 1 if len(free) > 0 else len(ROTATION_ANGLES))
+            self.profiler.count("blocked_moves", int(len(free) == 0))
+        if len(free) > 0:
+            self.position[i] = new_position[free[0]]
+            if not self.dense:
+                self.index.update(i)
+
+    def move_synchronous(self, idx=None):
+        """Move the agents idx (default all) at once, double buffered: every agent takes
+        its first free avoidance angle w.r.t. the positions at the start of the move. A
+        conflict pass then resolves the new positions that overlap each other, of two
+        conflicting agents the one with the lower index moves and the other stays put."""
+        idx = np.arange(self.num_agents) if idx is None else np.asarray(idx)
+        diff = self.target_position[idx] - self.position[idx]
+        moving = (diff[:, 0] != 0) | (diff[:, 1] != 0)
+        idx, diff = idx[moving], diff[moving]
+        if len(idx) == 0:
+            return
+        position = self.position[idx]
+        distance = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1])
+        direction0 = diff / distance[:, None]
+
+        # all avoidance angles of all agents, (M, len(ROTATION_ANGLES)) as in move_agent
+        num_angles = len(ROTATION_ANGLES)
+        step_length = np.repeat(self.step_length[idx, None], num_angles, axis=1)
+        step_length[:, 0] = np.minimum(distance, self.step_length[idx])
+        cos, sin = self.rotation_cos[idx], self.rotation_sin[idx]
+        new_position = np.empty((len(idx), num_angles, 2))
+        new_position[..., 0] = position[:, 0, None] + step_length * (cos * direction0[:, 0, None] - sin * direction0[:, 1, None])
+        new_position[..., 1] = position[:, 1, None] + step_length * (sin * direction0[:, 0, None] + cos * direction0[:, 1, None])
+
+        neighbors = self.move_neighbors(idx)
+        collide = self.collides(np.repeat(idx, num_angles), new_position.reshape(-1, 2),
+                                np.repeat(neighbors, num_angles, axis=0)).reshape(len(idx), num_angles)
+        free = ~collide
+        has_free = free.any(axis=1)
+        if self.profiler is not None:
+            self.profiler.count("rotation_attempts", int(np.where(has_free, free.argmax(axis=1) + 1, num_angles).sum()))
+            self.profiler.count("blocked_moves", int((~has_free).sum()))
+        idx = idx[has_free]
+        proposal = new_position[has_free, free[has_free].argmax(axis=1)]
+
+        conflict = self.move_conflicts(idx, proposal)
+        if self.profiler is not None:
+            self.profiler.count("move_conflicts", int(conflict.sum()))
+        idx = idx[~conflict]
+        self.position[idx] = proposal[~conflict]
+        if not self.dense:
+            self.index.update(idx)
+
+    def move_analytic(self, idx=None, retries=1):
+        """Move the agents idx (default all) at once with the analytic motion model. Every
+        neighbor disc (and the world boundary) blocks a cone of step directions, the agent
+        steps in the free direction closest to its target: its target direction if that is
+        free, otherwise the edge of a cone that is closest to it. An agent without any free
+        direction takes a shorter step, cut at the time of impact, in the candidate
+        direction that gets it closest to its target. The neighbors are at their positions
+        from the start of the move, overlapping moves are resolved by the conflict pass of
+        move_synchronous. Agents that did not move (blocked or lost a conflict) are moved
+        again, up to retries times, against the new positions."""
+        idx = np.arange(self.num_agents) if idx is None else np.asarray(idx)
+        diff = self.target_position[idx] - self.position[idx]
+        moving = (diff[:, 0] != 0) | (diff[:, 1] != 0)
+        idx, diff = idx[moving], diff[moving]
+        if len(idx) == 0:
+            return
+        position = self.position[idx]
+        distance = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1])
+        length = np.minimum(distance, self.step_length[idx])
+        goal = np.arctan2(diff[:, 1], diff[:, 0])
+
+        neighbors = self.move_neighbors(idx)
+        center, half = self.blocked_directions(idx, position, length, neighbors)
+        # candidate directions: the target direction and the edges of all blocking cones
+        candidates = np.concatenate([goal[:, None], center - half - CONE_EDGE, center + half + CONE_EDGE], axis=1)
+        inside = np.abs(wrap_angle(candidates[:, :, None] - center[:, None, :])) < half[:, None, :]
+        free = ~inside.any(axis=2)
+        deviation = np.where(free, np.abs(wrap_angle(candidates - goal[:, None])), np.inf)
+        best = deviation.argmin(axis=1)
+        has_free = free.any(axis=1)
+        angle = candidates[np.arange(len(idx)), best]
+        # a step in a free direction ends at least the contact distance away from all neighbors
+        step = length[:, None] * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+        proposal = position + step
+        if not has_free.all():
+            # enclosed agents take the shortened step (cut at the time of impact) along the
+            # candidate with the most progress towards the target, or the longest one if none progresses
+            enclosed = np.flatnonzero(~has_free)
+            num_candidates = candidates.shape[1]
+            direction = np.stack([np.cos(candidates[enclosed]), np.sin(candidates[enclosed])], axis=2)
+            t = self.time_of_impact(np.repeat(idx[enclosed], num_candidates),
+                                    np.repeat(position[enclosed], num_candidates, axis=0),
+                                    (length[enclosed, None, None] * direction).reshape(-1, 2),
+                                    np.repeat(neighbors[enclosed], num_candidates, axis=0)).reshape(-1, num_candidates)
+            progress = t * np.cos(candidates[enclosed] - goal[enclosed, None])
+            best = np.where(progress.max(axis=1) > 0, progress.argmax(axis=1), t.argmax(axis=1))
+            rows = np.arange(len(enclosed))
+            proposal[enclosed] = position[enclosed] + (t[rows, best] * length[enclosed])[:, None] * direction[rows, best]
+
+        moved = (proposal[:, 0] != position[:, 0]) | (proposal[:, 1] != position[:, 1])
+        conflict = np.zeros(len(idx), dtype=bool)
+        conflict[moved] = self.move_conflicts(idx[moved], proposal[moved])
+        moved &= ~conflict
+        if self.profiler is not None:
+            self.profiler.count("collision_checks", len(idx))
+            self.profiler.count("move_conflicts", int(conflict.sum()))
+            if retries == 0 or moved.all():
+                self.profiler.count("blocked_moves", int((~moved).sum()))
+        self.position[idx[moved]] = proposal[moved]
+        if not self.dense:
+            self.index.update(idx[moved])
+        if retries > 0 and not moved.all():
+            self.move_analytic(idx[~moved], retries - 1)
+
+    def blocked_directions(self, idx, start, length, neighbors):
+        """The cones of step directions (center angle, half width) in which a step of length
+        from start ends too close to one of the neighbors (M, K, padded with -1) of the
+        agents idx or outside the world, shape (M, K') with only the cones that block
+        anything (half width 0 for padding). As in collides only the end of the step
+        counts, the contact distance is the sum of the radii plus CONTACT_MARGIN and
+        CONE_CLEARANCE step lengths."""
+        radius = self.radius[idx]
+        other = self.position[neighbors]
+        mx = other[..., 0] - start[:, 0, None]
+        my = other[..., 1] - start[:, 1, None]
+        d = np.sqrt(mx * mx + my * my)
+        contact = radius[:, None] + self.radius[neighbors] + CONTACT_MARGIN + CONE_CLEARANCE * self.step_length[idx, None]
+        L = length[:, None]
+        # |start + L * (cos, sin) - other| < contact within acos((d^2 + L^2 - contact^2) / (2 d L)) of the neighbor
+        with np.errstate(divide="ignore", invalid="ignore"):
+            half = np.arccos(np.clip((d * d + L * L - contact * contact) / (2 * d * L), -1, 1))
+        half = np.where((neighbors >= 0) & (d > 0), half, 0)
+        center = np.arctan2(my, mx)
+
+        # the world boundary blocks the directions within acos(h / L) of the normal of a wall at distance h
+        low = radius + CONTACT_MARGIN
+        high = self.world_size[idx] - radius - CONTACT_MARGIN
+        h = np.stack([high - start[:, 0], high - start[:, 1], start[:, 0] - low, start[:, 1] - low], axis=1)
+        half = np.concatenate([half, np.arccos(np.clip(h / L, 0, 1))], axis=1)
+        center = np.concatenate([center, np.broadcast_to(WALL_NORMALS, h.shape)], axis=1)
+
+        # only the blocking cones, moved to the front of every row
+        blocking = half > 0
+        order = np.argsort(~blocking, axis=1, kind="stable")[:, :max(blocking.sum(axis=1).max(), 1)]
+        return np.take_along_axis(center, order, axis=1), np.take_along_axis(half, order, axis=1)
+
+    def time_of_impact(self, idx, start, step, neighbors):
+        """Fraction t in [0, 1] of the steps (M, 2) from start (M, 2) that the agents idx can
+        move before they touch one of their neighbors (M, K, padded with -1) or leave the
+        world. The contact distance is the sum of the radii plus CONTACT_MARGIN, agents
+        already closer than that may only move away from each other."""
+        if neighbors.shape[1] == 0:
+            neighbors = np.full((len(idx), 1), -1)
+        # |start + t * step - other|^2 = contact^2, the first root of a * t^2 + b * t + c
+        radius = self.radius[idx]
+        other = self.position[neighbors]
+        mx = start[:, 0, None] - other[..., 0]
+        my = start[:, 1, None] - other[..., 1]
+        contact = radius[:, None] + self.radius[neighbors] + CONTACT_MARGIN
+        a = (step[:, 0] * step[:, 0] + step[:, 1] * step[:, 1])[:, None]
+        b = 2 * (mx * step[:, 0, None] + my * step[:, 1, None])
+        c = mx * mx + my * my - contact * contact
+        root = b * b - 4 * a * c
+        approaching = (neighbors >= 0) & (b < 0) & (root > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(c <= 0, 0, (-b - np.sqrt(np.maximum(root, 0))) / (2 * a))
+        t_hit = np.where(approaching, t, np.inf).min(axis=1)
+
+        # the world boundary, the centers stay within [radius, world_size - radius]
+        low = (radius + CONTACT_MARGIN)[:, None]
+        high = (self.world_size[idx] - radius - CONTACT_MARGIN)[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_wall = np.where(step > 0, (high - start) / step, np.where(step < 0, (low - start) / step, np.inf))
+        return np.clip(np.minimum(t_hit, t_wall.min(axis=1)), 0, 1)
+
+    def move_neighbors(self, idx):
+        """Agents that may collide with a move of the agents idx (sorted), shape (M, K) padded with -1."""
+        if self.dense:
+            neighbors = np.tile(np.arange(self.num_agents), (len(idx), 1))
+            neighbors[np.arange(len(idx)), idx] = -1
+            return neighbors
+        reach = np.zeros(self.num_agents)
+        reach[idx] = self.collision_reach
+        i, j = self.geometry.refresh().pairs(reach)
+        return trim_padding(padded_lists(i, j, self.num_agents)[idx])
+
+    def move_conflicts(self, idx, proposal):
+        """Mask of the moves of the agents idx (sorted) to proposal (M, 2) that overlap
+        with the move of an agent with a lower index."""
+        conflict = np.zeros(len(idx), dtype=bool)
+        if len(idx) < 2:
+            return conflict
+        radius = self.radius[idx]
+        if len(idx) <= DENSE_NEIGHBOR_LIMIT:
+            close = np.tril(pairwise_distances(proposal) < radius[:, None] + radius[None, :], -1)
+            return close.any(axis=1)
+        grid = SpatialHash(self.bounds, self.index.cell_size)
+        grid.build(proposal)
+        i, j = grid.pairs_within(radius + radius.max())
+        diff = proposal[i] - proposal[j]
+        close = (j < i) & (np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]) < radius[i] + radius[j])
+        conflict[i[close]] = True
+        return conflict
+
+class CompiledEngine(VectorizedEngine):
+    """The simulation step done by compiled kernels (see kernels.py), one loop over all
+    agents instead of many small numpy calls.
+
+    With the sequential and random schedules (and rotation moves) the agents are updated
+    one after another as in the python engine: every agent searches its target on the
+    positions left by the agents before it and then moves (update_agents). The
+    trajectories are bit-identical to engine="python", not to VectorizedEngine, whose
+    targets all come from the positions at the start of the step. This update order is
+    what makes the python and the vectorized engine differ, the few ulps by which the
+    dot products of numpy (BLAS) round differently are reproduced by the kernels (see
+    kernels.numpy_rounding). The random targets are drawn with numpy in between, from
+    the same streams as Agent.
+    The synchronous and partial schedules use the kernels of the VectorizedEngine
+    steps instead and are bit-identical to it, the analytic motion model has no kernel,
+    its moves are the VectorizedEngine ones.
+
+    backend is "numba" (the compiled kernels), "python" (the same kernels, interpreted)
+    or "numpy" (the VectorizedEngine methods and steps). By default numba is used if it
+    is installed. When profiling, only the phases are timed (the target search and the
+    move of update_agents together as "move"), the kernels do not count collision
+    checks and pairs.
+
+    The kernels only look at the neighbors of an agent, the pairs of the PairGeometry
+    within the sensing or collision reach of the agents plus the distance that two agents
+    can close in one step (kernel_neighbors), so a step costs O(N) instead of O(N^2).
+
+    With workers > 1 the target search of a synchronous or partial step runs on a pool
+    of threads, each compiled kernel call (which releases the GIL) handles a disjoint
+    slice of the agents. All threads read the same state arrays from the start of the
+    step and write their own rows of the outputs, waiting for all slices is the barrier
+    before the random targets and the moves, which stay serial. A sequential or random
+    step is split into levels of agents that are no neighbors of each other and only
+    depend on the agents of lower levels (kernels.update_levels), the agents of a level
+    are updated by the threads at once. This needs the random targets to come from one
+    stream per agent (seeded agents), otherwise the step stays serial. The result does
+    not depend on the number of workers."""
+    def __init__(self, agents, scenario="a", bounds=None, cell_size=None, team_rules=None,
+                 schedule="sequential", batch_size=None, motion="rotation", backend=None, workers=1):
+        super().__init__(agents, scenario, bounds, cell_size, team_rules, schedule, batch_size, motion)
+        # imported here, numba is only loaded when a compiled engine is used
+        from . import kernels
+        if backend is None:
+            backend = "numba" if kernels.HAVE_NUMBA else "numpy"
+        if backend == "numba" and not kernels.HAVE_NUMBA:
+            raise ValueError("The numba backend needs numba to be installed")
+        if backend not in ("numba", "python", "numpy"):
+            raise ValueError(f"Unknown backend {backend}")
+        self.backend = backend
+        self.kernels = kernels
+        if backend == "numba":
+            self.search_kernel, self.update_kernel = kernels.search_targets, kernels.update_agents
+            self.levels_kernel = kernels.update_levels
+        else:
+            self.search_kernel, self.update_kernel = kernels.py_search_targets, kernels.py_update_agents
+            self.levels_kernel = kernels.py_update_levels
+        self.workers = max(1, int(workers))
+        self.executor = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        if self.num_agents > 0:
+            # reach of the neighbor lists of the kernels: within a step an agent moves by at most
+            # a step length plus the clamping of its target (0.1 radius), two agents close in by twice that
+            margin = 2 * (self.step_length.max() + 0.1 * self.radius.max())
+            self.kernel_reach = np.maximum(self.sensing_radius, self.collision_reach) + margin
+            if not self.dense:
+                self.geometry.cutoff = max(self.geometry.cutoff, self.kernel_reach.max())
+
+    def close(self):
+        # shut down the worker threads
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def step(self):
+        if self.backend == "numpy" or self.motion != "rotation" or self.schedule not in ("sequential", "random"):
+            return super().step()
+        # as in the python engine, the random order is drawn before the targets
+        order = np.arange(self.num_agents) if self.schedule == "sequential" else self.rng.permutation(self.num_agents)
+        self.timed("move", self.update_step, np.asarray(order, dtype=np.int64))
+        if self.profiler is not None:
+            self.profiler.count("moves", self.num_agents)
+        self.sync_agents()
+
+    def kernel_neighbors(self, symmetric=False):
+        """Neighbor lists (offsets (N + 1,), neighbors) of the kernels for the current step:
+        the agents j of neighbors[offsets[i]:offsets[i+1]] (sorted) are all agents that agent
+        i may sense or collide with before the end of the step. With symmetric, j is also a
+        neighbor of i when i is one of j (not sorted, for kernels.update_levels)."""
+        i, j = self.geometry.refresh().pairs(self.kernel_reach)
+        if symmetric:
+            i, j = np.concatenate([i, j]), np.concatenate([j, i])
+            by_agent = np.argsort(i, kind="stable")
+            i, j = i[by_agent], j[by_agent]
+        offsets = np.zeros(self.num_agents + 1, dtype=np.int64)
+        np.cumsum(np.bincount(i, minlength=self.num_agents), out=offsets[1:])
+        return offsets, np.asarray(j, dtype=np.int64)
+
+    def parallel_moves(self):
+        # the agents of a level can only be updated in any order when every agent draws its
+        # random targets from its own stream and no agent senses everyone
+        return self.executor is not None and self.rngs is not None and \
+            all(rng is not np.random for rng in self.rngs) and len({id(rng) for rng in self.rngs}) == self.num_agents \
+            and not (self.sensing_radius == 0).any()
+
+    def update_step(self, order):
+        """The sequential step of the agents in order, level by level on the worker threads
+        if possible (see kernels.update_levels), otherwise one agent after another."""
+        offsets, neighbors = self.kernel_neighbors()
+        if not self.parallel_moves():
+            self.count_random_targets(*self.update_agents(order, offsets, neighbors))
+            return
+        level = self.levels_kernel(order, *self.kernel_neighbors(symmetric=True))
+        by_level = np.argsort(level, kind="stable")
+        ends = np.flatnonzero(np.diff(level[by_level])) + 1
+        for agents in np.split(order[by_level], ends):
+            if len(agents) < MIN_PARALLEL_LEVEL:
+                self.count_random_targets(*self.update_agents(agents, offsets, neighbors))
+                continue
+            bounds = np.linspace(0, len(agents), self.workers * SLICES_PER_WORKER + 1).astype(int)
+            chunks = [agents[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+            # list() waits for the whole level (and raises the errors of the threads)
+            for counts in list(self.executor.map(lambda chunk: self.update_agents(chunk, offsets, neighbors), chunks)):
+                self.count_random_targets(*counts)
+
+    def count_random_targets(self, random_targets, rejections):
+        # counted by the calling thread, the counters of the profiler are not thread safe
+        if self.profiler is not None:
+            self.profiler.count("random_targets", random_targets)
+            self.profiler.count("random_target_rejections", rejections)
+
+    def update_agents(self, order, offsets, neighbors):
+        """Agent.move for the agents in order, one after another (see kernels.update_agents).
+        The kernel stops at every agent that needs a random target, which is drawn here.
+        Returns the number of random targets and of rejected random targets."""
+        sensed = np.empty(self.num_agents, dtype=np.int64)
+        start, drawn = 0, False
+        random_targets = rejections = 0
+        while True:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                start, has_both, num_sensed = self.update_kernel(
+                    self.position, self.target_position, self.target_distance, self.step_length, self.radius,
+                    self.sensing_radius, self.world_size, self.team, self.first_team, self.second_team,
+                    self.beyond, self.rotation_cos, self.rotation_sin, offsets, neighbors, order, start, drawn,
+                    sensed)
+            if start == len(order):
+                return random_targets, rejections
+            i = order[start]
+            random_state = np.random if self.rngs is None else self.rngs[i]
+            while True:
+                target = random_state.random(2) * (self.world_size[i] - 4*self.radius[i]) + 2*self.radius[i]
+                # with both teams sensed the target must be free (checked with the rounding of Agent)
+                if not has_both or not self.kernels.collides(target[0], target[1], i, sensed, num_sensed, self.position,
+                                                             self.radius, self.world_size, True):
+                    break
+                rejections += 1
+            self.target_position[i] = target
+            random_targets += 1
+            drawn = True
+
+    def search_targets(self, active=None):
+        if self.backend == "numpy":
+            return super().search_targets(active)
+        if self.profiler is not None:
+            start = time.perf_counter()
+        target_position = np.empty_like(self.target_position)
+        stay = np.empty(self.num_agents, dtype=bool)
+        needs_random = np.empty(self.num_agents, dtype=bool)
+        has_both = np.empty(self.num_agents, dtype=bool)
+        offsets, neighbors = self.kernel_neighbors()
+        def search(start, stop):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.search_kernel(self.position, self.target_position, self.step_length, self.radius,
+                                   self.sensing_radius, self.world_size, self.team, self.first_team,
+                                   self.second_team, self.beyond, offsets, neighbors, target_position, stay,
+                                   needs_random, has_both, start, stop)
+        if self.executor is None:
+            search(0, self.num_agents)
+        else:
+            bounds = np.linspace(0, self.num_agents, self.workers * SLICES_PER_WORKER + 1).astype(int)
+            # list() waits for all slices (and raises the errors of the threads)
+            list(self.executor.map(search, bounds[:-1], bounds[1:]))
+        if self.profiler is not None:
+            # includes the neighbor search of the kernel
+            self.profiler.add_time("target_update/pair_search", time.perf_counter() - start)
+        if active is not None:
+            # the kernel updates all agents, the inactive ones keep their targets
+            target_position[~active] = self.target_position[~active]
+            stay &= active
+            needs_random &= active
+            has_both &= active
+        return target_position, stay, needs_random, has_both
+
+def pairwise_distances(position):
+    """Distances between all positions, shape (N, N)."""
+    dx = position[:, None, 0] - position[None, :, 0]
+    dy = position[:, None, 1] - position[None, :, 1]
+    return np.sqrt(dx * dx + dy * dy)
+
+def padded_lists(i, j, num_rows):
+    """Turn pairs (i, j) sorted by i into a (num_rows, K) array of j's per row, padded with -1."""
+    counts = np.bincount(i, minlength=num_rows)
+    padded = -np.ones((num_rows, max(1, counts.max() if len(counts) else 0)), dtype=int)
+    slot = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+    padded[i, slot] = j
+    return padded
+
+def trim_padding(padded):
+    """Drop the padding columns that are empty in all rows."""
+    width = max(1, (padded >= 0).sum(axis=1).max())
+    return padded[:, :width]
+
+def pair_candidates(position, idx, A_idx, B_idx, radius, beyond):
+    """Closest target points of the agents idx w.r.t. all pairs of their sensed A and B agents.
+
+    A_idx (M, PA) and B_idx (M, PB) are the sensed agents of the first and second team,
+    padded with -1. beyond (M,) is the mode of every agent, between A and B (scenario a)
+    or beyond B (scenario b). Returns the candidates (M, PA*PB, 2) and their distance
+    (M, PA*PB) to the agent; padded pairs (and pairs that are too close in between mode)
+    get an infinite distance. The pairs are flattened in A-major order, just like the
+    double loop in Agent."""
+    M, PA, PB = len(idx), A_idx.shape[1], B_idx.shape[1]
+    A = position[A_idx][:, :, None, :]
+    B = position[B_idx][:, None, :, :]
+    C = position[idx][:, None, None, :]
+    AB = B - A
+    AC = C - A
+    BC = C - B
+    norm_AB = np.sqrt(AB[..., 0] * AB[..., 0] + AB[..., 1] * AB[..., 1])[..., None]
+    offset = 4 * radius[:, None, None, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proj_scalar = (AC[..., 0] * AB[..., 0] + AC[..., 1] * AB[..., 1]) / (AB[..., 0] * AB[..., 0] + AB[..., 1] * AB[..., 1])
+        offset_A = A + offset * AB / norm_AB
+        offset_B = B + offset * AB / norm_AB
+        offset_B_inner = B + offset * -AB / norm_AB
+    D = A + proj_scalar[..., None] * AB
+    valid = (A_idx >= 0)[:, :, None] & (B_idx >= 0)[:, None, :]
+    beyond = np.asarray(beyond, dtype=bool)
+
+    # between mode (scenario a)
+    if not beyond.all():
+        norm_AC = np.sqrt(AC[..., 0] * AC[..., 0] + AC[..., 1] * AC[..., 1])
+        norm_BC = np.sqrt(BC[..., 0] * BC[..., 0] + BC[..., 1] * BC[..., 1])
+        outside = np.where((norm_AC < norm_BC)[..., None], offset_A, offset_B_inner)
+        inside = ((0 <= proj_scalar) & (proj_scalar <= 1))[..., None]
+        closest_point = np.where(inside, D, outside)
+        valid &= beyond[:, None, None] | (norm_AB[..., 0] > 4 * radius[:, None, None])
+    # beyond mode (scenario b)
+    if beyond.any():
+        closest_beyond = np.where((proj_scalar > 1)[..., None], D, offset_B)
+        closest_point = closest_beyond if beyond.all() else \
+            np.where(beyond[:, None, None, None], closest_beyond, closest_point)
+
+    diff = closest_point - C
+    dist = np.sqrt(diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1])
+    dist = np.where(valid, dist, np.inf)
+    return closest_point.reshape(M, PA * PB, 2), dist.reshape(M, PA * PB)
@@ -1,11 +1,19 @@
 from src.agent import Agent
 from src.world import World
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.spatial.distance import pdist, squareform
+# matplotlib and scipy are imported in the functions that use them, so that the
+# simulation (create_agents) only needs numpy
+
+# Upper bound on the number of (step, agent, agent) elements per chunk of the metric series
+SERIES_CHUNK_ELEMENTS = 2**22
+# Upper bound on the number of distances per block of separation_index_chunked (it runs every step)
+PAIR_CHUNK_ELEMENTS = 2**18
 
 def create_agents(world,agents,
-                  agent_type, num_agents, step_length, agent_radius, sensing_radius):
+                  agent_type, num_agents, step_length, agent_radius, sensing_radius, positions=None, rng=None):
+    # positions (num_agents, 2) places the agents at given positions (see placement.py),
+    # otherwise they are placed by rejection sampling
+    # rng is a np.random.Generator for the positions and initial targets (default: global np.random)
     # assert that sensing_radius is either a single value or an numpy array of length num_agents
     if not isinstance(sensing_radius, np.ndarray):
         sensing_radius = sensing_radius * np.ones((num_agents,))
@@ -16,16 +24,24 @@ def create_agents(world,agents,
         step_length = step_length * np.ones((num_agents,))
     assert len(step_length) == num_agents, "step_length must be a single value or a numpy array of length num_agents"
 
+    if positions is not None:
+        assert len(positions) == num_agents, "positions must have a row for each agent"
+        for i in range(num_agents):
+            agents.append(Agent(agent_type, positions[i],
+                                step_length=step_length[i], radius=agent_radius, sensing_radius=sensing_radius[i],
+                                world_size=world.world_size, rng=rng))
+        return agents
+
     # then add an agent on a position that is not yet occupied
     for i in range(num_agents):
             position_valid = False
             while not position_valid:
-                position = np.random.rand(2) * (world.world_size - 2*agent_radius) + agent_radius
+                position = (np.random if rng is None else rng).random(2) * (world.world_size - 2*agent_radius) + agent_radius
                 if not check_overlap(position,agents):
                     position_valid = True
                     agents.append(Agent(agent_type, position, 
                                         step_length=step_length[i], radius=agent_radius, sensing_radius=sensing_radius[i],
-                                        world_size=world.world_size))
+                                        world_size=world.world_size, rng=rng))
     return agents
 
 def check_overlap(position,agents):
@@ -70,6 +86,7 @@ def get_density(sim, rotate=False, plot=False):
         mean_pos_B = R.dot(mean_pos_B)
 
     if plot:
+        import matplotlib.pyplot as plt
         axs, fig = plt.subplots(1, 1, figsize=(6, 6))
         # plot the position of each agent
         for agent in sim.agents:
@@ -82,6 +99,38 @@ def get_density(sim, rotate=False, plot=False):
 
     return [mean_pos_A, mean_pos_B]
 
+def disk_kernel(radius):
+    """Kernel with ones at the cells within radius (in cells) of the center, the same
+    cells that circle_around_index stamps."""
+    offsets = np.arange(-radius, radius + 1)
+    return (np.sqrt(offsets[:, None]**2 + offsets[None, :]**2) < radius).astype(float)
+
+def density_grid(mean_pos_teams, grid_world, resolution=None, kernel_radius=5):
+    """Density map of the team centroids of many runs at once.
+
+    mean_pos_teams has shape (runs, 2, 2), indexed [run, team, x/y] (e.g. the output of
+    get_density of every run, or mean_pos_A and mean_pos_B of the batch summaries).
+    Every centroid is binned to its nearest grid point (like pos_to_grid) and the counts,
+    +1 for team A and -1 for team B, are convolved with a disk of kernel_radius cells.
+    resolution is the number of grid points per axis (an int or a tuple), by default
+    one per meter of grid_world."""
+    mean_pos_teams = np.asarray(mean_pos_teams, dtype=float).reshape(-1, 2, 2)
+    if resolution is None:
+        resolution = (int(grid_world.x_lim[-1]-grid_world.x_lim[0]), int(grid_world.y_lim[-1]-grid_world.y_lim[0]))
+    elif np.isscalar(resolution):
+        resolution = (resolution, resolution)
+    nx, ny = resolution
+    x_range = np.linspace(grid_world.x_lim[0], grid_world.x_lim[1], nx)
+    y_range = np.linspace(grid_world.y_lim[0], grid_world.y_lim[1], ny)
+
+    # nearest grid point of every centroid, shape (runs, 2)
+    x = np.abs(mean_pos_teams[..., 0, None] - x_range).argmin(axis=-1)
+    y = np.abs(mean_pos_teams[..., 1, None] - y_range).argmin(axis=-1)
+    weights = np.broadcast_to([1.0, -1.0], x.shape)
+    counts = np.bincount((x * ny + y).ravel(), weights=weights.ravel(), minlength=nx * ny).reshape(nx, ny)
+    from scipy import ndimage
+    return ndimage.convolve(counts, disk_kernel(kernel_radius), mode='constant', cval=0.0)
+
 def get_mean_target_distance(sim_instance):
     agents_A = [agent for agent in sim_instance if agent.agent_type == 'A']
     agents_B = [agent for agent in sim_instance if agent.agent_type == 'B']
@@ -97,22 +146,122 @@ def get_separation_index(sim_instance):
 
     positions_A = np.array([agent.position for agent in agents_A])
     positions_B = np.array([agent.position for agent in agents_B])
+    return separation_index(positions_A, positions_B)
+
+def separation_index(positions_A, positions_B):
+    """Orderliness and total intra team distance from the positions of team A and B."""
+    from scipy.spatial.distance import pdist, squareform
     positions = np.concatenate([positions_A, positions_B], axis=0)
 
     # Compute the distance between all agents
-    pairwise_distances = squareform(pdist(positions))
-    intra_A = pairwise_distances[:len(positions_A), :len(positions_A)]
-    intra_B = pairwise_distances[len(positions_A):, len(positions_A):]
+    return separation_index_of_distances(squareform(pdist(positions)), len(positions_A))
+
+def separation_index_of_distances(pairwise_distances, num_A):
+    """separation_index from the distance matrix of the agents of team A followed by those of team B."""
+    intra_A = pairwise_distances[:num_A, :num_A]
+    intra_B = pairwise_distances[num_A:, num_A:]
+    num_B = len(pairwise_distances) - num_A
 
     avg_inter_team_distance = np.mean(pairwise_distances)
     # only take the average over the upper triangle of the intra_A matrix
-    avg_intra_team_A_distance = np.mean(intra_A[np.triu_indices(len(positions_A), k=1)])
-    avg_intra_team_B_distance = np.mean(intra_B[np.triu_indices(len(positions_B), k=1)])
+    avg_intra_team_A_distance = np.mean(intra_A[np.triu_indices(num_A, k=1)])
+    avg_intra_team_B_distance = np.mean(intra_B[np.triu_indices(num_B, k=1)])
 
     orderliness = avg_inter_team_distance / ((avg_intra_team_A_distance + avg_intra_team_B_distance) / 2)
     total_intra_team_distance = avg_intra_team_A_distance + avg_intra_team_B_distance
     return orderliness, total_intra_team_distance
 
+def separation_index_chunked(position, agent_type, chunk_size=None):
+    """separation_index of the positions (N, 2) with team labels agent_type (N,) without the
+    (N, N) distance matrix: the distances are summed over blocks of chunk_size rows (by default
+    about PAIR_CHUNK_ELEMENTS distances per block). Equal up to floating point rounding."""
+    agent_type = np.asarray(agent_type)
+    A, B = position[agent_type == 'A'], position[agent_type == 'B']
+    num_A, num_B = len(A), len(B)
+    if chunk_size is None:
+        chunk_size = max(1, PAIR_CHUNK_ELEMENTS // max(1, num_A + num_B))
+
+    def row_sums(P, Q):
+        # sum of |p - q| over all p in P and q in Q
+        return sum(pair_distance_sum(P[None, start:start+chunk_size, None], Q[None, None, :])[0]
+                   for start in range(0, len(P), chunk_size))
+    # the diagonal is zero, every other pair of a team is counted twice
+    sum_AA, sum_BB = row_sums(A, A) / 2, row_sums(B, B) / 2
+    sum_AB = row_sums(A, B)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_inter_team_distance = 2 * (sum_AA + sum_BB + sum_AB) / (num_A + num_B)**2
+        avg_intra_team_A_distance = sum_AA / (num_A * (num_A - 1) / 2)
+        avg_intra_team_B_distance = sum_BB / (num_B * (num_B - 1) / 2)
+        orderliness = avg_inter_team_distance / ((avg_intra_team_A_distance + avg_intra_team_B_distance) / 2)
+    return orderliness, avg_intra_team_A_distance + avg_intra_team_B_distance
+
+def pair_distance_sum(P, Q):
+    # sum of the distances |P - Q| over all but the first axis, shape (T,)
+    diff = P - Q
+    dist = np.sqrt(diff[..., 0] * diff[..., 0] + diff[..., 1] * diff[..., 1])
+    return dist.reshape(len(dist), -1).sum(axis=1)
+
+def separation_index_series(position, agent_type, stride=1, chunk_size=None):
+    """Orderliness and total intra team distance (see separation_index) of every
+    stride-th step of a trajectory position (T, N, 2) with team labels agent_type (N,).
+
+    The steps are processed in chunks of chunk_size steps (by default such that a chunk
+    has about SERIES_CHUNK_ELEMENTS pairwise distances), so position can be a
+    memory-mapped array of a long run. Returns two arrays of shape (ceil(T / stride),),
+    equal to separation_index of every step up to floating point rounding."""
+    agent_type = np.asarray(agent_type)
+    idx_A, idx_B = np.flatnonzero(agent_type == 'A'), np.flatnonzero(agent_type == 'B')
+    num_agents = len(idx_A) + len(idx_B)
+    iA, jA = np.triu_indices(len(idx_A), k=1)
+    iB, jB = np.triu_indices(len(idx_B), k=1)
+    if chunk_size is None:
+        chunk_size = max(1, SERIES_CHUNK_ELEMENTS // max(1, num_agents * num_agents))
+
+    steps = range(0, len(position), stride)
+    orderliness = np.empty(len(steps))
+    total_intra_team_distance = np.empty(len(steps))
+    for start in range(0, len(steps), chunk_size):
+        t = steps[start:start+chunk_size]
+        block = np.asarray(position[t.start:t.stop:stride], dtype=float)
+        A, B = block[:, idx_A], block[:, idx_B]
+        sum_AA = pair_distance_sum(A[:, iA], A[:, jA])
+        sum_BB = pair_distance_sum(B[:, iB], B[:, jB])
+        sum_AB = pair_distance_sum(A[:, :, None], B[:, None, :])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # the mean over the full distance matrix (with its zero diagonal) of all agents
+            avg_inter_team_distance = 2 * (sum_AA + sum_BB + sum_AB) / num_agents**2
+            avg_intra_team_A_distance = sum_AA / len(iA)
+            avg_intra_team_B_distance = sum_BB / len(iB)
+            orderliness[start:start+len(t)] = avg_inter_team_distance / ((avg_intra_team_A_distance + avg_intra_team_B_distance) / 2)
+        total_intra_team_distance[start:start+len(t)] = avg_intra_team_A_distance + avg_intra_team_B_distance
+    return orderliness, total_intra_team_distance
+
+def mean_target_distance_series(target_distance, agent_type, stride=1, chunk_size=None):
+    """Mean target distance of team A and B of every stride-th step of target_distance
+    (T, N), the array version of get_mean_target_distance. Returns shape (ceil(T / stride), 2)."""
+    agent_type = np.asarray(agent_type)
+    is_A, is_B = agent_type == 'A', agent_type == 'B'
+    if chunk_size is None:
+        chunk_size = max(1, SERIES_CHUNK_ELEMENTS // max(1, len(agent_type)))
+
+    steps = range(0, len(target_distance), stride)
+    series = np.empty((len(steps), 2))
+    for start in range(0, len(steps), chunk_size):
+        t = steps[start:start+chunk_size]
+        block = np.asarray(target_distance[t.start:t.stop:stride], dtype=float)
+        with np.errstate(invalid='ignore'):
+            series[start:start+len(t), 0] = block[:, is_A].mean(axis=1)
+            series[start:start+len(t), 1] = block[:, is_B].mean(axis=1)
+    return series
+
+def pad_to_same_length(series):
+    """Pad a list of time series of different lengths (e.g. of runs that stopped
+    early because they converged) with their final value, returns a (runs, T) array."""
+    length = max(len(s) for s in series)
+    return np.array([np.concatenate([s, np.full(length - len(s), s[-1])]) for s in series])
+
 def circle_around_index(x,y, r, density):
     # input is x and y which is an index in an array
     # we want to return a set of indices xs and ys that are within a circle of radius r
@@ -0,0 +1,118 @@
+import numpy as np
+
+class AgentState:
+    """Lightweight read-only snapshot of one agent at one time step.
+    Has the same attributes as Agent that are used by the plotting code."""
+    __slots__ = ('agent_type', 'position', 'target_position', 'target_distance',
+                 'step_length', 'radius', 'sensing_radius')
+
+    def __init__(self, agent_type, position, target_position, target_distance,
+                 step_length, radius, sensing_radius):
+        self.agent_type = agent_type
+        self.position = position
+        self.target_position = target_position
+        self.target_distance = target_distance
+        self.step_length = step_length
+        self.radius = radius
+        self.sensing_radius = sensing_radius
+
+class TrajectoryHistory:
+    """Preallocated trajectory buffer, replaces the list of deep copied agents.
+
+    Per step we store position and target_position (steps, N, 2) and
+    target_distance (steps, N), the per-agent metadata is stored only once.
+    Indexing gives a list of AgentState snapshots, so history[t] can be used
+    wherever a list of agents at time t was used before."""
+    def __init__(self, agents, capacity=0):
+        self.num_agents = len(agents)
+        self.agent_type = np.array([agent.agent_type for agent in agents])
+        self.step_length = np.array([agent.step_length for agent in agents], dtype=float)
+        self.radius = np.array([agent.radius for agent in agents], dtype=float)
+        self.sensing_radius = np.array([agent.sensing_radius for agent in agents], dtype=float)
+
+        self.length = 0
+        self._position = np.empty((capacity, self.num_agents, 2))
+        self._target_position = np.empty((capacity, self.num_agents, 2))
+        self._target_distance = np.empty((capacity, self.num_agents))
+
+    @classmethod
+    def from_arrays(cls, agent_type, step_length, radius, sensing_radius,
+                    position, target_position, target_distance):
+        """History on top of existing (e.g. memory-mapped) arrays, nothing is copied."""
+        history = cls.__new__(cls)
+        history.num_agents = len(agent_type)
+        history.agent_type = agent_type
+        history.step_length = step_length
+        history.radius = radius
+        history.sensing_radius = sensing_radius
+        history.length = len(position)
+        history._position = position
+        history._target_position = target_position
+        history._target_distance = target_distance
+        return history
+
+    @property
+    def position(self):
+        return self._position[:self.length]
+
+    @property
+    def target_position(self):
+        return self._target_position[:self.length]
+
+    @property
+    def target_distance(self):
+        return self._target_distance[:self.length]
+
+    def reserve(self, capacity):
+        """Make sure the buffer can hold at least capacity steps without reallocating."""
+        if capacity <= len(self._position):
+            return
+        for name in ('_position', '_target_position', '_target_distance'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:])
+            new[:self.length] = old[:self.length]
+            setattr(self, name, new)
+
+    def record(self, position, target_position, target_distance):
+        """Append the state of all agents at one time step."""
+        if self.length == len(self._position):
+            self.reserve(max(16, 2 * self.length))
+        self._position[self.length] = position
+        self._target_position[self.length] = target_position
+        self._target_distance[self.length] = target_distance
+        self.length += 1
+
+    def record_agents(self, agents):
+        self.record([agent.position for agent in agents],
+                    [agent.target_position for agent in agents],
+                    [agent.target_distance for agent in agents])
+
+    def snapshot(self, t):
+        """List of AgentState of all agents at time step t."""
+        if t < 0:
+            t += self.length
+        if not 0 <= t < self.length:
+            raise IndexError("history index out of range")
+        return [AgentState(self.agent_type[i], self._position[t, i], self._target_position[t, i],
+                           self._target_distance[t, i], self.step_length[i], self.radius[i],
+                           self.sensing_radius[i])
+                for i in range(self.num_agents)]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, t):
+        if isinstance(t, slice):
+            return [self.snapshot(i) for i in range(*t.indices(self.length))]
+        return self.snapshot(int(t))
+
+    def __iter__(self):
+        for t in range(self.length):
+            yield self.snapshot(t)
+
+    def __getstate__(self):
+        # only pickle the used part of the buffers
+        state = self.__dict__.copy()
+        for name in ('_position', '_target_position', '_target_distance'):
+            state[name] = state[name][:self.length].copy()
+        return state
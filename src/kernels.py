@@ -0,0 +1,331 @@
+import math
+import numpy as np
+
+# Numba is optional: without it the kernels below are plain python functions
+# (slow, but they still work and are useful to check the compiled versions)
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    numba = None
+    HAVE_NUMBA = False
+
+def jit(function):
+    """Compile function with numba in nopython mode, if numba is installed."""
+    if HAVE_NUMBA:
+        # numpy error model: division by zero gives inf/nan like in the numpy code,
+        # nogil so that threads can run the kernels on disjoint slices of agents at once
+        return numba.njit(cache=True, error_model='numpy', nogil=True)(function)
+    return function
+
+# The kernels do exactly the same floating point operations in the same order as
+# VectorizedEngine (elementwise products and sums, no fastmath), so search_targets gives
+# the targets of VectorizedEngine. update_agents (one agent after
+# another, as Agent.move) gives those of the python engine, its helpers round the dot
+# products like numpy does in Agent (agent_rounding, see numpy_rounding).
+
+if HAVE_NUMBA:
+    from numba.extending import intrinsic
+
+    @intrinsic
+    def _fused(typingctx, a, b, c):
+        # llvm.fma, a * b + c with a single rounding
+        def codegen(context, builder, signature, args):
+            return builder.fma(*args)
+        return numba.types.float64(numba.types.float64, numba.types.float64, numba.types.float64), codegen
+
+    @jit
+    def fma(a, b, c):
+        return _fused(a, b, c)
+elif hasattr(math, "fma"):
+    fma = math.fma
+else:
+    def fma(a, b, c):
+        # exact a * b + c, rounded once (math.fma only exists from python 3.13)
+        from fractions import Fraction
+        return float(Fraction(a) * Fraction(b) + Fraction(c))
+
+def numpy_rounding():
+    """How numpy rounds the products of 2-vectors that Agent uses: np.dot of two vectors
+    (also in np.linalg.norm) and of a 2x2 matrix and a vector (rotate_vector). These go
+    through BLAS, which fuses the multiply-adds on CPUs with FMA. Returns (fused dot,
+    fused matrix vector product); a library that rounds in yet another way is treated
+    as not fused, then the python engine is only reproduced up to rounding."""
+    rng = np.random.default_rng(0)
+    x, y = rng.random((2, 100, 2)) - 0.5
+    m = rng.random((100, 2, 2)) - 0.5
+    fused_dot = all(np.dot(a, b) == fma(a[1], b[1], a[0] * b[0]) for a, b in zip(x, y))
+    fused_matvec = all(np.dot(M, b)[0] == fma(M[0, 0], b[0], M[0, 1] * b[1]) and
+                       np.dot(M, b)[1] == fma(M[1, 0], b[0], M[1, 1] * b[1]) for M, b in zip(m, y))
+    return fused_dot, fused_matvec
+
+# The kernels see these as constants (numba caches the compiled kernels per CPU)
+FUSED_DOT, FUSED_MATVEC = numpy_rounding()
+
+@jit
+def _dot(agent_rounding, x0, y0, x1, y1):
+    # x0 * y0 + x1 * y1, with agent_rounding as np.dot((x0, x1), (y0, y1))
+    if agent_rounding and FUSED_DOT:
+        return fma(x1, y1, x0 * y0)
+    return x0 * y0 + x1 * y1
+
+@jit
+def _norm(agent_rounding, x, y):
+    # |(x, y)|, with agent_rounding as np.linalg.norm
+    return math.sqrt(_dot(agent_rounding, x, x, y, y))
+
+@jit
+def _rotate(agent_rounding, cos, sin, x, y):
+    # (x, y) rotated by the angle of (cos, sin), with agent_rounding as rotate_vector
+    if agent_rounding and FUSED_MATVEC:
+        return fma(cos, x, -sin * y), fma(sin, x, cos * y)
+    return cos * x - sin * y, sin * x + cos * y
+
+@jit
+def _collides(x, y, i, others, num_others, position, radius, world_size, agent_rounding=False):
+    # Does agent i at (x, y) collide with the world boundary or one of the agents in others?
+    r = radius[i]
+    high = world_size[i] - r
+    if x < r or x > high or y < r or y > high:
+        return True
+    for k in range(num_others):
+        j = others[k]
+        if _norm(agent_rounding, x - position[j, 0], y - position[j, 1]) < r + radius[j]:
+            return True
+    return False
+
+# What the target search of an agent decided (see _search_target)
+KEEP, TARGET, STAY, RANDOM = 0, 1, 2, 3
+
+@jit
+def _search_target(i, position, target_position, step_length, radius, sensing_radius, world_size,
+                   team, first_team, second_team, beyond, offsets, neighbors, A_list, B_list, others, agent_rounding):
+    # Same as Agent.update_target_position for agent i on the current positions, without the
+    # random targets and the clamping. Returns (decision, whether it senses both teams, the new
+    # target, the number of sensed agents), the sensed agents are written to others.
+    # The agents that i may sense are neighbors[offsets[i]:offsets[i+1]] (sorted), with a
+    # sensing radius of 0 it senses everyone.
+    everyone = sensing_radius[i] == 0
+    num_agents = position.shape[0] if everyone else offsets[i + 1] - offsets[i]
+    num_A = 0
+    num_B = 0
+    for n in range(num_agents):
+        j = n if everyone else neighbors[offsets[i] + n]
+        is_first = team[j] == first_team[i]
+        is_second = team[j] == second_team[i]
+        if j == i or not (is_first or is_second):
+            continue
+        if everyone or \
+                _norm(agent_rounding, position[i, 0] - position[j, 0], position[i, 1] - position[j, 1]) < sensing_radius[i]:
+            # the first team takes the place of A, the second team that of B
+            if is_first:
+                A_list[num_A] = j
+                num_A += 1
+            if is_second:
+                B_list[num_B] = j
+                num_B += 1
+    for k in range(num_A):
+        others[k] = A_list[k]
+    for k in range(num_B):
+        others[num_A + k] = B_list[k]
+    num_others = num_A + num_B
+    has_both = num_A > 0 and num_B > 0
+
+    if not has_both:
+        dx = target_position[i, 0] - position[i, 0]
+        dy = target_position[i, 1] - position[i, 1]
+        if _norm(agent_rounding, dx, dy) < step_length[i]:
+            return RANDOM, has_both, target_position[i, 0], target_position[i, 1], num_others
+        return KEEP, has_both, target_position[i, 0], target_position[i, 1], num_others
+
+    # closest points w.r.t. all (A, B) pairs in A-major order
+    offset = 4 * radius[i]
+    cx = position[i, 0]
+    cy = position[i, 1]
+    cand = np.empty((num_A * num_B, 2))
+    cand_dist = np.empty(num_A * num_B)
+    stay = False
+    for a in range(num_A):
+        ax = position[A_list[a], 0]
+        ay = position[A_list[a], 1]
+        for b in range(num_B):
+            k = a * num_B + b
+            bx = position[B_list[b], 0]
+            by = position[B_list[b], 1]
+            abx = bx - ax
+            aby = by - ay
+            acx = cx - ax
+            acy = cy - ay
+            length2 = _dot(agent_rounding, abx, abx, aby, aby)
+            norm_AB = math.sqrt(length2)
+            proj = _dot(agent_rounding, acx, abx, acy, aby) / length2
+            valid = True
+            if beyond[i]:
+                if proj > 1:
+                    px = ax + proj * abx
+                    py = ay + proj * aby
+                else:
+                    px = bx + offset * abx / norm_AB
+                    py = by + offset * aby / norm_AB
+            else:
+                valid = norm_AB > offset
+                if 0 <= proj and proj <= 1:
+                    px = ax + proj * abx
+                    py = ay + proj * aby
+                else:
+                    bcx = cx - bx
+                    bcy = cy - by
+                    if _norm(agent_rounding, acx, acy) < _norm(agent_rounding, bcx, bcy):
+                        px = ax + offset * abx / norm_AB
+                        py = ay + offset * aby / norm_AB
+                    else:
+                        px = bx + offset * -abx / norm_AB
+                        py = by + offset * -aby / norm_AB
+            cand[k, 0] = px
+            cand[k, 1] = py
+            if valid:
+                cand_dist[k] = _norm(agent_rounding, px - cx, py - cy)
+            else:
+                cand_dist[k] = math.inf
+            if cand_dist[k] < 1e-1 * step_length[i]:
+                stay = True
+    if stay:
+        return STAY, has_both, target_position[i, 0], target_position[i, 1], num_others
+
+    # closest candidate that does not collide with a sensed agent (ties go to the lower index)
+    checked = np.zeros(num_A * num_B, dtype=np.bool_)
+    while True:
+        best = -1
+        best_dist = math.inf
+        for k in range(num_A * num_B):
+            if not checked[k] and cand_dist[k] < best_dist:
+                best = k
+                best_dist = cand_dist[k]
+        if best < 0:
+            return RANDOM, has_both, target_position[i, 0], target_position[i, 1], num_others
+        checked[best] = True
+        if not _collides(cand[best, 0], cand[best, 1], i, others, num_others,
+                         position, radius, world_size, agent_rounding):
+            return TARGET, has_both, cand[best, 0], cand[best, 1], num_others
+
+def _search_targets(position, target_position, step_length, radius, sensing_radius, world_size,
+                    team, first_team, second_team, beyond, offsets, neighbors, new_target, stay, needs_random,
+                    has_both, start, stop):
+    # Same as VectorizedEngine.search_targets, one agent at a time for the agents start:stop.
+    # Only the rows start:stop of the outputs are written, the inputs are only read.
+    # offsets and neighbors are the neighbor lists (CSR) of all agents within sensing reach.
+    num_agents = position.shape[0]
+    A_list = np.empty(num_agents, dtype=np.int64)
+    B_list = np.empty(num_agents, dtype=np.int64)
+    others = np.empty(num_agents, dtype=np.int64)
+    for i in range(start, stop):
+        decision, both, x, y, _ = _search_target(i, position, target_position, step_length, radius,
+                                                 sensing_radius, world_size, team, first_team, second_team,
+                                                 beyond, offsets, neighbors, A_list, B_list, others, False)
+        new_target[i, 0] = x
+        new_target[i, 1] = y
+        stay[i] = decision == STAY
+        needs_random[i] = decision == RANDOM
+        has_both[i] = both
+
+@jit
+def _move_agent(i, position, target_position, step_length, radius, world_size, rotation_cos, rotation_sin,
+                offsets, neighbors, agent_rounding):
+    # Same as VectorizedEngine.move_agent, neighbors[offsets[i]:offsets[i+1]] are all agents
+    # that agent i may collide with
+    dx = target_position[i, 0] - position[i, 0]
+    dy = target_position[i, 1] - position[i, 1]
+    if dx == 0 and dy == 0:
+        return
+    distance = _norm(agent_rounding, dx, dy)
+    d0x = dx / distance
+    d0y = dy / distance
+    others = neighbors[offsets[i]:offsets[i + 1]]
+    px = position[i, 0]
+    py = position[i, 1]
+    for k in range(rotation_cos.shape[1]):
+        length = min(distance, step_length[i]) if k == 0 else step_length[i]
+        rx, ry = _rotate(agent_rounding, rotation_cos[i, k], rotation_sin[i, k], d0x, d0y)
+        x = px + length * rx
+        y = py + length * ry
+        if not _collides(x, y, i, others, len(others), position, radius, world_size, agent_rounding):
+            position[i, 0] = x
+            position[i, 1] = y
+            return
+
+def _update_agents(position, target_position, target_distance, step_length, radius, sensing_radius, world_size,
+                   team, first_team, second_team, beyond, rotation_cos, rotation_sin, offsets, neighbors,
+                   order, start, drawn, sensed):
+    # Same as Agent.move for the agents order[start:], one after another: every agent searches
+    # its target on the positions left by the agents before it and then moves, as the python
+    # engine does. Stops at an agent that needs a random target, which the caller draws with
+    # numpy, and returns (its index in order, whether it senses both teams, the number of its
+    # sensed agents, which are written to sensed). Returns (len(order), False, 0) at the end.
+    # With drawn, the target of order[start] was just drawn and is not searched again.
+    # offsets and neighbors are the neighbor lists (CSR) of all agents that an agent may sense
+    # or collide with during the step (see CompiledEngine.kernel_neighbors).
+    num_agents = position.shape[0]
+    A_list = np.empty(num_agents, dtype=np.int64)
+    B_list = np.empty(num_agents, dtype=np.int64)
+    for n in range(start, len(order)):
+        i = order[n]
+        decision = TARGET
+        if not (drawn and n == start):
+            decision, both, x, y, num_sensed = _search_target(i, position, target_position, step_length, radius,
+                                                              sensing_radius, world_size, team, first_team,
+                                                              second_team, beyond, offsets, neighbors,
+                                                              A_list, B_list, sensed, True)
+            if decision == RANDOM:
+                return n, both, num_sensed
+            if decision == STAY:
+                # the agent targets its own position (which the clamping below also moves)
+                x = position[i, 0]
+                y = position[i, 1]
+            target_position[i, 0] = x
+            target_position[i, 1] = y
+
+        # Ensure that the target position is within the world boundaries
+        low = 1.1 * radius[i]
+        high = world_size[i] - low
+        target_position[i, 0] = min(max(target_position[i, 0], low), high)
+        target_position[i, 1] = min(max(target_position[i, 1], low), high)
+        if decision == STAY:
+            position[i, 0] = target_position[i, 0]
+            position[i, 1] = target_position[i, 1]
+        target_distance[i] = _norm(True, target_position[i, 0] - position[i, 0], target_position[i, 1] - position[i, 1])
+
+        _move_agent(i, position, target_position, step_length, radius, world_size, rotation_cos, rotation_sin,
+                    offsets, neighbors, True)
+    return len(order), False, 0
+
+def _update_levels(order, offsets, neighbors):
+    # Level of every agent in a sequential step in the given order: one more than the highest
+    # level of its neighbors that come before it in order. The agents of one level are no
+    # neighbors of each other and only depend on lower levels, so they can be updated at once
+    # (in any order) and the result is that of the sequential step. neighbors must be symmetric.
+    # Returns the levels of order[0], order[1], ...
+    rank = np.empty(offsets.shape[0] - 1, dtype=np.int64)
+    for n in range(len(order)):
+        rank[order[n]] = n
+    level_of = np.zeros(offsets.shape[0] - 1, dtype=np.int64)
+    level = np.empty(len(order), dtype=np.int64)
+    for n in range(len(order)):
+        i = order[n]
+        highest = -1
+        for k in range(offsets[i], offsets[i + 1]):
+            j = neighbors[k]
+            if rank[j] < n and level_of[j] > highest:
+                highest = level_of[j]
+        level_of[i] = highest + 1
+        level[n] = highest + 1
+    return level
+
+search_targets = jit(_search_targets)
+update_agents = jit(_update_agents)
+update_levels = jit(_update_levels)
+
+# Interpreted versions of the same kernels (only the helpers are still compiled)
+collides = _collides
+py_search_targets = _search_targets
+py_update_agents = _update_agents
+py_update_levels = _update_levels
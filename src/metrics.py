@@ -0,0 +1,69 @@
+import numpy as np
+
+class MetricObserver:
+    """Base class of the metrics that are computed while the simulation runs.
+
+    The Simulator calls update() after every step, the metric is computed from the
+    live state every `every` steps (starting after the first step, so with every=1
+    the series matches a loop over sim.history). Only the output series is stored."""
+    name = "metric"
+
+    def __init__(self, every=1):
+        self.every = every
+        self.steps = []
+        self.values = []
+
+    def update(self, sim, step):
+        if (step - 1) % self.every == 0:
+            self.steps.append(step)
+            self.values.append(self.compute(sim))
+
+    def compute(self, sim):
+        raise NotImplementedError
+
+    def series(self):
+        """Steps at which the metric was computed and the values, as arrays."""
+        return np.array(self.steps), np.array(self.values)
+
+class SeparationIndexObserver(MetricObserver):
+    """Orderliness: mean distance between all agents over the mean intra team distance."""
+    name = "orderliness"
+
+    def compute(self, sim):
+        return sim.separation_index()[0]
+
+class IntraTeamDistanceObserver(MetricObserver):
+    """Sum of the mean intra team distances of team A and B."""
+    name = "intra_team_distance"
+
+    def compute(self, sim):
+        return sim.separation_index()[1]
+
+class MeanTargetDistanceObserver(MetricObserver):
+    """Mean target distance of team A and team B, values have shape (2,)."""
+    name = "target_distance"
+
+    def compute(self, sim):
+        target_distance, agent_type = sim.get_target_distances(), sim.agent_types
+        return np.array([np.mean(target_distance[agent_type == 'A']),
+                         np.mean(target_distance[agent_type == 'B'])])
+
+class TeamCentroidObserver(MetricObserver):
+    """Mean position of every team, values have shape (num_teams, 2) with the
+    teams in the order of self.teams (sorted team labels)."""
+    name = "team_centroid"
+
+    def __init__(self, every=1):
+        super().__init__(every)
+        self.teams = None
+
+    def compute(self, sim):
+        position, agent_type = sim.get_positions(), sim.agent_types
+        if self.teams is None:
+            self.teams = np.unique(agent_type)
+        return np.array([position[agent_type == team].mean(axis=0) for team in self.teams])
+
+def default_observers(every=1):
+    """The observers of all metrics used by the plots."""
+    return [SeparationIndexObserver(every), IntraTeamDistanceObserver(every),
+            MeanTargetDistanceObserver(every), TeamCentroidObserver(every)]
@@ -0,0 +1,95 @@
+import numpy as np
+from .spatial_index import SpatialHash
+
+class PairGeometry:
+    """Agent to agent distances of the current positions, computed once and shared by
+    the sensing, the moves and the metrics of a step.
+
+    position is the live (N, 2) array of the engine. For small swarms (dense) the full
+    (N, N) distance matrix is kept, for large swarms only the pairs closer than
+    cutoff + skin, as a neighbor list (Verlet list) built with a SpatialHash. refresh()
+    brings the distances up to date: it compares the positions with those of the last
+    refresh and only recomputes the pairs of the agents that moved (under the sequential
+    schedule most agents of a settled swarm do not move). The neighbor list is only
+    rebuilt once an agent moved more than skin / 2 since the build, until then it
+    contains all pairs closer than cutoff. The distances are computed with the same
+    formula as everywhere in the engine, so they are bit-identical to a recomputation."""
+    def __init__(self, position, dense=True, cutoff=None, skin=0.0, bounds=None):
+        self.position = position
+        self.dense = dense
+        self.cutoff = cutoff
+        self.skin = skin
+        self.bounds = bounds
+        # positions at the last refresh (None until the first one) and at the last build of the list
+        self.refreshed_position = None
+        self.built_position = None
+        if dense:
+            self.distance = np.zeros((len(position), len(position)))
+        else:
+            self.i = self.j = np.empty(0, dtype=int)
+            self.pair_distance = np.empty(0)
+
+    def refresh(self):
+        """Update the distances to the live positions, returns self."""
+        position = self.position
+        if self.refreshed_position is None:
+            moved = np.ones(len(position), dtype=bool)
+        else:
+            moved = (position[:, 0] != self.refreshed_position[:, 0]) | (position[:, 1] != self.refreshed_position[:, 1])
+        if not moved.any():
+            return self
+        if self.dense:
+            self.update_rows(np.flatnonzero(moved))
+        elif self.needs_build():
+            self.build()
+        else:
+            pairs = np.flatnonzero(moved[self.i] | moved[self.j])
+            self.pair_distance[pairs] = distances(position, self.i[pairs], self.j[pairs])
+        self.refreshed_position = position.copy()
+        return self
+
+    def update_rows(self, idx):
+        # the rows and columns of the agents idx of the dense matrix
+        position = self.position
+        if len(idx) == len(position):
+            dx = position[:, None, 0] - position[None, :, 0]
+            dy = position[:, None, 1] - position[None, :, 1]
+            self.distance[:] = np.sqrt(dx * dx + dy * dy)
+            return
+        dx = position[idx, None, 0] - position[None, :, 0]
+        dy = position[idx, None, 1] - position[None, :, 1]
+        rows = np.sqrt(dx * dx + dy * dy)
+        self.distance[idx] = rows
+        self.distance[:, idx] = rows.T
+
+    def needs_build(self):
+        if self.built_position is None:
+            return True
+        diff = self.position - self.built_position
+        return np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]).max() > self.skin / 2
+
+    def build(self):
+        # the neighbor list of all pairs closer than cutoff + skin, sorted by i and then j
+        reach = self.cutoff + self.skin
+        grid = SpatialHash(self.bounds, max(reach, 1e-9))
+        grid.build(self.position)
+        self.i, self.j = grid.pairs_within(np.full(len(self.position), reach))
+        self.pair_distance = distances(self.position, self.i, self.j)
+        self.built_position = self.position.copy()
+
+    def pairs(self, radius):
+        """All pairs (i, j), i != j, with |p_i - p_j| < radius[i] (radius (N,) or a scalar
+        up to cutoff for a neighbor list), sorted by i and then j. Call refresh() first."""
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(self.position),))
+        if self.dense:
+            close = self.distance < radius[:, None]
+            np.fill_diagonal(close, False)
+            return np.nonzero(close)
+        keep = self.pair_distance < radius[self.i]
+        return self.i[keep], self.j[keep]
+
+def distances(position, i, j):
+    """|p_i - p_j| for the pairs (i, j)."""
+    dx = position[i, 0] - position[j, 0]
+    dy = position[i, 1] - position[j, 1]
+    return np.sqrt(dx * dx + dy * dy)
@@ -0,0 +1,224 @@
+import numpy as np
+
+# Strategies to place agents without overlap, much faster than the rejection sampling of
+# create_agents. All of them return positions (num_agents, 2) that are passed to
+# create_agents(..., positions=...). The random strategies take a seed (or a
+# np.random.Generator) and never touch the global np.random state.
+# All agents are assumed to have the same radius, agents overlap if they are closer
+# than 2*radius (as in check_overlap). existing are the positions of agents that were
+# placed before (e.g. the other team), the new agents do not overlap with them.
+
+class DiskGrid:
+    """Background grid that enforces a minimum distance between points (as in Bridson's
+    Poisson disk sampling): the cells have a diagonal of min_distance, so they hold at
+    most one point, and all points closer than min_distance are in the 5x5 block of cells
+    around a point. Batches of candidates are checked with a few array operations."""
+    def __init__(self, world_size, min_distance):
+        self.min_distance = min_distance
+        self.cell_size = min_distance / np.sqrt(2)
+        self.num_cells = int(np.ceil(world_size / self.cell_size)) + 1
+        # padded by two cells on every side so the 5x5 blocks never leave the grid
+        self.cells = -np.ones((self.num_cells + 4, self.num_cells + 4), dtype=int)
+        self.points = np.empty((0, 2))
+
+    def cell_of(self, points):
+        cell = np.floor(points / self.cell_size).astype(int)
+        return np.clip(cell, 0, self.num_cells - 1) + 2
+
+    def add(self, points):
+        cell = self.cell_of(points)
+        self.cells[cell[:, 0], cell[:, 1]] = len(self.points) + np.arange(len(points))
+        self.points = np.concatenate([self.points, points])
+
+    def neighbor_cells(self, cell):
+        # flat indices of the 5x5 block of cells around every cell, shape (M, 25)
+        offsets = np.arange(-2, 3)
+        nx = cell[:, 0, None, None] + offsets[None, :, None]
+        ny = cell[:, 1, None, None] + offsets[None, None, :]
+        return (nx * self.cells.shape[1] + ny).reshape(-1, 25)
+
+    def too_close(self, query, neighbors, points, index=None):
+        """For every query point check if one of its neighbors (indices into points,
+        -1 for none) is closer than min_distance (only neighbors with a lower index if
+        index is given)."""
+        other = points[np.maximum(neighbors, 0)]
+        dx = other[..., 0] - query[:, 0, None]
+        dy = other[..., 1] - query[:, 1, None]
+        close = (neighbors >= 0) & (np.sqrt(dx * dx + dy * dy) < self.min_distance)
+        if index is not None:
+            close &= neighbors < index[:, None]
+        return close.any(axis=1)
+
+    def free(self, candidates, cell=None, block=None):
+        """Mask of the candidates that are at least min_distance from all points."""
+        free = np.ones(len(candidates), dtype=bool)
+        if len(candidates) == 0 or len(self.points) == 0:
+            return free
+        if block is None:
+            cell = self.cell_of(candidates)
+            block = self.neighbor_cells(cell)
+        # candidates in an occupied cell are too close anyway, only check the others
+        free = self.cells.ravel()[block[:, 12]] < 0
+        free[free] = ~self.too_close(candidates[free], self.cells.ravel()[block[free]], self.points)
+        return free
+
+    def accept(self, candidates, free=None):
+        """Add the candidates that are far enough from all points and from the earlier
+        accepted candidates of the batch, returns the mask of accepted candidates.
+        free optionally restricts the candidates (e.g. to those free on another grid)."""
+        if len(candidates) == 0:
+            return np.ones(0, dtype=bool)
+        cell = self.cell_of(candidates)
+        block = self.neighbor_cells(cell)
+        free = self.free(candidates, cell, block) & (free if free is not None else True)
+
+        # conflicts within the batch: per cell only the first free candidate is kept, and a
+        # candidate is dropped if it is too close to an earlier kept candidate of the batch
+        flat = block[:, 12]
+        kept = np.flatnonzero(free)
+        kept = kept[np.unique(flat[kept], return_index=True)[1]]
+        keys = flat[kept]
+        position = np.minimum(np.searchsorted(keys, block[kept]), len(keys) - 1)
+        neighbors = np.where(keys[position] == block[kept], kept[position], -1)
+        free[:] = False
+        free[kept[~self.too_close(candidates[kept], neighbors, candidates, kept)]] = True
+        self.add(candidates[free])
+        return free
+
+def as_generator(seed):
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+def new_grid(world, min_distance, existing=None):
+    grid = DiskGrid(world.world_size, min_distance)
+    if existing is not None and len(existing) > 0:
+        grid.add(np.asarray(existing, dtype=float).reshape(-1, 2))
+    return grid
+
+def inside(points, world, radius):
+    # the positions that create_agents can generate
+    return np.all((points >= radius) & (points <= world.world_size - radius), axis=1)
+
+def sample_until(grid, num_agents, propose, max_rounds=1000):
+    """Accept batches of proposed candidates until num_agents are placed."""
+    placed, count = [], 0
+    for _ in range(max_rounds):
+        if count >= num_agents:
+            break
+        candidates = propose(max(64, 2 * (num_agents - count)))
+        accepted = candidates[grid.accept(candidates)][:num_agents - count]
+        placed.append(accepted)
+        count += len(accepted)
+    if count < num_agents:
+        raise RuntimeError(f"Could only place {count} of {num_agents} agents, the world is too full")
+    return np.concatenate(placed)[:num_agents] if placed else np.empty((0, 2))
+
+def place_random(world, num_agents, radius, seed=None, existing=None):
+    """Uniformly random positions like create_agents (random sequential placement),
+    the candidates are drawn and checked in batches on a DiskGrid."""
+    rng = as_generator(seed)
+    grid = new_grid(world, 2 * radius, existing)
+    return sample_until(grid, num_agents,
+                        lambda n: rng.random((n, 2)) * (world.world_size - 2*radius) + radius)
+
+def place_poisson_disk(world, num_agents, radius, seed=None, existing=None, min_distance=None, k=10):
+    """Poisson disk sampling: a maximal set of random points at least min_distance apart
+    (and at least 2*radius from the existing agents) is grown from random seed points as
+    in Bridson's algorithm, with all active points expanded at once in every round, and
+    num_agents of these points are picked at random. By default min_distance spreads the
+    agents evenly over the whole world. If the set has fewer points than agents, it is
+    sampled again with a smaller min_distance (down to 2*radius)."""
+    rng = as_generator(seed)
+    if min_distance is None:
+        # the maximal set has about 0.6 / min_distance**2 points per area (with k=10),
+        # aim for about twice as many points as agents so the set is rarely too small
+        min_distance = np.sqrt(0.6 * world.world_size**2 / (2 * num_agents))
+    min_distance = max(2 * radius, min_distance)
+    # the existing agents only must not overlap with the new ones
+    blocked = new_grid(world, 2 * radius, existing)
+    while True:
+        points = poisson_disk_points(world, radius, rng, blocked, min_distance, k)
+        if len(points) >= num_agents:
+            return points[rng.choice(len(points), num_agents, replace=False)]
+        if min_distance <= 2 * radius:
+            raise RuntimeError(f"Poisson disk sampling gave {len(points)} points for {num_agents} agents, "
+                               "the world is too full")
+        min_distance = max(2 * radius, 0.8 * min_distance)
+
+def poisson_disk_points(world, radius, rng, blocked, min_distance, k, num_seeds=256):
+    # One maximal set of points at least min_distance apart that are free on the grid blocked.
+    # Once no active point is left, the set is grown again from new random seed points (the
+    # existing agents can cut off parts of the world), until a batch of seeds finds no room.
+    grid = new_grid(world, min_distance)
+    active = np.empty(0, dtype=int)
+    while True:
+        num_points = len(grid.points)
+        if len(active) == 0:
+            candidates = rng.random((num_seeds, 2)) * (world.world_size - 2*radius) + radius
+            grid.accept(candidates, blocked.free(candidates))
+            active = np.arange(num_points, len(grid.points))
+            if len(active) == 0:
+                return grid.points
+            continue
+        # k candidates in the annulus [min_distance, 2*min_distance) around every active point
+        owner = np.repeat(active, k)
+        angle = rng.random(len(owner)) * 2 * np.pi
+        distance = min_distance * (1 + rng.random(len(owner)))
+        candidates = grid.points[owner] + distance[:, None] * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+        keep = inside(candidates, world, radius)
+        accepted = grid.accept(candidates[keep], blocked.free(candidates[keep]))
+        # points stay active as long as they produce new points
+        active = np.concatenate([np.unique(owner[keep][accepted]), np.arange(num_points, len(grid.points))])
+
+def place_clusters(world, num_agents, radius, centers, spread, seed=None, existing=None):
+    """Agents normally distributed (standard deviation spread) around randomly chosen
+    cluster centers (K, 2), e.g. to start a team clustered in one corner."""
+    rng = as_generator(seed)
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    grid = new_grid(world, 2 * radius, existing)
+    def propose(n):
+        candidates = centers[rng.integers(len(centers), size=n)] + rng.normal(0, spread, (n, 2))
+        return candidates[inside(candidates, world, radius)]
+    return sample_until(grid, num_agents, propose)
+
+def place_fixed(world, points, radius, existing=None):
+    # check a structured layout for overlaps
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if not inside(points, world, radius).all():
+        raise ValueError("The layout does not fit into the world")
+    if not new_grid(world, 2 * radius, existing).accept(points).all():
+        raise ValueError("Agents of the layout overlap")
+    return points
+
+def place_line(world, num_agents, radius, start, end, existing=None):
+    """Agents evenly spaced on the line from start to end (both included)."""
+    t = np.linspace(0, 1, num_agents)[:, None]
+    return place_fixed(world, (1 - t) * np.asarray(start, dtype=float) + t * np.asarray(end, dtype=float),
+                       radius, existing)
+
+def place_ring(world, num_agents, radius, center, ring_radius, existing=None, phase=0.0):
+    """Agents evenly spaced on a circle of ring_radius around center."""
+    angle = phase + 2 * np.pi * np.arange(num_agents) / num_agents
+    points = np.asarray(center, dtype=float) + ring_radius * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    return place_fixed(world, points, radius, existing)
+
+PLACEMENTS = {"random": place_random, "poisson_disk": place_poisson_disk, "clusters": place_clusters,
+              "line": place_line, "ring": place_ring}
+
+def place_agents(world, strategy, num_agents, radius, **kwargs):
+    """Positions of num_agents agents with the placement strategy of that name."""
+    if strategy not in PLACEMENTS:
+        raise ValueError(f"Unknown placement {strategy}")
+    return PLACEMENTS[strategy](world, num_agents, radius, **kwargs)
+
+def place_team(world, spec, num_agents, radius, seed=None, existing=None):
+    """Place a team with a placement spec: the name of a strategy or a dict with the
+    "strategy" and its arguments, e.g. {"strategy": "clusters", "centers": [[200, 200]], "spread": 50}.
+    The random strategies get the seed, the structured layouts need none."""
+    if isinstance(spec, str):
+        spec = {"strategy": spec}
+    kwargs = {name: value for name, value in spec.items() if name != "strategy"}
+    if spec["strategy"] in ("random", "poisson_disk", "clusters"):
+        kwargs["seed"] = seed
+    return place_agents(world, spec["strategy"], num_agents, radius, existing=existing, **kwargs)
@@ -1,53 +1,139 @@
+import concurrent.futures
+import os
+import subprocess
 import numpy as np
+import matplotlib
 from matplotlib import pyplot as plt
 from matplotlib.animation import FuncAnimation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.patches import Circle, Patch
 
-def animate_agents(i, agent_circles, steps):
-    """Update the position of each agent's circles (both position and sensing radius)."""
-    updated_artists = []
-    for agent_data, agent in zip(agent_circles, steps[i]):
-        position_circle, sensing_circle = agent_data
-        position_circle.center = agent.position
-        sensing_circle.center = agent.position
-        updated_artists.extend([position_circle, sensing_circle])
-    return updated_artists
-
-def plot_movements(sim, anim_length=10, anim_fps=12):
-    """Animate the movements of all agents, including their sensing radius."""
-    skip_frames = max(int(len(sim.history)/(anim_length * anim_fps)), 1)
-    steps = np.array(sim.history[::skip_frames])  # Assuming sim.history is a list of positions for each step
-    
-    fig, ax = plt.subplots()
-    ax.set_xlim(0, sim.world.world_size)
-    ax.set_ylim(0, sim.world.world_size)
+def agent_color(agent_type):
+    if agent_type == 'A':
+        return 'red'
+    elif agent_type == 'B':
+        return 'blue'
+    return 'green'
 
+def add_agent_circles(ax, position, agent_type, radius, sensing_radius, animated=False):
+    """Add a (position_circle, sensing_circle) per agent to ax, at the positions (N, 2)."""
     agent_circles = []  # This will store tuples of (position_circle, sensing_circle) for each agent
-    
-    for agent in steps[0]:
-        if agent.agent_type == 'A':
-            color = 'red'
-        elif agent.agent_type == 'B':
-            color = 'blue'
-        else:
-            color = 'green'
-        position_circle = Circle(agent.position, radius=agent.radius, color=color)
+    for center, kind, r, sensing_r in zip(position, agent_type, radius, sensing_radius):
+        color = agent_color(kind)
+        position_circle = Circle(center, radius=r, color=color, animated=animated)
         ax.add_patch(position_circle)
-        
+
         # We can always add the sensing circle because radius=0 if we don't care about it (and you don't see it)
-        sensing_circle = Circle(agent.position, radius=agent.sensing_radius, color=color, fill=False, linestyle='--')
+        sensing_circle = Circle(center, radius=sensing_r, color=color, fill=False, linestyle='--', animated=animated)
         ax.add_patch(sensing_circle)
-        
+
         agent_circles.append((position_circle, sensing_circle))
-    
-    anim = FuncAnimation(fig, animate_agents, frames=len(steps), interval=1e3/anim_fps, fargs=(agent_circles, steps), blit=True)
-    
-    ax.set_aspect('equal')
+    return agent_circles
 
+def setup_axes(ax, world_size):
+    ax.set_xlim(0, world_size)
+    ax.set_ylim(0, world_size)
+    ax.set_aspect('equal')
     # Create legend
     red_patch = Patch(color='red', label='A')
     blue_patch = Patch(color='blue', label='B')
     ax.legend(handles=[red_patch, blue_patch])
 
+def animate_agents(i, agent_circles, frames):
+    """Update the position of each agent's circles (both position and sensing radius)."""
+    updated_artists = []
+    for agent_data, center in zip(agent_circles, frames[i]):
+        position_circle, sensing_circle = agent_data
+        position_circle.center = center
+        sensing_circle.center = center
+        updated_artists.extend([position_circle, sensing_circle])
+    return updated_artists
+
+def movement_frames(history, anim_length=10, anim_fps=12):
+    """Positions (frames, N, 2) of every skip_frames-th step of a TrajectoryHistory,
+    so that the animation takes anim_length seconds at anim_fps."""
+    skip_frames = max(int(len(history)/(anim_length * anim_fps)), 1)
+    return np.asarray(history.position[::skip_frames])
+
+def plot_movements(sim, anim_length=10, anim_fps=12, filename=None, dpi=100):
+    """Animate the movements of all agents, including their sensing radius.
+    With a filename the animation is written to that file instead of shown (headless)."""
+    history = sim.history
+    frames = movement_frames(history, anim_length, anim_fps)
+    if filename is not None:
+        render_movements(frames, history.agent_type, history.radius, history.sensing_radius,
+                         sim.world.world_size, filename, fps=anim_fps, dpi=dpi)
+        return None
+
+    fig, ax = plt.subplots()
+    agent_circles = add_agent_circles(ax, frames[0], history.agent_type, history.radius, history.sensing_radius)
+    anim = FuncAnimation(fig, animate_agents, frames=len(frames), interval=1e3/anim_fps, fargs=(agent_circles, frames), blit=True)
+    setup_axes(ax, sim.world.world_size)
+
     plt.show()
     return anim
+
+def render_movements(frames, agent_type, radius, sensing_radius, world_size, filename,
+                     fps=12, dpi=100, figsize=(6.4, 4.8)):
+    """Write an animation of the positions frames (F, N, 2) to filename without a display.
+
+    The figure is drawn once, the agent circles are animated artists that are blitted
+    onto the saved background in every frame. The frames are streamed to the writer:
+    .gif files are written with Pillow, everything else (e.g. .mp4) is piped to ffmpeg.
+    Pillow still keeps the part of every gif frame that changed until the file is written,
+    long animations are better written as videos."""
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    agent_circles = add_agent_circles(ax, frames[0], agent_type, radius, sensing_radius, animated=True)
+    setup_axes(ax, world_size)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    width, height = canvas.get_width_height()
+
+    def render(frame):
+        canvas.restore_region(background)
+        for artist in animate_agents(frame, agent_circles, frames):
+            ax.draw_artist(artist)
+        return np.asarray(canvas.buffer_rgba())
+
+    if filename.lower().endswith(".gif"):
+        from PIL import Image
+        def image(i):
+            return Image.fromarray(render(i)).convert("RGB").quantize()
+        # the frames are rendered while Pillow writes them
+        image(0).save(filename, save_all=True, append_images=(image(i) for i in range(1, len(frames))),
+                      duration=1e3/fps, loop=0)
+        return filename
+
+    command = [matplotlib.rcParams["animation.ffmpeg_path"], "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", filename]
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError("ffmpeg is needed to write videos, write a .gif instead") from None
+    with process.stdin:
+        for i in range(len(frames)):
+            process.stdin.write(render(i).tobytes())
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to write {filename}")
+    return filename
+
+def export_animations(runs, filenames, anim_length=10, anim_fps=12, dpi=100, max_workers=None):
+    """Render the animations of many runs (Simulators or stored runs with a trajectory)
+    in parallel worker processes, one file per run. Only the subsampled frames are sent
+    to the workers. Returns the written filenames in the order of runs."""
+    max_workers = max_workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for run, filename in zip(runs, filenames):
+            history = run.history
+            if history is None:
+                raise ValueError(f"Can not animate {filename}, the run has no trajectory")
+            futures.append(executor.submit(
+                render_movements, movement_frames(history, anim_length, anim_fps), np.asarray(history.agent_type),
+                np.asarray(history.radius), np.asarray(history.sensing_radius), run.world.world_size,
+                filename, fps=anim_fps, dpi=dpi))
+        return [future.result() for future in futures]
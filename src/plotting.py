@@ -1,43 +1,27 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from tqdm import tqdm
 
-from src.simulator import Simulator
 from src.world import World
-from src.plot_agents import plot_movements
-from src.helper_functions import create_agents, pos_to_grid, get_density, \
-    get_separation_index, circle_around_index, get_mean_target_distance
+from src.helper_functions import get_density, pad_to_same_length, \
+    density_grid, separation_index_series, mean_target_distance_series
 
 # increase the text size of the plots
 plt.rcParams.update({'font.size': 14})
    
-def plot_density(sims, title="density", name="density"):
+def plot_density(sims, title="density", name="density", resolution=None, kernel_radius=5):
     ###############
     # Density Fig #
     ###############
-    mean_pos_teams = []
-    for sim in sims:
-        # compute the mean position of each team
-        mean_pos_teams.append(get_density(sim,rotate=False))
-    mean_pos_teams = np.array(mean_pos_teams)
-
-    # Create a heatmap of the mean position of each team
-    # Create a grid of worldsize and add an occurrence of 1 at each position of the mean position of each team
+    # compute the mean position of each team, indexing is [simulation, team, x/y]
+    mean_pos_teams = np.array([get_density(sim, rotate=False) for sim in sims])
+    plot_density_map(mean_pos_teams, title=title, name=name, resolution=resolution, kernel_radius=kernel_radius)
+
+def plot_density_map(mean_pos_teams, title="density", name="density", resolution=None, kernel_radius=5):
+    # Heatmap of the mean position of each team, from the (runs, team, x/y) centroids
+    # (so it can also be plotted from the mean_pos_A and mean_pos_B of stored results).
+    # Every centroid adds a disk of kernel_radius grid cells, team A -> +1, team B -> -1
     grid_world = World([-100,100])
-    density = np.zeros((int(grid_world.x_lim[-1]-grid_world.x_lim[0]), 
-                        int(grid_world.y_lim[-1]-grid_world.y_lim[0])))
-    
-    for it,data in enumerate(mean_pos_teams):
-        # team A -> +1
-        x,y = pos_to_grid(data[0], density, grid_world)
-        xs,ys = circle_around_index(x,y, 5, density)
-        for x,y in zip(xs,ys):
-            density[x,y] += 1
-        # team B -> -1
-        x,y = pos_to_grid(data[1], density, grid_world)
-        xs,ys = circle_around_index(x,y, 5, density)
-        for x,y in zip(xs,ys):
-            density[x,y] -= 1
+    density = density_grid(mean_pos_teams, grid_world, resolution=resolution, kernel_radius=kernel_radius)
 
     # Plot the heatmap
     fig, ax = plt.subplots(1,1, figsize=(7,6))
@@ -93,19 +77,21 @@ def plot_separation_index(sims, title="orderliness", name="orderliness"):
     # here we plot the separation index of each simulation
     # orderliness = avg_inter_team_distance / (avg_intra_team_distance_A + avg_intra_team_distance_B)/2
     # Get the separation of all sims over time
-    orderlinesses = []
     intra_team_distances = []
     for sim in sims:
-        indices = []
-        distances = []
-        # we do this for each sim, loop through the history and get the separation index
-        for sim_state in sim.history:
-            orderliness, total_intra_team_distance = get_separation_index(sim_state)
-            indices.append(orderliness)
-            distances.append(total_intra_team_distance)
-        orderlinesses.append(indices)
+        # use the series computed during the run if the sim has the observers
+        if "intra_team_distance" in sim.metrics:
+            intra_team_distances.append(sim.metrics["intra_team_distance"].values)
+            continue
+        # otherwise compute the series from the whole trajectory at once
+        _, distances = separation_index_series(sim.history.position, sim.history.agent_type)
         intra_team_distances.append(distances)
     
+    plot_intra_team_distances(intra_team_distances, title=title, name=name)
+
+def plot_intra_team_distances(intra_team_distances, title="orderliness", name="orderliness"):
+    # Plot the mean and standard deviation over time of the intra team distances,
+    # intra_team_distances is a list with the series of each simulation
     # # Now plot the orderliness over time
     # fig, axs = plt.subplots(1,1, figsize=(12,6))
     # for sim in orderlinesses:
@@ -122,10 +108,9 @@ def plot_separation_index(sims, title="orderliness", name="orderliness"):
     # axs.set_ylabel("Intra team distances")
     # plt.savefig("figures/intra_team_distances_index.png", dpi=300)
 
-    # Create a plot with the mean and standard deviation over time for all the different simulations
-    mean_orderlinesses_index = np.mean(orderlinesses, axis=0)
-    std_orderlinesses_index = np.std(orderlinesses, axis=0)
-
+    # Create a plot with the mean and standard deviation over time for all the different simulations,
+    # runs that converged early are padded with their final state
+    intra_team_distances = pad_to_same_length(intra_team_distances)
     mean_intra_team_distances_index = np.mean(intra_team_distances, axis=0)
     std_intra_team_distances_index = np.std(intra_team_distances, axis=0)
 
@@ -158,17 +143,27 @@ def plot_target_distance(sims, title="target_distance", name="target_distance"):
     mean_target_distances_A = []
     mean_target_distances_B = []
     for sim in sims:
-        distances_A = []
-        distances_B = []
-        # we do this for each sim, loop through the history and get the separation index
-        for sim_state in sim.history:
-            mean_target_distance_A, mean_target_distance_B = get_mean_target_distance(sim_state)
-            distances_A.append(mean_target_distance_A)
-            distances_B.append(mean_target_distance_B)
+        # use the series computed during the run if the sim has the observer
+        if "target_distance" in sim.metrics:
+            distances_A, distances_B = np.transpose(sim.metrics["target_distance"].values)
+            mean_target_distances_A.append(distances_A)
+            mean_target_distances_B.append(distances_B)
+            continue
+        # otherwise compute the series from the whole trajectory at once
+        distances_A, distances_B = mean_target_distance_series(sim.history.target_distance, sim.history.agent_type).T
         mean_target_distances_A.append(distances_A)
         mean_target_distances_B.append(distances_B)
     
-    # Create a plot with the mean and standard deviation over time for all the different simulations
+    plot_target_distance_series(mean_target_distances_A, mean_target_distances_B, title=title, name=name)
+
+def plot_target_distance_series(mean_target_distances_A, mean_target_distances_B,
+                                title="target_distance", name="target_distance"):
+    # Plot the mean target distance of both teams over time,
+    # the inputs are lists with the series of each simulation.
+    # Create a plot with the mean and standard deviation over time for all the different simulations,
+    # runs that converged early are padded with their final state
+    mean_target_distances_A = pad_to_same_length(mean_target_distances_A)
+    mean_target_distances_B = pad_to_same_length(mean_target_distances_B)
     mean_target_distances_A = np.mean(mean_target_distances_A, axis=0)
     std_target_distances_A = np.std(mean_target_distances_A, axis=0)
 
@@ -0,0 +1,76 @@
+import os
+from collections import defaultdict
+
+class Profiler:
+    """Per-phase timers and event counters of a simulation run.
+
+    Enabled with Simulator(..., profile=True), the Simulator, its engine and the agents
+    then get a reference to the profiler (it is None otherwise, so the hot paths only
+    check `if profiler is not None`). Timers accumulate seconds and calls per phase,
+    counters count events like collision checks, rotation attempts of a move and
+    rejected random targets. Profiles of many runs are combined with merge()."""
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.steps = 0
+
+    def add_time(self, name, seconds):
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def merge(self, other):
+        """Add the timers and counters of another Profiler (or of its to_dict())."""
+        if isinstance(other, dict):
+            other = Profiler.from_dict(other)
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+            self.calls[name] += other.calls[name]
+        for name, n in other.counts.items():
+            self.counts[name] += n
+        self.steps += other.steps
+        return self
+
+    def to_dict(self):
+        return {"steps": self.steps, "pid": os.getpid(),
+                "timers": {name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                           for name in sorted(self.seconds)},
+                "counters": dict(sorted(self.counts.items()))}
+
+    @classmethod
+    def from_dict(cls, data):
+        profiler = cls()
+        profiler.steps = data.get("steps", 0)
+        for name, timer in data.get("timers", {}).items():
+            profiler.seconds[name] = timer["seconds"]
+            profiler.calls[name] = timer["calls"]
+        profiler.counts.update(data.get("counters", {}))
+        return profiler
+
+    def report(self):
+        """Table of the timers (total, per step, share of the step time) and counters (total, per step)."""
+        steps = max(self.steps, 1)
+        total = self.seconds.get("step", 0) or sum(self.seconds.values())
+        lines = [f"{'phase':<30}{'seconds':>10}{'ms/step':>10}{'share':>8}{'calls':>10}"]
+        for name, seconds in sorted(self.seconds.items(), key=lambda item: -item[1]):
+            lines.append(f"{name:<30}{seconds:>10.3f}{1e3*seconds/steps:>10.3f}"
+                         f"{seconds/total if total else 0:>8.1%}{self.calls[name]:>10}")
+        lines.append(f"{'counter':<30}{'total':>10}{'per step':>10}")
+        for name, n in sorted(self.counts.items()):
+            lines.append(f"{name:<30}{n:>10}{n/steps:>10.1f}")
+        return "\n".join(lines)
+
+def aggregate_profiles(results, by_worker=False):
+    """Combine the profiles of the summaries of run_batch (runs without a profile, e.g.
+    cache hits, are skipped). Returns one Profiler, or a dict of Profilers per worker pid."""
+    profiles = defaultdict(Profiler)
+    for result in results:
+        profile = result.get("profile")
+        if profile is not None:
+            profiles[profile.get("pid") if by_worker else None].merge(profile)
+    if by_worker:
+        return dict(profiles)
+    return profiles[None]
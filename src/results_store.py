@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import numpy as np
+
+from .world import World
+from .history import AgentState, TrajectoryHistory
+
+class ResultsStore:
+    """Results of simulation runs on disk.
+
+    Layout of the store directory:
+        manifest.jsonl          one line per run: key, run, seed, params, steps, settings
+                                (the requested steps, engine and convergence), path
+        runs/<key>_<settings key>_seed<seed>/
+                                one .npy file per array (trajectory, metric series,
+                                final state and per-agent metadata)
+    Every array is a separate .npy file so it can be memory-mapped when loading,
+    only the parts that a plot actually uses are read from disk."""
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, "runs"), exist_ok=True)
+        self.manifest_file = os.path.join(root, "manifest.jsonl")
+
+    def run_path(self, key, seed):
+        return os.path.join("runs", f"{key}_seed{seed}")
+
+    def save_arrays(self, key, seed, arrays):
+        """Write the arrays of one run, returns the path relative to the store root.
+        The run is written to a temporary directory first, so a crash never leaves
+        a half written run behind. This is safe to call from worker processes."""
+        path = self.run_path(key, seed)
+        final = os.path.join(self.root, path)
+        tmp = final + f".tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(array))
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.rename(tmp, final)
+        return path
+
+    def add(self, entry):
+        """Append the manifest entry of a saved run (only from one process)."""
+        with open(self.manifest_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def entries(self):
+        entries = []
+        if not os.path.exists(self.manifest_file):
+            return entries
+        with open(self.manifest_file) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        return entries
+
+    def find(self, **params):
+        """Manifest entries whose parameters, seed or run settings (steps, engine,
+        convergence, see batch_runner.run_settings) match all given values."""
+        def matches(entry):
+            values = {**entry["params"], **entry.get("settings", {}), "seed": entry["seed"]}
+            return all(values.get(name) == value for name, value in params.items())
+        return [entry for entry in self.entries() if matches(entry)]
+
+    def runs(self, **params):
+        """Lazily loaded StoredRuns of all matching entries."""
+        return [StoredRun(self, entry) for entry in self.find(**params)]
+
+class StoredMetric:
+    # Stands in for a MetricObserver of a stored run
+    def __init__(self, values):
+        self.values = values
+
+class RunArrays:
+    """Base of runs that are loaded from saved arrays (see run_arrays). It has the
+    attributes of a Simulator that the plotting functions use (world, agents,
+    history, metrics); subclasses implement has() and array()."""
+    def __init__(self, params):
+        self.params = params
+        self.scenario = params.get("scenario")
+
+    def has(self, name):
+        raise NotImplementedError
+
+    def array(self, name):
+        raise NotImplementedError
+
+    @property
+    def world(self):
+        return World(list(self.params.get("world_limits", (0, 1000))))
+
+    @property
+    def agents(self):
+        """Final state of all agents as AgentState snapshots."""
+        return [AgentState(*values) for values in zip(
+            self.array("agent_type"), self.array("final_position"), self.array("final_target_position"),
+            self.array("final_target_distance"), self.array("step_length"), self.array("radius"),
+            self.array("sensing_radius"))]
+
+    @property
+    def history(self):
+        """The trajectory (if it was stored) as a TrajectoryHistory on the arrays."""
+        if not self.has("position"):
+            return None
+        return TrajectoryHistory.from_arrays(
+            self.array("agent_type"), self.array("step_length"), self.array("radius"),
+            self.array("sensing_radius"), self.array("position"), self.array("target_position"),
+            self.array("target_distance"))
+
+    @property
+    def metrics(self):
+        names = ("orderliness", "intra_team_distance", "target_distance_series", "team_centroid")
+        metrics = {name: StoredMetric(self.array(name)) for name in names if self.has(name)}
+        # the per-step series of the mean target distance is stored under another name
+        # than the per-agent target distance of the trajectory
+        if "target_distance_series" in metrics:
+            metrics["target_distance"] = metrics.pop("target_distance_series")
+        return metrics
+
+class StoredRun(RunArrays):
+    """One run of a ResultsStore, all arrays are memory-mapped and only loaded on first use."""
+    def __init__(self, store, entry):
+        super().__init__(entry["params"])
+        self.store = store
+        self.entry = entry
+        self.seed = entry["seed"]
+        self.converged_step = entry.get("converged_step")
+        self.path = os.path.join(store.root, entry["path"])
+        self._cache = {}
+
+    def has(self, name):
+        return os.path.exists(os.path.join(self.path, f"{name}.npy"))
+
+    def array(self, name):
+        if name not in self._cache:
+            self._cache[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+        return self._cache[name]
+
+def run_arrays(sim, save_trajectory=False):
+    """Arrays of a finished Simulator to store: per-agent metadata, final state,
+    the series of its metric observers and optionally the full trajectory."""
+    agents = sim.agents
+    arrays = {
+        "agent_type": sim.agent_types,
+        "step_length": np.array([agent.step_length for agent in agents], dtype=float),
+        "radius": np.array([agent.radius for agent in agents], dtype=float),
+        "sensing_radius": np.array([agent.sensing_radius for agent in agents], dtype=float),
+        "final_position": sim.get_positions(),
+        "final_target_position": np.array([agent.target_position for agent in agents]),
+        "final_target_distance": sim.get_target_distances(),
+    }
+    for name, observer in sim.metrics.items():
+        arrays["target_distance_series" if name == "target_distance" else name] = np.array(observer.values)
+    if save_trajectory and sim.history is not None:
+        arrays["position"] = sim.history.position
+        arrays["target_position"] = sim.history.target_position
+        arrays["target_distance"] = sim.history.target_distance
+    return arrays
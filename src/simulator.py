@@ -1,29 +1,302 @@
+import json
+import os
+import pickle
+import time
 import numpy as np
 from .agent import Agent
-import matplotlib.pyplot as plt
-import copy
+from .world import World
+from .engine import VectorizedEngine, CompiledEngine, SCHEDULES, DENSE_NEIGHBOR_LIMIT, pairwise_distances
+from .helper_functions import separation_index_of_distances, separation_index_chunked
+from .teams import TeamRules
+from .history import TrajectoryHistory
+from .profiling import Profiler
 
 class Simulator:
-    def __init__(self, world, agents, scenario="a"):
+    def __init__(self, world, agents, scenario="a", engine="python",
+                 observers=None, record_history=True, profile=False, team_rules=None,
+                 schedule="sequential", batch_size=None, workers=1, seed=None, motion="rotation"):
+        # engine is "python" (Agent.move per agent), "vectorized" (structure-of-arrays engine)
+        # or "compiled" (the structure-of-arrays engine with numba kernels, if installed)
+        # observers are MetricObservers that are updated after every step, they are accessible
+        # by name in self.metrics. Without record_history no trajectory is stored at all.
+        # With profile the time per phase and counters of the hot path are collected in self.profiler.
+        # team_rules (a TeamRules or a dict team -> (first team, second team, "between"/"beyond"))
+        # says relative to which teams every team positions itself, by default A and B by the scenario.
+        # schedule is the update order of a step (see VectorizedEngine), "sequential", "synchronous",
+        # "random" or "partial" with batches of batch_size agents. The python engine only does
+        # "sequential" and "random" (the agents move one after another in a random order).
+        # motion is the collision avoidance of the moves (see VectorizedEngine), "rotation" (the
+        # avoidance angles of Agent.move) or "analytic" (time of impact and sliding, not in the python engine).
+        # workers > 1 runs the target search of the compiled engine on that many threads, and its
+        # sequential moves too when the run has a seed.
+        # With a seed the simulator owns a np.random.Generator and every agent gets its own stream
+        # spawned from it, which (re)draws its initial target and all its random targets, so a run
+        # only depends on the agents' setup and the seed. Without a seed the global np.random is used.
         self.world = world
         self.agents = agents
         self.scenario = scenario
-        self.history = []
+        self.agent_types = np.array([agent.agent_type for agent in agents])
+        self.history = TrajectoryHistory(agents) if record_history else None
+        self.observers = list(observers) if observers is not None else []
+        self.metrics = {observer.name: observer for observer in self.observers}
+        self.step_count = 0
+        # step at which the convergence detector stopped the simulation (None if it ran all steps)
+        self.converged_step = None
+        # (step, value) of the pairwise distances and the separation index, computed at most once per step
+        self.distance_cache = (None, None)
+        self.separation_cache = (None, None)
+        self.team_rules = team_rules if isinstance(team_rules, TeamRules) else TeamRules(team_rules, scenario)
+        self.schedule = schedule
+        self.engine_name = engine
+        self.batch_size = batch_size
+        self.workers = workers
+        self.motion = motion
+        self.seed = seed
+        self.rng = np.random
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+            for agent, rng in zip(agents, self.rng.spawn(len(agents))):
+                agent.rng = rng
+                agent.target_position = rng.random(2) * agent.world_size
+                agent.target_distance = np.linalg.norm(agent.target_position - agent.position)
+        if workers > 1 and engine != "compiled":
+            raise ValueError("Parallel steps (workers > 1) need the compiled engine")
+
+        if engine == "vectorized":
+            self.engine = VectorizedEngine(agents, scenario, team_rules=self.team_rules,
+                                           schedule=schedule, batch_size=batch_size, motion=motion)
+        elif engine == "compiled":
+            self.engine = CompiledEngine(agents, scenario, team_rules=self.team_rules,
+                                         schedule=schedule, batch_size=batch_size, motion=motion,
+                                         workers=workers)
+        elif engine == "python":
+            if schedule not in ("sequential", "random"):
+                raise ValueError(f"The python engine does not support the {schedule} schedule, "
+                                 f"use the vectorized or compiled engine for {SCHEDULES}")
+            if motion != "rotation":
+                raise ValueError("The python engine only has the rotation motion model")
+            self.engine = None
+            if team_rules is not None:
+                for agent in agents:
+                    agent.rule = self.team_rules.rule(agent.agent_type)
+        else:
+            raise ValueError(f"Unknown engine {engine}")
+        self.connect_rngs()
+
+        self.profiler = Profiler() if profile else None
+        if profile:
+            for agent in agents:
+                agent.profiler = self.profiler
+            if self.engine is not None:
+                self.engine.profiler = self.profiler
     
+    def connect_rngs(self):
+        # the engine draws from the same random streams as the agents
+        if self.engine is not None:
+            self.engine.rng = self.rng
+            rngs = [agent.rng for agent in self.agents]
+            self.engine.rngs = None if all(rng is None for rng in rngs) else \
+                [np.random if rng is None else rng for rng in rngs]
+
     def update(self):
         # Update positions of all agents for one simulation step.
-        for agent in self.agents:
-            other_agents = [other for other in self.agents if other != agent]
-            agent.move(other_agents,self.scenario)
+        profiler = self.profiler
+        if profiler is not None:
+            start = time.perf_counter()
+        if self.engine is not None:
+            self.engine.step()
+        else:
+            order = self.agents
+            if self.schedule == "random":
+                order = [self.agents[i] for i in self.rng.permutation(len(self.agents))]
+            for agent in order:
+                other_agents = [other for other in self.agents if other != agent]
+                agent.move(other_agents,self.scenario)
         
+        self.step_count += 1
+        if profiler is not None:
+            now = time.perf_counter()
+            profiler.add_time("step", now - start)
+            profiler.steps += 1
+            start = now
+
         # Store the current positions of all agents
-        # self.history.append([(agent.position[0], agent.position[1]) for agent in self.agents])
-        # Store the current positions of all the agents by making a deep copy of the agent classes at this time instance
-        self.history.append([copy.deepcopy(agent) for agent in self.agents])
+        if self.history is None:
+            pass
+        elif self.engine is not None:
+            self.history.record(self.engine.position, self.engine.target_position, self.engine.target_distance)
+        else:
+            self.history.record_agents(self.agents)
+        if profiler is not None:
+            now = time.perf_counter()
+            profiler.add_time("history", now - start)
+            start = now
+
+        for observer in self.observers:
+            observer.update(self, self.step_count)
+        if profiler is not None:
+            profiler.add_time("observers", time.perf_counter() - start)
     
-    def simulate(self, steps):
+    def get_positions(self):
+        # Current positions of all agents, shape (N, 2)
+        if self.engine is not None:
+            return self.engine.position
+        return np.array([agent.position for agent in self.agents])
+
+    def get_target_distances(self):
+        # Current target distances of all agents, shape (N,)
+        if self.engine is not None:
+            return self.engine.target_distance
+        return np.array([agent.target_distance for agent in self.agents])
+
+    def pair_distances(self):
+        # Distances between all agents after the current step, shape (N, N), or None for large
+        # swarms (more than DENSE_NEIGHBOR_LIMIT agents, where the engine only keeps a neighbor
+        # list). The engines keep them up to date incrementally (only the moved agents), for the
+        # python engine they are computed once per step.
+        if self.engine is not None and self.engine.num_agents > 0:
+            return self.engine.geometry.refresh().distance if self.engine.geometry.dense else None
+        if len(self.agents) > DENSE_NEIGHBOR_LIMIT:
+            return None
+        if self.distance_cache[0] != self.step_count:
+            self.distance_cache = (self.step_count, pairwise_distances(self.get_positions()))
+        return self.distance_cache[1]
+
+    def separation_index(self):
+        # Orderliness and total intra team distance after the current step, shared by the
+        # metric observers and the convergence detector (computed once per step). Large
+        # swarms sum the distances in chunks instead of building the distance matrix.
+        if self.separation_cache[0] != self.step_count:
+            distances = self.pair_distances()
+            if distances is None:
+                value = separation_index_chunked(self.get_positions(), self.agent_types)
+            else:
+                is_A = self.agent_types == 'A'
+                team = np.concatenate([np.flatnonzero(is_A), np.flatnonzero(self.agent_types == 'B')])
+                value = separation_index_of_distances(distances[np.ix_(team, team)], int(is_A.sum()))
+            self.separation_cache = (self.step_count, value)
+        return self.separation_cache[1]
+
+    def simulate(self, steps, convergence=None, checkpoint=None, checkpoint_every=1000):
         # Run the simulation for a given number of steps.
+        # If a ConvergenceDetector is given, stop as soon as it reports convergence.
+        # With a checkpoint path the state is saved every checkpoint_every steps and at the end,
+        # a preempted run is continued with Simulator.load_checkpoint(checkpoint).
+        if self.history is not None:
+            self.history.reserve(len(self.history) + steps)
         for _ in range(steps):
             self.update()
+            if convergence is not None and convergence.update(self):
+                self.converged_step = self.step_count
+                break
+            if checkpoint is not None and self.step_count % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint, convergence)
             # Add progress bar
             # print(f"Simulation progress: {len(self.history)}/{steps}", end="\r")
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint, convergence)
+
+    def save_checkpoint(self, path, convergence=None):
+        """Save the full state of the run to the .npz file path: the agent arrays, the step
+        count, the states of all random streams (or of the global np.random without a seed),
+        the metric series, the trajectory (if recorded) and the ConvergenceDetector.
+        The file is written to a temporary file first and then renamed, so a run that is
+        preempted while saving always leaves the previous checkpoint intact."""
+        agents = self.agents
+        # agents can share a generator (e.g. from create_agents(..., rng=...)), store each one once
+        streams = {}
+        for agent in agents:
+            if agent.rng is not None:
+                streams.setdefault(id(agent.rng), (len(streams), agent.rng))
+        meta = {"scenario": self.scenario, "world_limits": np.asarray(self.world.x_lim, dtype=float).tolist(), "engine": self.engine_name,
+                "schedule": self.schedule, "batch_size": self.batch_size, "workers": self.workers,
+                "motion": self.motion,
+                "team_rules": self.team_rules.rules or None, "step_count": self.step_count,
+                "converged_step": self.converged_step, "seed": self.seed,
+                "rng": self.rng.bit_generator.state if self.seed is not None else None,
+                "streams": [rng.bit_generator.state for _, rng in streams.values()],
+                "agent_stream": [streams[id(agent.rng)][0] if agent.rng is not None else -1 for agent in agents],
+                "metrics": list(self.metrics)}
+        arrays = {
+            "agent_type": self.agent_types,
+            "position": np.array(self.get_positions(), dtype=float).reshape(-1, 2),
+            "target_position": np.array([agent.target_position for agent in agents], dtype=float).reshape(-1, 2),
+            "target_distance": np.array(self.get_target_distances(), dtype=float),
+            "step_length": np.array([agent.step_length for agent in agents], dtype=float),
+            "radius": np.array([agent.radius for agent in agents], dtype=float),
+            "sensing_radius": np.array([agent.sensing_radius for agent in agents], dtype=float),
+            "world_size": np.array([agent.world_size for agent in agents], dtype=float),
+        }
+        if self.seed is None:
+            _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+            arrays["global_rng_keys"] = keys
+            meta["global_rng"] = [int(pos), int(has_gauss), float(cached_gaussian)]
+        for name, observer in self.metrics.items():
+            arrays[f"metric_steps/{name}"] = np.array(observer.steps, dtype=int)
+            arrays[f"metric_values/{name}"] = np.array(observer.values, dtype=float)
+        if self.history is not None:
+            arrays["history_position"] = self.history.position
+            arrays["history_target_position"] = self.history.target_position
+            arrays["history_target_distance"] = self.history.target_distance
+        if convergence is not None:
+            arrays["convergence"] = np.frombuffer(pickle.dumps(convergence), dtype=np.uint8)
+        arrays["meta"] = np.array(json.dumps(meta))
+
+        tmp = f"{path}.tmp{os.getpid()}.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load_checkpoint(cls, path, observers=None, profile=False):
+        """Simulator in the state saved by save_checkpoint, returns (sim, convergence) with
+        the restored ConvergenceDetector (or None). observers are new MetricObservers of the
+        same kind as those of the saved run, their series are restored by name. For a run
+        without a seed the global np.random state is restored as well. Continue the run with
+        sim.simulate(remaining steps, convergence, checkpoint=path)."""
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            arrays = {name: data[name] for name in data.files}
+        world = World(meta["world_limits"])
+        agents = []
+        for i, agent_type in enumerate(arrays["agent_type"]):
+            agent = Agent(str(agent_type), arrays["position"][i], step_length=float(arrays["step_length"][i]),
+                          radius=float(arrays["radius"][i]), sensing_radius=float(arrays["sensing_radius"][i]),
+                          world_size=float(arrays["world_size"][i]))
+            agent.target_position = arrays["target_position"][i].copy()
+            agent.target_distance = float(arrays["target_distance"][i])
+            agents.append(agent)
+        streams = []
+        for state in meta["streams"]:
+            rng = np.random.default_rng()
+            rng.bit_generator.state = state
+            streams.append(rng)
+        for agent, stream in zip(agents, meta["agent_stream"]):
+            if stream >= 0:
+                agent.rng = streams[stream]
+
+        team_rules = {team: tuple(rule) for team, rule in meta["team_rules"].items()} if meta["team_rules"] else None
+        sim = cls(world, agents, meta["scenario"], engine=meta["engine"], observers=observers,
+                  record_history="history_position" in arrays, profile=profile, team_rules=team_rules,
+                  schedule=meta["schedule"], batch_size=meta["batch_size"], workers=meta["workers"],
+                  motion=meta.get("motion", "rotation"))
+        sim.seed = meta["seed"]
+        if sim.seed is not None:
+            sim.rng = np.random.default_rng()
+            sim.rng.bit_generator.state = meta["rng"]
+        sim.connect_rngs()
+        sim.step_count = meta["step_count"]
+        sim.converged_step = meta["converged_step"]
+        for name, observer in sim.metrics.items():
+            if f"metric_steps/{name}" in arrays:
+                observer.steps = arrays[f"metric_steps/{name}"].tolist()
+                observer.values = list(arrays[f"metric_values/{name}"])
+        if sim.history is not None:
+            sim.history = TrajectoryHistory.from_arrays(
+                sim.history.agent_type, sim.history.step_length, sim.history.radius, sim.history.sensing_radius,
+                arrays["history_position"], arrays["history_target_position"], arrays["history_target_distance"])
+        convergence = pickle.loads(arrays["convergence"].tobytes()) if "convergence" in arrays else None
+        if sim.seed is None:
+            # after creating the agents, which draw their initial targets from np.random
+            pos, has_gauss, cached_gaussian = meta["global_rng"]
+            np.random.set_state(("MT19937", arrays["global_rng_keys"], pos, has_gauss, cached_gaussian))
+        return sim, convergence
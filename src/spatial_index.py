@@ -0,0 +1,93 @@
+import numpy as np
+
+class SpatialHash:
+    """Uniform grid (cell list) over the world bounds for neighbor queries.
+
+    The index is built once per step with build(). Agents that move afterwards
+    are reported with update(), they stay in their old cell but the queries are
+    widened by the largest displacement since the build (the slack), and the
+    exact distance test always uses the live positions."""
+    def __init__(self, bounds, cell_size):
+        self.origin = float(bounds[0])
+        self.cell_size = float(cell_size)
+        self.num_cells = max(1, int(np.ceil((bounds[-1] - bounds[0]) / self.cell_size)))
+        self.position = None
+
+    def cell_of(self, position):
+        cell = np.floor((np.asarray(position) - self.origin) / self.cell_size).astype(int)
+        return np.clip(cell, 0, self.num_cells - 1)
+
+    def build(self, position):
+        """(Re)build the index for the positions (N, 2). The array is kept as a
+        reference, so in-place changes are seen by the queries."""
+        self.position = position
+        self.built_position = position.copy()
+        self.slack = 0.0
+        cell = self.cell_of(position)
+        cell_id = cell[:, 0] * self.num_cells + cell[:, 1]
+        self.order = np.argsort(cell_id, kind='stable')
+        self.cell_start = np.searchsorted(cell_id[self.order], np.arange(self.num_cells**2 + 1))
+
+    def update(self, i, position=None):
+        """Report that agent(s) i moved (the position is read from the live array if not given)."""
+        if position is not None:
+            self.position[i] = position
+        diff = (self.position[i] - self.built_position[i]).reshape(-1, 2)
+        if len(diff) > 0:
+            self.slack = max(self.slack, np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]).max())
+
+    def query(self, point, radius):
+        """Sorted indices of all agents closer than radius to point."""
+        reach = radius + self.slack
+        low = self.cell_of(np.asarray(point) - reach)
+        high = self.cell_of(np.asarray(point) + reach)
+        # every x-row of the block of cells is a contiguous range of cell ids
+        rows = [self.order[self.cell_start[cx * self.num_cells + low[1]]:self.cell_start[cx * self.num_cells + high[1] + 1]]
+                for cx in range(low[0], high[0] + 1)]
+        candidates = np.concatenate(rows) if rows else np.empty(0, dtype=int)
+        dx = self.position[candidates, 0] - point[0]
+        dy = self.position[candidates, 1] - point[1]
+        return np.sort(candidates[np.sqrt(dx * dx + dy * dy) < radius])
+
+    def any_within(self, point, radius, radii):
+        """True if any agent j is closer than radius + radii[j] to point."""
+        candidates = self.query(point, radius + radii.max())
+        dx = self.position[candidates, 0] - point[0]
+        dy = self.position[candidates, 1] - point[1]
+        return bool((np.sqrt(dx * dx + dy * dy) < radius + radii[candidates]).any())
+
+    def pairs_within(self, radius):
+        """All pairs (i, j), i != j, with |p_i - p_j| < radius[i], sorted by i and then j.
+
+        Vectorized over all agents: for each cell offset in the search block,
+        every agent is paired with the agents of the neighboring cell."""
+        position = self.position
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), (len(position),))
+        reach = int(np.ceil((radius.max() + self.slack) / self.cell_size)) if len(position) else 0
+        cell = self.cell_of(position)
+        ii, jj = [], []
+        for ox in range(-reach, reach + 1):
+            for oy in range(-reach, reach + 1):
+                cx, cy = cell[:, 0] + ox, cell[:, 1] + oy
+                inside = (cx >= 0) & (cx < self.num_cells) & (cy >= 0) & (cy < self.num_cells)
+                src = np.flatnonzero(inside)
+                cell_id = cx[src] * self.num_cells + cy[src]
+                start, end = self.cell_start[cell_id], self.cell_start[cell_id + 1]
+                count = end - start
+                if count.sum() == 0:
+                    continue
+                i = np.repeat(src, count)
+                # positions within the concatenated ranges [start, end)
+                offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+                j = self.order[np.repeat(start, count) + offsets]
+                ii.append(i)
+                jj.append(j)
+        if not ii:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        i, j = np.concatenate(ii), np.concatenate(jj)
+        dx = position[i, 0] - position[j, 0]
+        dy = position[i, 1] - position[j, 1]
+        keep = (i != j) & (np.sqrt(dx * dx + dy * dy) < radius[i])
+        i, j = i[keep], j[keep]
+        order = np.lexsort((j, i))
+        return i[order], j[order]
@@ -0,0 +1,158 @@
+import itertools
+from collections import defaultdict
+import numpy as np
+
+from .batch_runner import DEFAULT_PARAMS, param_key, run_batch, load_results, run_settings, settings_key
+
+# Parameters that are not swept (the setup of run_multi_agent_sim.py)
+SWEEP_DEFAULTS = {"scenario": "a", "num_A_agents": 6, "num_B_agents": 6, "step_length_A": 1,
+                  "step_length_B": 1, "sensing_radius_A": 200, "sensing_radius_B": 200}
+# Half width of the 95% confidence interval of the mean at which a configuration has
+# enough runs, per summary metric ("steps" is the convergence time of runs with convergence)
+CI_TOLERANCE = {"final_orderliness": 0.02, "steps": 100}
+
+class SweepConfig:
+    """One configuration of an adaptive sweep and the summaries of its runs so far."""
+    def __init__(self, params, level=0):
+        self.params = params
+        self.key = param_key({**DEFAULT_PARAMS, **params})
+        # refinement level, 0 for the configurations of the initial grid
+        self.level = level
+        self.summaries = {}
+
+    @property
+    def num_runs(self):
+        return len(self.summaries)
+
+    def values(self, metric):
+        return np.array([float(summary[metric]) for summary in self.summaries.values()])
+
+    def mean(self, metric):
+        return float(np.mean(self.values(metric)))
+
+    def ci_half_width(self, metric, confidence=0.95):
+        """Half width of the confidence interval of the mean of metric (Student t)."""
+        from scipy import stats
+        values = self.values(metric)
+        if len(values) < 2:
+            return np.inf
+        return float(stats.t.ppf(0.5 + confidence / 2, len(values) - 1) * values.std(ddof=1) / np.sqrt(len(values)))
+
+    def to_dict(self, metrics):
+        return {"key": self.key, "params": self.params, "level": self.level, "runs": self.num_runs,
+                "mean": {metric: self.mean(metric) for metric in metrics},
+                "ci": {metric: self.ci_half_width(metric) for metric in metrics}}
+
+def is_numeric(values):
+    return all(isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool)
+               for value in values)
+
+def midpoint(a, b):
+    # the value between two grid values, integers stay integers (None if there is none)
+    if isinstance(a, (int, np.integer)) and isinstance(b, (int, np.integer)):
+        middle = (int(a) + int(b)) // 2
+        return middle if middle not in (a, b) else None
+    return (a + b) / 2
+
+def adaptive_sweep(ranges, fixed=None, ci_tolerance=None, min_runs=5, max_runs=50, runs_per_round=5,
+                   refine=None, sharpness=0.25, max_level=2, log=None, **run_kwargs):
+    """Sensitivity analysis over the grid of the parameter ranges, with adaptive allocation of runs.
+
+    ranges maps parameters of run_batch (scenario, num_A_agents, step_length_B, ...) to
+    the list of their values, the other parameters are taken from fixed and SWEEP_DEFAULTS.
+    Every configuration first gets min_runs runs, then runs_per_round more per round until
+    the 95% confidence intervals of the means of all metrics in ci_tolerance are narrower
+    than the tolerance (or it has max_runs runs). Once all configurations are sampled
+    enough, the grid is refined where the metrics change sharply: between two neighbors
+    along a numeric parameter in refine (by default all numeric ranges) whose mean differs
+    by more than sharpness times the spread of that metric over all configurations, a
+    configuration with the midpoint value is added (up to max_level refinements deep).
+    The runs are done by run_batch with run_kwargs (steps, convergence, max_workers,
+    batched, store, ...), every round is one run_batch call per group of configurations
+    with the same number of runs. With a store or results_file the sweep can be resumed,
+    only runs with the same steps, engine, convergence and batched settings are reused.
+    Returns the SweepConfigs sorted by their key."""
+    ci_tolerance = dict(CI_TOLERANCE if ci_tolerance is None else ci_tolerance)
+    if "steps" in ci_tolerance and run_kwargs.get("convergence") is None:
+        # without convergence every run takes all steps, there is no convergence time
+        del ci_tolerance["steps"]
+    names = list(ranges)
+    if refine is None:
+        refine = [name for name in names if is_numeric(ranges[name])]
+    base = {**SWEEP_DEFAULTS, **(fixed or {})}
+
+    configs = {}
+    def add(params, level):
+        config = SweepConfig(params, level)
+        if config.key in configs:
+            return False
+        configs[config.key] = config
+        return True
+    for values in itertools.product(*ranges.values()):
+        add({**base, **dict(zip(names, values))}, 0)
+
+    # summaries of earlier runs with the same settings, run_batch skips these jobs
+    store = run_kwargs.get("store")
+    settings = settings_key(run_settings(**{name: run_kwargs[name] for name in ("steps", "engine", "convergence", "batched")
+                                            if name in run_kwargs}))
+    known = {(result["key"], result["run"]): result
+             for result in load_results(run_kwargs.get("results_file")) + (store.entries() if store is not None else [])
+             if result.get("settings_key") == settings}
+
+    def sampled_enough(config):
+        if config.num_runs >= max_runs:
+            return True
+        return config.num_runs >= min_runs and all(config.ci_half_width(metric) <= tolerance
+                                                   for metric, tolerance in ci_tolerance.items())
+
+    while True:
+        todo = [config for config in configs.values() if not sampled_enough(config)]
+        if not todo:
+            if not refine_grid(configs, add, refine, list(ci_tolerance), sharpness, max_level):
+                break
+            continue
+
+        by_runs = defaultdict(list)
+        for config in todo:
+            by_runs[config.num_runs].append(config)
+        for first_run, group in by_runs.items():
+            num_runs = min(min_runs if first_run == 0 else runs_per_round, max_runs - first_run)
+            by_key = {config.key: config for config in group}
+            for summary in run_batch([config.params for config in group], num_runs, first_run=first_run, **run_kwargs):
+                by_key[summary["key"]].summaries[summary["run"]] = summary
+            for config in group:
+                for run in range(first_run, first_run + num_runs):
+                    if run not in config.summaries and (config.key, run) in known:
+                        config.summaries[run] = known[(config.key, run)]
+        if log is not None:
+            log(f"{len(configs)} configurations, {sum(config.num_runs for config in configs.values())} runs, "
+                f"{len(todo)} need more runs")
+    return [configs[key] for key in sorted(configs)]
+
+def refine_grid(configs, add, refine, metrics, sharpness, max_level):
+    """Add the midpoints between neighboring configurations whose metrics differ sharply,
+    returns True if any configuration was added."""
+    configs = list(configs.values())
+    spread = {}
+    for metric in metrics:
+        means = [config.mean(metric) for config in configs]
+        spread[metric] = max(means) - min(means)
+
+    added = False
+    for name in refine:
+        # neighbors along name are the configurations that only differ in name
+        lines = defaultdict(list)
+        for config in configs:
+            rest = tuple(sorted((other, str(value)) for other, value in config.params.items() if other != name))
+            lines[rest].append(config)
+        for line in lines.values():
+            line.sort(key=lambda config: config.params[name])
+            for a, b in zip(line[:-1], line[1:]):
+                if max(a.level, b.level) >= max_level:
+                    continue
+                if not any(abs(a.mean(metric) - b.mean(metric)) > sharpness * spread[metric] > 0 for metric in metrics):
+                    continue
+                value = midpoint(a.params[name], b.params[name])
+                if value is not None:
+                    added |= add({**a.params, name: value}, max(a.level, b.level) + 1)
+    return added
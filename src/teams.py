@@ -0,0 +1,44 @@
+import numpy as np
+
+# Positioning modes of a rule (first, second, mode): "between" first and second
+# (scenario a), or "beyond" second so that second is between first and the agent (scenario b)
+MODES = {"between": "a", "beyond": "b"}
+SCENARIO_MODES = {"a": "between", "b": "beyond"}
+
+class TeamRules:
+    """Rule table of the teams: the pair of teams (first, second) that the agents of a
+    team position themselves relative to, and the mode ("between" or "beyond").
+
+    rules maps team labels to (first, second, mode), e.g. for three teams
+    {"A": ("B", "C", "between"), "B": ("C", "A", "between"), "C": ("A", "B", "beyond")}.
+    Teams without a rule use the rule of the scenario, ("A", "B", "between") for
+    scenario a and ("A", "B", "beyond") for scenario b, as in the two team model."""
+    def __init__(self, rules=None, scenario="a"):
+        if scenario not in SCENARIO_MODES:
+            raise ValueError(f"Unknown scenario {scenario}")
+        self.default = ("A", "B", SCENARIO_MODES[scenario])
+        self.rules = {}
+        for team, (first, second, mode) in (rules or {}).items():
+            if mode not in MODES:
+                raise ValueError(f"Unknown mode {mode} of team {team}, use one of {list(MODES)}")
+            self.rules[team] = (first, second, mode)
+
+    def rule(self, team):
+        return self.rules.get(team, self.default)
+
+    def labels(self, agent_type):
+        """Integer team labels of the agents plus, per agent, the labels of its first and
+        second team and whether it positions itself beyond them. The labels index into
+        the returned list of teams (the teams of the agents, then teams only used in rules)."""
+        agent_type = list(agent_type)
+        teams = list(dict.fromkeys(agent_type))
+        for first, second, _ in [self.default] + list(self.rules.values()):
+            teams += [team for team in (first, second) if team not in teams]
+        index = {team: i for i, team in enumerate(teams)}
+        rules = [self.rule(team) for team in teams]
+        first = np.array([index[first] for first, _, _ in rules], dtype=np.int64)
+        second = np.array([index[second] for _, second, _ in rules], dtype=np.int64)
+        beyond = np.array([mode == "beyond" for _, _, mode in rules], dtype=bool)
+
+        team = np.array([index[t] for t in agent_type], dtype=np.int64)
+        return teams, team, first[team], second[team], beyond[team]